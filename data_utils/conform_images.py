@@ -23,10 +23,16 @@ import argparse
 import os
 import sys
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 
-def reorient_image(img, orientation='LIA'):
-    data = img.get_fdata()
+# images with more voxels than this are subsampled to estimate the rescaling percentiles (see estimate_percentiles)
+DEFAULT_PERCENTILE_SAMPLES = 2 ** 24
+
+def reorient_image(img, orientation='LIA', data=None):
+    """data: voxel values to reorient instead of img's (e.g. already rescaled). Default: img.get_fdata() in float32."""
+    if data is None:
+        data = img.get_fdata(dtype=np.float32)
     affine = img.affine
 
     current_ornt = io_orientation(affine)
@@ -38,18 +44,53 @@ def reorient_image(img, orientation='LIA'):
 
     return nib.Nifti1Image(reoriented_data, new_affine)
 
-def rescale_intensity(image_data, out_min=0, out_max=255, lower_percentile=0.5, upper_percentile=99.5):
-    lower = np.percentile(image_data, lower_percentile)
-    upper = np.percentile(image_data, upper_percentile)
+def estimate_percentiles(image_data, percentiles, max_samples=DEFAULT_PERCENTILE_SAMPLES):
+    """
+    All percentiles of image_data with a single np.partition. Images with more than max_samples voxels are subsampled
+    with a regular stride, the percentiles are then estimates (more samples, more accurate). max_samples=0: exact.
+    """
+    # no copy for C and F ordered arrays
+    flat = image_data.ravel(order='K')
+    if 0 < max_samples < flat.size:
+        flat = flat[::int(np.ceil(flat.size / max_samples))]
+    return np.percentile(flat, percentiles)
+
+def rescale_intensity(image_data, out_min=0, out_max=255, lower_percentile=0.5, upper_percentile=99.5,
+                      max_samples=DEFAULT_PERCENTILE_SAMPLES, in_place=False):
+    """
+    in_place: clip and scale image_data itself (must be a writeable float32 array) instead of a copy, without any
+    full-size temporary.
+    """
+    lower, upper = estimate_percentiles(image_data, [lower_percentile, upper_percentile], max_samples)
 
     if upper - lower == 0:
+        if in_place:
+            image_data.fill(out_min)
+            return image_data
         return np.full_like(image_data, out_min, dtype=np.float32)
 
-    clipped = np.clip(image_data, lower, upper)
-    scaled = (clipped - lower) / (upper - lower)
-    scaled = scaled * (out_max - out_min) + out_min
-
-    return scaled.astype(np.float32)
+    scaled = image_data if in_place else image_data.astype(np.float32)
+    np.clip(scaled, lower, upper, out=scaled)
+    scaled -= lower
+    scaled /= upper - lower
+    scaled *= out_max - out_min
+    scaled += out_min
+
+    return scaled
+
+def conform_image(input_path, output_path, orientation='LIA', out_min=0, out_max=255, lower_percentile=0.5,
+                  upper_percentile=99.5, max_samples=DEFAULT_PERCENTILE_SAMPLES):
+    """Reorients and rescales a single image. The voxel values are loaded once, in float32, and rescaled in place."""
+    original_img = nib.load(input_path)
+    data = original_img.get_fdata(dtype=np.float32)
+    if not data.flags.writeable:
+        # memory mapped .nii
+        data = np.array(data)
+    # both are voxel-wise, rescaling before reorienting keeps the array contiguous for the percentiles
+    rescale_intensity(data, out_min, out_max, lower_percentile, upper_percentile, max_samples, in_place=True)
+    final_img = reorient_image(original_img, orientation.upper(), data)
+    nib.save(final_img, output_path)
+    return output_path
 
 def main(custom_args=None):
     parser = argparse.ArgumentParser(
@@ -62,6 +103,10 @@ def main(custom_args=None):
     parser.add_argument('--max', type=float, default=255, help='Rescale output maximum (default: 255)')
     parser.add_argument('--pmin', type=float, default=0.5, help='Lower percentile for intensity rescaling (default: 0.5)')
     parser.add_argument('--pmax', type=float, default=99.5, help='Upper percentile for intensity rescaling (default: 99.5)')
+    parser.add_argument('--percentile_samples', type=int, default=DEFAULT_PERCENTILE_SAMPLES,
+                        help=f'Maximum number of voxels the percentiles are computed from, larger images are subsampled '
+                             f'with a regular stride. 0: all voxels, exact percentiles (default: {DEFAULT_PERCENTILE_SAMPLES})')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of images conformed in parallel (default: 4)')
 
     if custom_args is None:
         args = parser.parse_args()
@@ -87,18 +132,20 @@ def main(custom_args=None):
     print(f"  Intensity range     : {args.min} to {args.max}")
     print(f"  Intensity rescaling : {args.pmin} to {args.pmax} percentile\n")
 
-    for input_path in input_files:
-        filename = os.path.basename(input_path)
-        output_path = os.path.join(args.output_dir, filename)
-
-        original_img = nib.load(input_path)
-        reoriented_img = reorient_image(original_img, args.orientation.upper())
-        rescaled_data = rescale_intensity(reoriented_img.get_fdata(), args.min, args.max, args.pmin, args.pmax)
-        final_img = nib.Nifti1Image(rescaled_data, reoriented_img.affine)
-        nib.save(final_img, output_path)
+    output_files = [os.path.join(args.output_dir, os.path.basename(i)) for i in input_files]
+    conform_kwargs = dict(orientation=args.orientation, out_min=args.min, out_max=args.max,
+                          lower_percentile=args.pmin, upper_percentile=args.pmax, max_samples=args.percentile_samples)
+    if args.num_workers <= 1 or len(input_files) == 1:
+        for input_path, output_path in zip(input_files, output_files):
+            conform_image(input_path, output_path, **conform_kwargs)
+    else:
+        with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+            futures = [executor.submit(conform_image, i, o, **conform_kwargs) for i, o in zip(input_files, output_files)]
+            # re-raises the exceptions of the workers
+            for f in futures:
+                f.result()
 
     print(f"Finished processing {len(input_files)} images.")
 
 if __name__ == "__main__":
     main()
-
@@ -6,6 +6,8 @@ import nibabel as nib
 import numpy as np
 import pandas as pd
 import glob
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 def strip_nii_extension(filename):
     """
@@ -36,26 +38,42 @@ def load_label_mapping(label_file):
                 label_map[label_id] = label_name
     return label_map
 
-def compute_volumes(nifti_file, label_map, voxel_volume, task):
+def read_label_counts(nifti_file):
+    """
+    Voxel count of every label (index = label ID) of a label map and its voxel volume in mm³, with a single read of the
+    file in its stored dtype and a single np.bincount (instead of np.unique plus one full-volume comparison per label).
+    """
     img = nib.load(nifti_file)
-    data = img.get_fdata()
-    unique_labels = np.unique(data).astype(int)
-    subject_id = strip_nii_extension(os.path.basename(nifti_file))
-
+    voxel_volume = np.prod(img.header.get_zooms())  # mm³
+    data = np.asanyarray(img.dataobj)
+    if not np.issubdtype(data.dtype, np.integer):
+        data = np.round(data).astype(np.int64)
+    return count_labels(data), voxel_volume
+
+def count_labels(data):
+    """np.bincount of a label map. Labels must not be negative."""
+    if np.issubdtype(data.dtype, np.signedinteger) and data.size > 0 and data.min() < 0:
+        raise ValueError("Label maps with negative labels are not supported")
+    return np.bincount(data.ravel().astype(np.intp, copy=False), minlength=1)
+
+def volumes_from_counts(subject_id, label_counts, label_map, voxel_volume, task):
+    """Rows of the volumetry table of one subject from its label voxel counts (see count_labels)."""
     volumes = []
+    present_labels = np.flatnonzero(label_counts)
+    non_zero_vox = label_counts[1:].sum()
 
     if task == "brain":
-        TIV_vox = np.count_nonzero(data)
-        CSF_vox = np.sum(data == 16)
+        TIV_vox = non_zero_vox
+        CSF_vox = label_counts[16] if len(label_counts) > 16 else np.int64(0)
         BV_vox = TIV_vox - CSF_vox
 
-        for label in unique_labels:
+        for label in present_labels:
             if label == 0:
                 continue
-            label_vox = np.sum(data == label)
+            label_vox = label_counts[label]
             abs_vol = label_vox * voxel_volume
-            norm_tiv = abs_vol / (TIV_vox * voxel_volume) if TIV_vox > 0 else 0
-            norm_bv = abs_vol / (BV_vox * voxel_volume) if BV_vox > 0 else 0
+            norm_tiv = abs_vol / (TIV_vox * voxel_volume) if TIV_vox > 0 else 0.0
+            norm_bv = abs_vol / (BV_vox * voxel_volume) if BV_vox > 0 else 0.0
             volumes.append({
                 "Subject": subject_id,
                 "Label_ID": label,
@@ -71,7 +89,7 @@ def compute_volumes(nifti_file, label_map, voxel_volume, task):
             "Label_Name": "TIV",
             "Absolute_Volume_mm3": TIV_vox * voxel_volume,
             "Normalized_Volume_TIV": 1.0,
-            "Normalized_Volume_BV": (TIV_vox / BV_vox) if BV_vox > 0 else 0
+            "Normalized_Volume_BV": (TIV_vox / BV_vox) if BV_vox > 0 else 0.0
         })
 
         volumes.append({
@@ -79,19 +97,19 @@ def compute_volumes(nifti_file, label_map, voxel_volume, task):
             "Label_ID": -2,
             "Label_Name": "BrainVolume(BV)",
             "Absolute_Volume_mm3": BV_vox * voxel_volume,
-            "Normalized_Volume_TIV": (BV_vox / TIV_vox) if TIV_vox > 0 else 0,
+            "Normalized_Volume_TIV": (BV_vox / TIV_vox) if TIV_vox > 0 else 0.0,
             "Normalized_Volume_BV": 1.0
         })
 
     elif task == "cortex":
-        CV_vox = np.count_nonzero(data)
+        CV_vox = non_zero_vox
 
-        for label in unique_labels:
+        for label in present_labels:
             if label == 0:
                 continue
-            label_vox = np.sum(data == label)
+            label_vox = label_counts[label]
             abs_vol = label_vox * voxel_volume
-            norm_cv = abs_vol / (CV_vox * voxel_volume) if CV_vox > 0 else 0
+            norm_cv = abs_vol / (CV_vox * voxel_volume) if CV_vox > 0 else 0.0
             volumes.append({
                 "Subject": subject_id,
                 "Label_ID": label,
@@ -110,6 +128,66 @@ def compute_volumes(nifti_file, label_map, voxel_volume, task):
 
     return volumes
 
+def compute_volumes(nifti_file, label_map, voxel_volume=None, task="brain"):
+    """voxel_volume: in mm³. Default: from the header of nifti_file."""
+    label_counts, header_voxel_volume = read_label_counts(nifti_file)
+    subject_id = strip_nii_extension(os.path.basename(nifti_file))
+    return volumes_from_counts(subject_id, label_counts, label_map,
+                               voxel_volume if voxel_volume is not None else header_voxel_volume, task)
+
+VOLUMETRY_COLUMN_DTYPES = {
+    "Subject": str,
+    "Label_ID": np.int64,
+    "Label_Name": str,
+    "Absolute_Volume_mm3": np.float64,
+    "Normalized_Volume_TIV": np.float64,
+    "Normalized_Volume_BV": np.float64,
+    "Normalized_Volume_CV": np.float64
+}
+
+class VolumetryWriter:
+    """
+    Appends the rows of every subject to a CSV or Parquet file as soon as they are computed, so that the rows of the
+    whole cohort are never held in memory. Parquet requires pyarrow.
+    """
+    def __init__(self, output_file, output_format="csv"):
+        self.output_file = output_file
+        self.output_format = output_format
+        self.num_rows = 0
+        self._parquet_writer = None
+        if output_format == "parquet":
+            try:
+                import pyarrow
+            except ImportError:
+                raise ImportError("Writing Parquet files requires pyarrow (pip install pyarrow)") from None
+
+    def write(self, rows):
+        if len(rows) == 0:
+            return
+        # fixed column dtypes, so that every subject has the same (parquet) schema, whatever its volumes
+        df = pd.DataFrame(rows).astype({c: VOLUMETRY_COLUMN_DTYPES[c] for c in rows[0].keys()})
+        if self.output_format == "csv":
+            df.to_csv(self.output_file, index=False, mode="w" if self.num_rows == 0 else "a",
+                      header=self.num_rows == 0)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self._parquet_writer is None:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                self._parquet_writer = pq.ParquetWriter(self.output_file, table.schema)
+            else:
+                table = pa.Table.from_pandas(df, schema=self._parquet_writer.schema, preserve_index=False)
+            self._parquet_writer.write_table(table)
+        self.num_rows += len(rows)
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+def _compute_volumes_of_file(nifti_path, label_map, task):
+    return compute_volumes(nifti_path, label_map, task=task)
+
 def main():
     parser = argparse.ArgumentParser(description="Volumetry extraction for .nii(.gz) label maps")
     parser.add_argument("--input_dir", "-i", required=True, help="Directory containing .nii or .nii.gz label maps")
@@ -117,6 +195,8 @@ def main():
     parser.add_argument("--task", "-t", choices=["brain", "cortex"], required=True, help="Segmentation task")
     parser.add_argument("--label_file", "-l", help="Optional label mapping file (.txt)")
     parser.add_argument("--dataset_id", "-d", help="Optional dataset ID to include in filename", default="")
+    parser.add_argument("--num_workers", type=int, default=4, help="Number of label maps processed in parallel (default: 4)")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv", help="Output file format (default: csv). parquet requires pyarrow")
 
     args = parser.parse_args()
     input_dir = args.input_dir
@@ -137,23 +217,27 @@ def main():
         return
 
     label_map = load_label_mapping(label_file)
-    all_volumes = []
 
     nii_files = sorted(glob.glob(os.path.join(input_dir, "*.nii*")))
     if not nii_files:
         print("No .nii or .nii.gz files found in the input directory.")
         return
 
-    for nifti_path in nii_files:
-        img = nib.load(nifti_path)
-        voxel_volume = np.prod(img.header.get_zooms())  # mm³
-        volumes = compute_volumes(nifti_path, label_map, voxel_volume, args.task)
-        all_volumes.extend(volumes)
-
-    df = pd.DataFrame(all_volumes)
-    output_csv = os.path.join(output_dir, f"volumetry_{args.task}{dataset_id}.csv")
-    df.to_csv(output_csv, index=False)
-    print(f"Volumetry saved to: {output_csv}")
+    output_file = os.path.join(output_dir, f"volumetry_{args.task}{dataset_id}.{args.format}")
+    writer = VolumetryWriter(output_file, args.format)
+    try:
+        if args.num_workers <= 1:
+            for nifti_path in nii_files:
+                writer.write(_compute_volumes_of_file(nifti_path, label_map, args.task))
+        else:
+            with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+                # results come in the order of the files and are written as soon as they are ready
+                for volumes in executor.map(_compute_volumes_of_file, nii_files, repeat(label_map), repeat(args.task),
+                                            chunksize=4):
+                    writer.write(volumes)
+    finally:
+        writer.close()
+    print(f"Volumetry saved to: {output_file}")
 
 if __name__ == "__main__":
     main()
@@ -33,7 +33,9 @@ def run_preprocessing(args):
         min=args.min,
         max=args.max,
         pmin=args.pmin,
-        pmax=args.pmax
+        pmax=args.pmax,
+        percentile_samples=args.percentile_samples,
+        num_workers=args.num_workers
     )
     conform_images.main(conform_args)
 
@@ -72,6 +74,8 @@ def main():
     parser.add_argument("--max", type=float, default=255, help="Rescale output maximum (default: 255)")
     parser.add_argument("--pmin", type=float, default=0.5, help="Lower percentile (default: 0.5)")
     parser.add_argument("--pmax", type=float, default=99.5, help="Upper percentile (default: 99.5)")
+    parser.add_argument("--percentile_samples", type=int, default=conform_images.DEFAULT_PERCENTILE_SAMPLES, help="Maximum number of voxels the percentiles are computed from, 0 for all voxels (default: %(default)s)")
+    parser.add_argument("--num_workers", type=int, default=4, help="Number of images conformed in parallel (default: 4)")
 
     args = parser.parse_args()
     run_preprocessing(args)
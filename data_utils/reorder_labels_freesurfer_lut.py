@@ -19,9 +19,14 @@
 
 import os
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
 import nibabel as nib
 import numpy as np
 
+from nnunetv2.utilities.telemetry import span, telemetry_case, case_from_file
+
 def load_labels(label_file):
     """Reads a label text file and returns a dictionary mapping label IDs to label names."""
     labels = {}
@@ -38,35 +43,72 @@ def load_labels(label_file):
 
 def create_mapping(old_labels, new_labels):
     """Create a dictionary mapping old label IDs to new label IDs based on label names."""
-    mapping = {}
-    for old_id, old_name in old_labels.items():
-        # Find the corresponding new label ID based on name matching
-        for new_id, new_name in new_labels.items():
-            if old_name == new_name:
-                mapping[old_id] = new_id
-                break
-    return mapping
-
-def process_label_map(file_path, output_dir, mapping):
-    print(f"Processing file: {file_path}")
-    # Load the label map file
+    # first new label ID of every name
+    new_ids_by_name = {}
+    for new_id, new_name in new_labels.items():
+        new_ids_by_name.setdefault(new_name, new_id)
+    return {old_id: new_ids_by_name[old_name] for old_id, old_name in old_labels.items() if old_name in new_ids_by_name}
+
+@lru_cache(maxsize=None)
+def _get_lookup_table(mapping_items, num_entries, dtype):
+    return create_lookup_table(dict(mapping_items), num_entries, dtype)
+
+def create_lookup_table(mapping, num_entries, dtype=np.int32):
+    """Dense old->new label lookup table for the label IDs 0 to num_entries - 1. Labels without a mapping are kept."""
+    lut = np.arange(num_entries, dtype=dtype)
+    for old_label, new_label in mapping.items():
+        if 0 <= old_label < num_entries:
+            lut[old_label] = new_label
+    return lut
+
+def reorder_label_array(label_map, mapping, verbose=False):
+    """Apply an old->new label ID mapping to an in-memory integer label map and return the reordered copy."""
+    with span("reordering"):
+        if verbose:
+            print("Switching labels " + ", ".join(f"{k}->{v}" for k, v in mapping.items()))
+        # the new label IDs may not fit into the dtype of the label map (e.g. uint8 segmentations reordered to
+        # FreeSurfer's lookuptable)
+        new_labels = list(mapping.values())
+        dtype = np.result_type(label_map.dtype, *[np.min_scalar_type(i) for i in (min(new_labels), max(new_labels))]) \
+            if len(new_labels) > 0 else label_map.dtype
+        num_entries = None
+        if label_map.dtype in (np.uint8, np.uint16):
+            # every value of the dtype is covered, no need to look at the label map
+            num_entries = 2 ** (8 * label_map.dtype.itemsize)
+        elif np.issubdtype(label_map.dtype, np.integer) and label_map.size > 0:
+            min_label, max_label = int(label_map.min()), int(label_map.max())
+            if min_label >= 0 and max_label < 2 ** 24:
+                num_entries = max([max_label] + list(mapping.keys())) + 1
+        if num_entries is None:
+            # float, negative or huge labels: one masked assignment per label, as before
+            new_data = label_map.astype(dtype)
+            for old_label, new_label in mapping.items():
+                new_data[label_map == old_label] = new_label
+            return new_data
+        # one gather over the label map instead of one full-volume pass per label. The table is built once per
+        # mapping and dtype
+        lut = _get_lookup_table(tuple(sorted(mapping.items())), num_entries, dtype)
+        return lut[label_map]
+
+def read_integer_label_map(file_path):
+    """Label map in its stored integer dtype (no float64 copy). Float label maps are rounded to int32."""
     img = nib.load(file_path)
-    data = img.get_fdata()
+    data = np.asanyarray(img.dataobj)
+    if not np.issubdtype(data.dtype, np.integer):
+        data = np.round(data).astype(np.int32)
+    return img, data
 
-    # Ensure the data is handled as integer
-    unique_raw_labels = np.unique(data)
-    rounded_int_label_map = np.round(data).astype(np.int32)  # Round first, and then convert to integer
+def process_label_map(file_path, output_dir, mapping):
+    with telemetry_case(case_from_file(file_path)):
+        _process_label_map(file_path, output_dir, mapping)
 
-    # Debug: print the shape and data type of the loaded image
-    print(f"Loaded {file_path}, shape: {rounded_int_label_map.shape}, dtype: {rounded_int_label_map.dtype}")
+def _process_label_map(file_path, output_dir, mapping):
+    # Load the label map file
+    with span("read"):
+        img, data = read_integer_label_map(file_path)
 
     # Map the new labels back to the original labels
-    new_data = np.copy(rounded_int_label_map)
-    for old_label, new_label in mapping.items():
-        print(f"Switching label {old_label} to {new_label}")
-        new_data[rounded_int_label_map == old_label] = new_label
-
-    new_data_rd = np.round(new_data).astype(np.int32)
+    new_data_rd = reorder_label_array(data, mapping).astype(np.int32, copy=False)
 
     # Save the modified label map
     new_affine = img.affine
@@ -76,10 +118,11 @@ def process_label_map(file_path, output_dir, mapping):
     # Save the new label map file
     new_img = nib.Nifti1Image(new_data_rd, new_affine, new_header)
     new_file_path = os.path.join(output_dir, os.path.basename(file_path))
-    nib.save(new_img, new_file_path)
+    with span("write"):
+        nib.save(new_img, new_file_path)
     print(f"Processed {file_path} -> {new_file_path}")
 
-def process_directory(input_dir, output_dir, old_labels_file, new_labels_file):
+def process_directory(input_dir, output_dir, old_labels_file, new_labels_file, num_workers=4):
     # Ensure the output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
@@ -91,10 +134,14 @@ def process_directory(input_dir, output_dir, old_labels_file, new_labels_file):
     mapping = create_mapping(old_labels, new_labels)
 
     # Process each .nii.gz file in the input directory
-    for filename in os.listdir(input_dir):
-        if filename.endswith('.nii.gz'):
-            file_path = os.path.join(input_dir, filename)
+    file_paths = [os.path.join(input_dir, f) for f in sorted(os.listdir(input_dir)) if f.endswith('.nii.gz')]
+    if num_workers <= 1 or len(file_paths) <= 1:
+        for file_path in file_paths:
             process_label_map(file_path, output_dir, mapping)
+        return
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        # list() re-raises the exceptions of the workers
+        list(executor.map(process_label_map, file_paths, [output_dir] * len(file_paths), [mapping] * len(file_paths)))
 
 def main():
     # Argument parser
@@ -107,6 +154,8 @@ def main():
                         help="Path to the text file containing GOUHFI's label definitions (label IDs and names).")
     parser.add_argument('--new_labels_file', type=str, required=True, default=None,
                         help="Path to the text file containing FreeSurfer/new label definitions (label IDs and names).")
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help="Number of label maps processed in parallel. Default: 4.")
     args = parser.parse_args()
 
     # Derive output_dir from input_dir if it is not provided
@@ -118,7 +167,7 @@ def main():
     print(f"Old labels file: {args.old_labels_file}")
     print(f"New labels file: {args.new_labels_file}")
 
-    process_directory(args.input_dir, args.output_dir, args.old_labels_file, args.new_labels_file)
+    process_directory(args.input_dir, args.output_dir, args.old_labels_file, args.new_labels_file, args.num_workers)
     print("Done reordering label values.")
 
 if __name__ == "__main__":
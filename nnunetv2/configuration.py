@@ -8,3 +8,7 @@ ANISO_THRESHOLD = 3  # determines when a sample is considered anisotropic (3 mea
 # resolution axis must be 3x as large as the next largest spacing)
 
 default_n_proc_DA = get_allowed_n_proc_DA()
+
+# memory budget (bytes) of one slab of the chunked resampling and argmax in
+# convert_predicted_logits_to_segmentation_with_correct_shape
+default_export_slab_memory = 256 * 1024 ** 2
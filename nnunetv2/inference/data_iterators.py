@@ -1,8 +1,10 @@
 import multiprocessing
+import os
 import queue
+import traceback
 from torch.multiprocessing import Event, Process, Queue, Manager
 
-from time import sleep
+from time import sleep, perf_counter
 from typing import Union, List
 
 import numpy as np
@@ -10,52 +12,60 @@ import torch
 from batchgenerators.dataloading.data_loader import DataLoader
 
 from nnunetv2.preprocessing.preprocessors.default_preprocessor import DefaultPreprocessor
+from nnunetv2.utilities.helpers import create_shared_memory_tensor, get_shared_memory_descriptor, \
+    open_shared_memory_array, close_shared_memory, release_shared_memory
+from nnunetv2.utilities.telemetry import telemetry_case, case_from_file
 from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
 
 
-def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
-                                       list_of_segs_from_prev_stage_files: Union[None, List[str]],
-                                       output_filenames_truncated: Union[None, List[str]],
-                                       plans_manager: PlansManager,
-                                       dataset_json: dict,
-                                       configuration_manager: ConfigurationManager,
-                                       target_queue: Queue,
-                                       done_event: Event,
-                                       abort_event: Event,
-                                       verbose: bool = False):
-    try:
-        label_manager = plans_manager.get_label_manager(dataset_json)
-        preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
-        for idx in range(len(list_of_lists)):
-            data, seg, data_properties = preprocessor.run_case(list_of_lists[idx],
-                                                               list_of_segs_from_prev_stage_files[
-                                                                   idx] if list_of_segs_from_prev_stage_files is not None else None,
-                                                               plans_manager,
-                                                               configuration_manager,
-                                                               dataset_json)
+def preprocess_fromfiles_save_to_shared_memory(list_of_lists: List[List[str]],
+                                               list_of_segs_from_prev_stage_files: Union[None, List[str]],
+                                               output_filenames_truncated: Union[None, List[str]],
+                                               plans_manager: PlansManager,
+                                               dataset_json: dict,
+                                               configuration_manager: ConfigurationManager,
+                                               task_queue: Queue,
+                                               result_queue: Queue,
+                                               verbose: bool = False):
+    """
+    Worker of preprocessing_iterator_fromfiles. Preprocesses the cases whose indices arrive in task_queue (None ends
+    the worker) and writes them to new shared memory blocks. Only the shared memory descriptor, the properties and the
+    timings go through result_queue. The receiver unlinks the blocks.
+    """
+    label_manager = plans_manager.get_label_manager(dataset_json)
+    preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
+    while True:
+        idx = task_queue.get()
+        if idx is None:
+            return
+        case = os.path.basename(output_filenames_truncated[idx]) if output_filenames_truncated is not None else \
+            case_from_file(list_of_lists[idx][0])
+        try:
+            start_time = perf_counter()
+            with telemetry_case(case):
+                data, seg, data_properties = preprocessor.run_case(list_of_lists[idx],
+                                                                   list_of_segs_from_prev_stage_files[
+                                                                       idx] if list_of_segs_from_prev_stage_files is not None else None,
+                                                                   plans_manager,
+                                                                   configuration_manager,
+                                                                   dataset_json)
             if list_of_segs_from_prev_stage_files is not None and list_of_segs_from_prev_stage_files[idx] is not None:
                 seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
                 data = np.vstack((data, seg_onehot))
+            preprocessing_time = perf_counter() - start_time
 
-            data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
-
-            item = {'data': data, 'data_properties': data_properties,
-                    'ofile': output_filenames_truncated[idx] if output_filenames_truncated is not None else None}
-            success = False
-            while not success:
-                try:
-                    if abort_event.is_set():
-                        return
-                    target_queue.put(item, timeout=0.01)
-                    success = True
-                except queue.Full:
-                    pass
-        done_event.set()
-    except Exception as e:
-        # print(Exception, e)
-        abort_event.set()
-        raise e
+            start_time = perf_counter()
+            block, shared_data = create_shared_memory_tensor(data.shape, np.float32)
+            shared_data.numpy()[:] = data
+            descriptor = get_shared_memory_descriptor(block, shared_data)
+            del shared_data, data
+            close_shared_memory(block)
+            result_queue.put((idx, descriptor, data_properties,
+                              {'preprocessing': preprocessing_time, 'handoff': perf_counter() - start_time}))
+        except Exception:
+            result_queue.put((idx, None, traceback.format_exc(), None))
+            raise
 
 
 def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
@@ -66,57 +76,133 @@ def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
                                      configuration_manager: ConfigurationManager,
                                      num_processes: int,
                                      pin_memory: bool = False,
-                                     verbose: bool = False):
+                                     verbose: bool = False,
+                                     prefetch_depth: Union[int, None] = None,
+                                     in_order: bool = False,
+                                     stats: Union[dict, None] = None):
+    """
+    Preprocesses the cases in num_processes background workers and yields them as soon as they are done (completion
+    order, so a slow case does not hold back the ones behind it) unless in_order is set. At most prefetch_depth cases
+    (default: num_processes + 1) are dispatched to the workers but not yet yielded, which bounds the RAM taken by
+    finished cases waiting for the predictor. The preprocessed data is handed over in shared memory.
+    If stats is given it is filled with the utilization of the workers and of the consumer (the predictor) once all
+    cases are yielded. A summary is printed as well.
+    """
     context = multiprocessing.get_context('spawn')
-    manager = Manager()
-    num_processes = min(len(list_of_lists), num_processes)
+    num_cases = len(list_of_lists)
+    num_processes = min(num_cases, num_processes)
     assert num_processes >= 1
+    if prefetch_depth is None:
+        prefetch_depth = num_processes + 1
+    assert prefetch_depth >= 1
+    task_queue = context.Queue()
+    result_queue = context.Queue()
     processes = []
-    done_events = []
-    target_queues = []
-    abort_event = manager.Event()
     for i in range(num_processes):
-        event = manager.Event()
-        queue = Manager().Queue(maxsize=1)
-        pr = context.Process(target=preprocess_fromfiles_save_to_queue,
-                     args=(
-                         list_of_lists[i::num_processes],
-                         list_of_segs_from_prev_stage_files[
-                         i::num_processes] if list_of_segs_from_prev_stage_files is not None else None,
-                         output_filenames_truncated[
-                         i::num_processes] if output_filenames_truncated is not None else None,
-                         plans_manager,
-                         dataset_json,
-                         configuration_manager,
-                         queue,
-                         event,
-                         abort_event,
-                         verbose
-                     ), daemon=True)
+        pr = context.Process(target=preprocess_fromfiles_save_to_shared_memory,
+                             args=(
+                                 list_of_lists,
+                                 list_of_segs_from_prev_stage_files,
+                                 output_filenames_truncated,
+                                 plans_manager,
+                                 dataset_json,
+                                 configuration_manager,
+                                 task_queue,
+                                 result_queue,
+                                 verbose
+                             ), daemon=True)
         pr.start()
-        target_queues.append(queue)
-        done_events.append(event)
         processes.append(pr)
 
-    worker_ctr = 0
-    while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
-        # import IPython;IPython.embed()
-        if not target_queues[worker_ctr].empty():
-            item = target_queues[worker_ctr].get()
-            worker_ctr = (worker_ctr + 1) % num_processes
-        else:
-            all_ok = all(
-                [i.is_alive() or j.is_set() for i, j in zip(processes, done_events)]) and not abort_event.is_set()
-            if not all_ok:
-                raise RuntimeError('Background workers died. Look for the error message further up! If there is '
-                                   'none then your RAM was full and the worker was killed by the OS. Use fewer '
-                                   'workers or get more RAM in that case!')
-            sleep(0.01)
-            continue
-        if pin_memory:
-            [i.pin_memory() for i in item.values() if isinstance(i, torch.Tensor)]
-        yield item
-    [p.join() for p in processes]
+    start_time = perf_counter()
+    timings = {'preprocessing': 0., 'handoff': 0., 'consumer_wait': 0., 'consumer_busy': 0.}
+    num_dispatched = 0
+    num_yielded = 0
+    # finished cases that cannot be yielded yet (in_order)
+    finished = {}
+    try:
+        while num_dispatched < min(prefetch_depth, num_cases):
+            task_queue.put(num_dispatched)
+            num_dispatched += 1
+
+        while num_yielded < num_cases:
+            wait_start = perf_counter()
+            while (num_yielded not in finished) if in_order else (len(finished) == 0):
+                try:
+                    idx, descriptor, data_properties, worker_timings = result_queue.get(timeout=1)
+                except queue.Empty:
+                    if not all([p.is_alive() for p in processes]):
+                        raise RuntimeError('Background workers died. Look for the error message further up! If '
+                                           'there is none then your RAM was full and the worker was killed by the '
+                                           'OS. Use fewer workers or get more RAM in that case!')
+                    continue
+                if descriptor is None:
+                    # data_properties is the traceback of the worker
+                    raise RuntimeError(f'Preprocessing of {list_of_lists[idx]} failed:\n{data_properties}')
+                block, shared_data = open_shared_memory_array(descriptor)
+                # pinned memory speeds up the copy to the GPU
+                data = torch.empty(shared_data.shape, dtype=torch.float32, pin_memory=pin_memory)
+                data.numpy()[:] = shared_data
+                del shared_data
+                release_shared_memory(block)
+                for k, v in worker_timings.items():
+                    timings[k] += v
+                finished[idx] = (data, data_properties)
+            idx = num_yielded if in_order else next(iter(finished.keys()))
+            data, data_properties = finished.pop(idx)
+            timings['consumer_wait'] += perf_counter() - wait_start
+
+            item = {'data': data, 'data_properties': data_properties,
+                    'ofile': output_filenames_truncated[idx] if output_filenames_truncated is not None else None}
+            del data
+            num_yielded += 1
+            # the prefetch slot of this case is free once it is handed to the consumer
+            if num_dispatched < num_cases:
+                task_queue.put(num_dispatched)
+                num_dispatched += 1
+            busy_start = perf_counter()
+            yield item
+            timings['consumer_busy'] += perf_counter() - busy_start
+    finally:
+        # if we stopped early, the workers should not start on cases that were dispatched but not picked up yet
+        while True:
+            try:
+                task_queue.get(timeout=0.1)
+            except queue.Empty:
+                break
+        for _ in processes:
+            task_queue.put(None)
+        for p in processes:
+            p.join(timeout=10)
+            if p.is_alive():
+                p.terminate()
+        # cases that were preprocessed but not picked up because we stopped early
+        while True:
+            try:
+                _, descriptor, _, _ = result_queue.get(timeout=0.1)
+            except queue.Empty:
+                break
+            if descriptor is not None:
+                block, _ = open_shared_memory_array(descriptor)
+                release_shared_memory(block)
+
+    wall_time = perf_counter() - start_time
+    utilization = {
+        'num_cases': num_cases,
+        'num_processes': num_processes,
+        'prefetch_depth': prefetch_depth,
+        'wall_seconds': wall_time,
+        **{f'{k}_seconds': v for k, v in timings.items()},
+        'worker_utilization': timings['preprocessing'] / max(wall_time * num_processes, 1e-8),
+        'consumer_utilization': timings['consumer_busy'] / max(wall_time, 1e-8),
+    }
+    if stats is not None:
+        stats.update(utilization)
+    print(f'Preprocessing: {num_cases} cases in {wall_time:.2f} s with {num_processes} workers (utilization '
+          f'{utilization["worker_utilization"]:.0%}), {timings["handoff"]:.2f} s shared memory handoff. The predictor '
+          f'waited {timings["consumer_wait"]:.2f} s ({timings["consumer_wait"] / max(wall_time, 1e-8):.0%}) for '
+          f'preprocessed cases')
+
 
 class PreprocessAdapter(DataLoader):
     def __init__(self, list_of_lists: List[List[str]],
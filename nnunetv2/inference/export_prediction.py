@@ -1,15 +1,31 @@
 import os
 from copy import deepcopy
-from typing import Union, List
+from typing import Union, List, Optional
 
 import numpy as np
 import torch
 from acvl_utils.cropping_and_padding.bounding_boxes import bounding_box_to_slice
 from batchgenerators.utilities.file_and_folder_operations import load_json, isfile, save_pickle
 
-from nnunetv2.configuration import default_num_processes
+from nnunetv2.configuration import default_num_processes, default_export_slab_memory
+from nnunetv2.preprocessing.resampling.default_resampling import can_resample_data_to_shape_in_slabs, \
+    resample_data_to_shape_in_slab
+from nnunetv2.utilities.helpers import open_shared_memory_array, close_shared_memory
 from nnunetv2.utilities.label_handling.label_handling import LabelManager
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.telemetry import span, telemetry_case
+
+
+def get_slab_size_for_memory_budget(num_channels: int, new_shape: Union[List[int], tuple], max_memory: int,
+                                    itemsize: int = 2) -> int:
+    """
+    Number of rows (first axis of new_shape) of resampled logits that can be processed at once with max_memory bytes.
+    Per row we hold the input rows and the resampled logits (itemsize bytes, usually fp16) and the float32 copy of the
+    resampled logits for the argmax. Input rows are counted like output rows, which is an overestimate when upsampling
+    to the original resolution (the usual case for high resolution images)
+    """
+    bytes_per_row = num_channels * int(np.prod(new_shape[1:])) * (itemsize + itemsize + 4)
+    return int(max(1, min(new_shape[0], max_memory // bytes_per_row)))
 
 
 def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits: Union[torch.Tensor, np.ndarray],
@@ -18,7 +34,19 @@ def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits
                                                                 label_manager: LabelManager,
                                                                 properties_dict: dict,
                                                                 return_probabilities: bool = False,
-                                                                num_threads_torch: int = default_num_processes):
+                                                                num_threads_torch: int = default_num_processes,
+                                                                max_memory: Optional[int] = None):
+    """
+    Unless return_probabilities, the logits are resampled and converted to a segmentation in slabs along the first
+    axis (see get_slab_size_for_memory_budget) that are written straight into the uint8 output, so the resampled
+    logits and the probabilities of all classes are never held in memory at once. The probabilities are only computed
+    if return_probabilities. This is used with the default resampling function whenever the result is identical to
+    resampling the whole image up to rounding (see can_resample_data_to_shape_in_slabs and
+    resample_data_to_shape_in_slab).
+    max_memory: memory budget (bytes) of a slab. Default: default_export_slab_memory. If given, slabs are also used
+    where they only approximate the resampling of the whole image (splines of order > 1 along the first axis).
+    predicted_logits can then be memory mapped.
+    """
     old_threads = torch.get_num_threads()
     torch.set_num_threads(num_threads_torch)
 
@@ -27,26 +55,49 @@ def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits
         len(configuration_manager.spacing) == \
         len(properties_dict['shape_after_cropping_and_before_resampling']) else \
         [properties_dict['spacing'][0], *configuration_manager.spacing]
-    predicted_logits = configuration_manager.resampling_fn_probabilities(predicted_logits,
-                                            properties_dict['shape_after_cropping_and_before_resampling'],
-                                            current_spacing,
-                                            properties_dict['spacing'])
-    # return value of resampling_fn_probabilities can be ndarray or Tensor but that does not matter because
-    # apply_inference_nonlin will convert to torch
-    predicted_probabilities = label_manager.apply_inference_nonlin(predicted_logits)
-    del predicted_logits
-    segmentation = label_manager.convert_probabilities_to_segmentation(predicted_probabilities)
-
-    # segmentation may be torch.Tensor but we continue with numpy
-    if isinstance(segmentation, torch.Tensor):
-        segmentation = segmentation.cpu().numpy()
-
-    # put segmentation in bbox (revert cropping)
+    new_shape = properties_dict['shape_after_cropping_and_before_resampling']
+    resampling_kwargs = configuration_manager.configuration['resampling_fn_probabilities_kwargs']
     segmentation_reverted_cropping = np.zeros(properties_dict['shape_before_cropping'],
                                               dtype=np.uint8 if len(label_manager.foreground_labels) < 255 else np.uint16)
     slicer = bounding_box_to_slice(properties_dict['bbox_used_for_cropping'])
-    segmentation_reverted_cropping[slicer] = segmentation
-    del segmentation
+    # resampling and conversion to a segmentation
+    with span('export_resampling'):
+        if not return_probabilities and \
+                configuration_manager.configuration['resampling_fn_probabilities'] == 'resample_data_or_seg_to_shape' and \
+                can_resample_data_to_shape_in_slabs(current_spacing, properties_dict['spacing'], **resampling_kwargs,
+                                                    require_exact=max_memory is None):
+            itemsize = predicted_logits.element_size() if isinstance(predicted_logits, torch.Tensor) else \
+                predicted_logits.itemsize
+            slab_size = get_slab_size_for_memory_budget(
+                predicted_logits.shape[0], new_shape,
+                max_memory if max_memory is not None else default_export_slab_memory, itemsize)
+            # the segmentation of a slab goes straight into the cropped region of the output
+            cropped_segmentation = segmentation_reverted_cropping[slicer]
+            for s in range(0, new_shape[0], slab_size):
+                logits_slab = resample_data_to_shape_in_slab(predicted_logits, new_shape, current_spacing,
+                                                             properties_dict['spacing'], slice(s, s + slab_size),
+                                                             **resampling_kwargs)
+                cropped_segmentation[s:s + slab_size] = label_manager.convert_logits_to_segmentation(logits_slab)
+                del logits_slab
+            del predicted_logits, cropped_segmentation
+        else:
+            predicted_logits = configuration_manager.resampling_fn_probabilities(predicted_logits,
+                                                    new_shape,
+                                                    current_spacing,
+                                                    properties_dict['spacing'])
+            # return value of resampling_fn_probabilities can be ndarray or Tensor but that does not matter because
+            # apply_inference_nonlin will convert to torch
+            predicted_probabilities = label_manager.apply_inference_nonlin(predicted_logits)
+            del predicted_logits
+            segmentation = label_manager.convert_probabilities_to_segmentation(predicted_probabilities)
+
+            # segmentation may be torch.Tensor but we continue with numpy
+            if isinstance(segmentation, torch.Tensor):
+                segmentation = segmentation.cpu().numpy()
+
+            # put segmentation in bbox (revert cropping)
+            segmentation_reverted_cropping[slicer] = segmentation
+            del segmentation
 
     # revert transpose
     segmentation_reverted_cropping = segmentation_reverted_cropping.transpose(plans_manager.transpose_backward)
@@ -72,7 +123,7 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
                                   configuration_manager: ConfigurationManager,
                                   plans_manager: PlansManager,
                                   dataset_json_dict_or_file: Union[dict, str], output_file_truncated: str,
-                                  save_probabilities: bool = False):
+                                  save_probabilities: bool = False, max_memory: Optional[int] = None):
     # if isinstance(predicted_array_or_file, str):
     #     tmp = deepcopy(predicted_array_or_file)
     #     if predicted_array_or_file.endswith('.npy'):
@@ -87,7 +138,7 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
     label_manager = plans_manager.get_label_manager(dataset_json_dict_or_file)
     ret = convert_predicted_logits_to_segmentation_with_correct_shape(
         predicted_array_or_file, plans_manager, configuration_manager, label_manager, properties_dict,
-        return_probabilities=save_probabilities
+        return_probabilities=save_probabilities, max_memory=max_memory
     )
     del predicted_array_or_file
 
@@ -102,8 +153,9 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
         del ret
 
     rw = plans_manager.image_reader_writer_class()
-    rw.write_seg(segmentation_final, output_file_truncated + dataset_json_dict_or_file['file_ending'],
-                 properties_dict)
+    with span('write'):
+        rw.write_seg(segmentation_final, output_file_truncated + dataset_json_dict_or_file['file_ending'],
+                     properties_dict)
 
 
 def resample_and_save(predicted: Union[torch.Tensor, np.ndarray], target_shape: List[int], output_file: str,
@@ -143,3 +195,60 @@ def resample_and_save(predicted: Union[torch.Tensor, np.ndarray], target_shape:
         segmentation = segmentation.cpu().numpy()
     np.savez_compressed(output_file, seg=segmentation.astype(np.uint8))
     torch.set_num_threads(old_threads)
+
+
+# set by initialize_export_worker in the processes of an export pool
+_export_worker_state = {}
+
+
+def initialize_export_worker(plans_manager: PlansManager, configuration_manager: ConfigurationManager,
+                             dataset_json: dict, **kwargs) -> None:
+    """
+    Initializer of export pools (Pool(initializer=initialize_export_worker, initargs=...)). The plans, configuration
+    and dataset.json are sent to every worker once instead of with every case. Additional kwargs are stored as well,
+    for tasks that need more (see get_export_worker_state).
+    """
+    _export_worker_state.clear()
+    _export_worker_state.update(plans_manager=plans_manager, configuration_manager=configuration_manager,
+                                dataset_json=dataset_json,
+                                label_manager=plans_manager.get_label_manager(dataset_json), **kwargs)
+
+
+def get_export_worker_state() -> dict:
+    assert len(_export_worker_state) > 0, 'This process was not initialized with initialize_export_worker'
+    return _export_worker_state
+
+
+def export_prediction_from_shared_logits(shared_logits: dict, properties_dict: dict, output_file_truncated: str,
+                                         save_probabilities: bool = False) -> None:
+    """
+    export_prediction_from_logits for export workers initialized with initialize_export_worker. shared_logits
+    describes logits in shared memory (see get_shared_memory_descriptor). They are mapped, not copied.
+    """
+    state = get_export_worker_state()
+    block, predicted_logits = open_shared_memory_array(shared_logits)
+    try:
+        with telemetry_case(os.path.basename(output_file_truncated)):
+            export_prediction_from_logits(predicted_logits, properties_dict, state['configuration_manager'],
+                                          state['plans_manager'], state['dataset_json'], output_file_truncated,
+                                          save_probabilities)
+    finally:
+        del predicted_logits
+        close_shared_memory(block)
+
+
+def convert_shared_logits_to_segmentation_with_correct_shape(shared_logits: dict, properties_dict: dict,
+                                                             return_probabilities: bool = False):
+    """
+    convert_predicted_logits_to_segmentation_with_correct_shape for export workers initialized with
+    initialize_export_worker, see export_prediction_from_shared_logits
+    """
+    state = get_export_worker_state()
+    block, predicted_logits = open_shared_memory_array(shared_logits)
+    try:
+        return convert_predicted_logits_to_segmentation_with_correct_shape(
+            predicted_logits, state['plans_manager'], state['configuration_manager'], state['label_manager'],
+            properties_dict, return_probabilities)
+    finally:
+        del predicted_logits
+        close_shared_memory(block)
@@ -0,0 +1,45 @@
+from copy import deepcopy
+from typing import List
+
+import torch
+from torch import nn
+from torch.func import stack_module_state, functional_call
+
+
+class FoldEnsemble(nn.Module):
+    """
+    Runs all folds of a model in a single (vmapped) forward pass and returns the mean of their logits. The weights of
+    all folds are stacked along a new leading dimension, so the folds must share the same architecture.
+
+    Averaging the logits of every tile before the sliding window aggregation gives the same result as averaging the
+    aggregated logits of each fold (gaussian weighting and mirroring are linear), up to floating point precision.
+    """
+    def __init__(self, networks: List[nn.Module]):
+        super().__init__()
+        assert len(networks) > 0, 'Need at least one network'
+        for n in networks:
+            n.eval()
+        self.num_folds = len(networks)
+        self.stacked_params, self.stacked_buffers = stack_module_state(networks)
+        for v in self.stacked_params.values():
+            v.requires_grad_(False)
+        # the template only provides the forward. It is kept out of the module tree so that .to() etc do not see it
+        self._template = [deepcopy(networks[0]).to('meta')]
+
+    @property
+    def template_network(self) -> nn.Module:
+        """Architecture shared by all folds (on the meta device, holds no weights)"""
+        return self._template[0]
+
+    def _apply(self, fn, *args, **kwargs):
+        self.stacked_params = {k: fn(v) for k, v in self.stacked_params.items()}
+        self.stacked_buffers = {k: fn(v) for k, v in self.stacked_buffers.items()}
+        return super()._apply(fn, *args, **kwargs)
+
+    def _forward_single_fold(self, params: dict, buffers: dict, x: torch.Tensor) -> torch.Tensor:
+        return functional_call(self.template_network, (params, buffers), (x,))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        predictions = torch.vmap(self._forward_single_fold, in_dims=(0, 0, None))(self.stacked_params,
+                                                                                   self.stacked_buffers, x)
+        return predictions.mean(0)
@@ -0,0 +1,245 @@
+import io
+import os
+import traceback
+from queue import Empty
+from typing import List, Union, Tuple
+
+import torch
+import torch.multiprocessing as mp
+from batchgenerators.utilities.file_and_folder_operations import join
+
+import nnunetv2
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.quantization import build_int8_network
+from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
+from nnunetv2.utilities.helpers import get_peak_rss
+from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.telemetry import set_telemetry_case, get_telemetry_case
+
+
+def fold_worker(predictor_kwargs: dict, plans_manager: PlansManager, configuration_manager: ConfigurationManager,
+                parameters: List[dict], dataset_json: dict, trainer_name: str, allowed_mirroring_axes,
+                int8_quantization: Union[dict, None], fold_indices: List[int], num_threads: int, input_queue: mp.Queue,
+                output_queue: mp.Queue):
+    """
+    Holds the networks of the folds in fold_indices and predicts every case it receives with each of them. Results
+    are sent back fold by fold as (case_id, fold_index, fp16 logits, memory stats), the memory stats being the peak
+    memory of this worker up to that fold (same keys as nnUNetPredictor.memory_stats). Runs until it receives None.
+    """
+    torch.set_num_threads(num_threads)
+    if predictor_kwargs['device'].type == 'cuda':
+        torch.set_num_interop_threads(1)
+        torch.cuda.set_device(predictor_kwargs['device'])
+
+    # networks cannot be pickled, so we rebuild it the same way initialize_from_trained_model_folder does
+    num_input_channels = determine_num_input_channels(plans_manager, configuration_manager, dataset_json)
+    trainer_class = recursive_find_python_class(join(nnunetv2.__path__[0], "training", "nnUNetTrainer"),
+                                                trainer_name, 'nnunetv2.training.nnUNetTrainer')
+    network = trainer_class.build_network_architecture(
+        configuration_manager.network_arch_class_name,
+        configuration_manager.network_arch_init_kwargs,
+        configuration_manager.network_arch_init_kwargs_req_import,
+        num_input_channels,
+        plans_manager.get_label_manager(dataset_json).num_segmentation_heads,
+        enable_deep_supervision=False
+    )
+    if int8_quantization is not None:
+        network = build_int8_network(network, configuration_manager.patch_size, num_input_channels,
+                                     int8_quantization['backend'], int8_quantization['fp32_modules'])
+        parameters = [torch.load(io.BytesIO(p)) for p in parameters]
+    predictor = nnUNetPredictor(**predictor_kwargs)
+    predictor.manual_initialization(network, plans_manager, configuration_manager, parameters, dataset_json,
+                                    trainer_name, allowed_mirroring_axes)
+
+    while True:
+        item = input_queue.get()
+        if item is None:
+            break
+        case_id, data, case = item
+        set_telemetry_case(case)
+        peak_rss_before = get_peak_rss()
+        if predictor.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(predictor.device)
+        try:
+            for fold_index, network in zip(fold_indices, predictor.fold_networks):
+                predictor.network = network
+                logits = predictor._internal_predict_fold(data, fold_index).to('cpu')
+                memory_stats = {
+                    'peak_rss': get_peak_rss(),
+                    'peak_rss_increase': max(0, get_peak_rss() - peak_rss_before),
+                    'peak_device_memory': torch.cuda.max_memory_allocated(predictor.device)
+                    if predictor.device.type == 'cuda' else None
+                }
+                output_queue.put((case_id, fold_index, logits, memory_stats))
+                del logits
+        except Exception:
+            output_queue.put((case_id, None, traceback.format_exc(), None))
+        del data
+
+
+class nnUNetFoldParallelPredictor(nnUNetPredictor):
+    def __init__(self,
+                 tile_step_size: float = 0.5,
+                 use_gaussian: bool = True,
+                 use_mirroring: bool = True,
+                 perform_everything_on_device: bool = True,
+                 device: torch.device = torch.device('cuda'),
+                 verbose: bool = False,
+                 verbose_preprocessing: bool = False,
+                 allow_tqdm: bool = True,
+                 tile_batch_size: Union[int, str] = 1,
+                 batched_mirroring: bool = False,
+                 mirror_axes_combinations: Union[List[Tuple[int, ...]], None] = None,
+                 tile_skip_threshold: Union[float, None] = None,
+                 max_tiles: Union[int, None] = None,
+                 target_latency: Union[float, None] = None,
+                 refine_threshold: Union[float, None] = None,
+                 cpu_precision: str = 'fp32',
+                 num_fold_workers: Union[int, None] = None,
+                 fold_devices: Union[List[torch.device], None] = None):
+        """
+        Same as nnUNetPredictor but the folds are predicted concurrently by background workers, each holding the
+        weights of its folds. The fp16 logits of the folds are averaged in fold order, so the result is identical to
+        nnUNetPredictor.
+
+        fold_devices: one worker per device, folds are distributed round-robin. Use this for multiple GPUs.
+        num_fold_workers: number of workers on `device` if fold_devices is None. Default: one worker per fold. On CPU
+        the available cores are split evenly between the workers.
+        """
+        # the workers keep their folds resident. The main process never predicts itself
+        super().__init__(tile_step_size, use_gaussian, use_mirroring, perform_everything_on_device, device, verbose,
+                         verbose_preprocessing, allow_tqdm, keep_folds_resident=False, fuse_folds=False,
+                         tile_batch_size=tile_batch_size, batched_mirroring=batched_mirroring,
+                         mirror_axes_combinations=mirror_axes_combinations, tile_skip_threshold=tile_skip_threshold,
+                         max_tiles=max_tiles, target_latency=target_latency, refine_threshold=refine_threshold,
+                         cpu_precision=cpu_precision)
+        self.num_fold_workers = num_fold_workers
+        self.fold_devices = [torch.device(i) for i in fold_devices] if fold_devices is not None else None
+        self.fold_workers, self.fold_input_queues, self.fold_output_queue = None, None, None
+        self._case_id = 0
+
+    def initialize_from_exported_model(self, export_folder: str, use_folds: Union[Tuple[Union[int, str]], None],
+                                       backend: str):
+        """
+        Not supported: the workers rebuild the networks from the checkpoints (see fold_worker), exported networks cannot
+        be sent to them. Exported networks are always kept resident, use nnUNetPredictor for them.
+        """
+        raise ValueError(f'Exported backends ({backend}) cannot be combined with fold workers. Use nnUNetPredictor or '
+                         f'the torch backend.')
+
+    def start_fold_workers(self):
+        num_folds = len(self.list_of_parameters)
+        if self.fold_devices is not None:
+            devices = self.fold_devices[:num_folds]
+        else:
+            num_workers = num_folds if self.num_fold_workers is None else min(self.num_fold_workers, num_folds)
+            devices = [self.device] * num_workers
+        num_threads = max(1, os.cpu_count() // len(devices)) if all([d.type == 'cpu' for d in devices]) else 1
+
+        ctx = mp.get_context('spawn')
+        self.fold_output_queue = ctx.Queue()
+        self.fold_workers, self.fold_input_queues = [], []
+        for w, worker_device in enumerate(devices):
+            fold_indices = list(range(w, num_folds, len(devices)))
+            predictor_kwargs = {
+                'tile_step_size': self.tile_step_size,
+                'use_gaussian': self.use_gaussian,
+                'use_mirroring': self.use_mirroring,
+                'perform_everything_on_device': self.perform_everything_on_device,
+                'device': worker_device,
+                # the output of concurrent workers would be interleaved
+                'verbose': False,
+                'verbose_preprocessing': False,
+                'allow_tqdm': False,
+                'keep_folds_resident': True,
+                'tile_batch_size': self.tile_batch_size,
+                'batched_mirroring': self.batched_mirroring,
+                'mirror_axes_combinations': self.mirror_axes_combinations,
+                'tile_skip_threshold': self.tile_skip_threshold,
+                'max_tiles': self.max_tiles,
+                'target_latency': self.target_latency,
+                'refine_threshold': self.refine_threshold,
+                # int8 networks do not run under autocast
+                'cpu_precision': self.cpu_precision if self.int8_quantization is None else 'fp32',
+            }
+            parameters = [self.list_of_parameters[i] for i in fold_indices]
+            if self.int8_quantization is not None:
+                # quantized tensors do not survive torch's shared memory pickling, so they are sent serialized
+                parameters = [self._serialize_state_dict(i) for i in parameters]
+            input_queue = ctx.Queue()
+            p = ctx.Process(target=fold_worker,
+                            args=(predictor_kwargs, self.plans_manager, self.configuration_manager,
+                                  parameters, self.dataset_json,
+                                  self.trainer_name, self.allowed_mirroring_axes, self.int8_quantization,
+                                  fold_indices, num_threads,
+                                  input_queue, self.fold_output_queue),
+                            daemon=True)
+            p.start()
+            self.fold_workers.append(p)
+            self.fold_input_queues.append(input_queue)
+        if self.verbose:
+            print(f'started {len(devices)} fold workers on {[str(d) for d in devices]} with {num_threads} threads each')
+
+    @staticmethod
+    def _serialize_state_dict(state_dict: dict) -> bytes:
+        buffer = io.BytesIO()
+        torch.save(state_dict, buffer)
+        return buffer.getvalue()
+
+    def stop_fold_workers(self):
+        if self.fold_workers is None:
+            return
+        for q in self.fold_input_queues:
+            q.put(None)
+        for p in self.fold_workers:
+            p.join()
+        self.fold_workers, self.fold_input_queues, self.fold_output_queue = None, None, None
+
+    def _terminate_fold_workers(self):
+        # results of the failed case may still be queued, so we cannot reuse these workers
+        for p in self.fold_workers:
+            p.terminate()
+        self.fold_workers, self.fold_input_queues, self.fold_output_queue = None, None, None
+
+    def predict_logits_from_preprocessed_data(self, data: torch.Tensor, out: Union[torch.Tensor, None] = None) \
+            -> torch.Tensor:
+        """
+        See nnUNetPredictor.predict_logits_from_preprocessed_data
+        """
+        if self.fold_workers is None:
+            self.start_fold_workers()
+        # the main process only averages the logits on the CPU, the folds and their VRAM are measured by the workers
+        prediction_stats_start = self._internal_start_prediction_stats(measure_device=False)
+        self._case_id += 1
+        data.share_memory_()
+        for q in self.fold_input_queues:
+            q.put((self._case_id, data, get_telemetry_case()))
+
+        num_folds = len(self.list_of_parameters)
+        prediction = None
+        pending = {}
+        worker_memory_stats = []
+        next_fold = 0
+        while next_fold < num_folds:
+            try:
+                case_id, fold_index, result, memory_stats = self.fold_output_queue.get(timeout=1)
+            except Empty:
+                if not all([p.is_alive() for p in self.fold_workers]):
+                    self._terminate_fold_workers()
+                    raise RuntimeError('Some fold workers are no longer alive')
+                continue
+            if fold_index is None:
+                self._terminate_fold_workers()
+                raise RuntimeError(f'A fold worker failed with the following error:\n{result}')
+            assert case_id == self._case_id, 'Received a result from another case. This should not happen'
+            pending[fold_index] = result
+            worker_memory_stats.append(memory_stats)
+            # reduce in fold order so that we get exactly what the sequential prediction would give us
+            while next_fold in pending:
+                prediction = self._internal_accumulate_fold_logits(prediction, pending.pop(next_fold))
+                next_fold += 1
+
+        prediction = self._internal_finalize_fold_logits(prediction, num_folds, out)
+        self._internal_finish_prediction_stats(prediction_stats_start, num_folds, worker_memory_stats)
+        return prediction
@@ -0,0 +1,116 @@
+"""
+Exported (frozen) networks for nnUNetPredictor. export_network_graphs writes every fold (and optionally the fold
+average) as TorchScript and/or ONNX into an export folder that also holds plans.json, dataset.json and export.json, so
+that it can be deployed without the training checkpoints. nnUNetPredictor.initialize_from_exported_model then runs the
+sliding window through one of INFERENCE_BACKENDS instead of eager PyTorch.
+"""
+import inspect
+import shutil
+from typing import List, Union, Tuple
+
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, maybe_mkdir_p, save_json
+from torch import nn
+
+INFERENCE_BACKENDS = ('torch', 'torchscript', 'onnxruntime')
+EXPORT_FORMATS = {'torchscript': 'pt', 'onnxruntime': 'onnx'}
+
+
+def get_exported_network_name(fold: Union[int, str, None], backend: str) -> str:
+    """fold None is the fold average"""
+    name = 'fold_average' if fold is None else f'fold_{fold}'
+    return f'{name}.{EXPORT_FORMATS[backend]}'
+
+
+class FoldAverage(nn.Module):
+    """
+    Mean of the logits of several folds. Unlike FoldEnsemble this is a plain module, so it can be traced and exported.
+    """
+    def __init__(self, networks: List[nn.Module]):
+        super().__init__()
+        self.networks = nn.ModuleList(networks)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        prediction = self.networks[0](x)
+        for network in self.networks[1:]:
+            prediction = prediction + network(x)
+        return prediction / len(self.networks)
+
+
+class OnnxRuntimeNetwork(nn.Module):
+    """
+    Runs an exported ONNX network with onnxruntime. Inputs and outputs are torch tensors so that it can replace the
+    network in nnUNetPredictor. Only float32 inputs are supported.
+    """
+    def __init__(self, onnx_file: str, device: torch.device, num_threads: int = None):
+        super().__init__()
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('The onnxruntime backend requires onnxruntime (pip install onnxruntime, or '
+                              'onnxruntime-gpu for cuda devices)') from None
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session_options.intra_op_num_threads = num_threads if num_threads is not None else torch.get_num_threads()
+        providers = ['CPUExecutionProvider']
+        if device.type == 'cuda' and 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+            providers = [('CUDAExecutionProvider', {'device_id': device.index or 0})] + providers
+        self.session = onnxruntime.InferenceSession(onnx_file, session_options, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        output = self.session.run(None, {self.input_name: x.detach().float().cpu().numpy()})[0]
+        return torch.from_numpy(output).to(x.device)
+
+
+def load_exported_network(exported_file: str, backend: str, device: torch.device) -> nn.Module:
+    assert backend in EXPORT_FORMATS.keys(), f'Unknown backend {backend}. Exported backends: {list(EXPORT_FORMATS)}'
+    if backend == 'torchscript':
+        return torch.jit.load(exported_file, map_location=device).eval()
+    return OnnxRuntimeNetwork(exported_file, device)
+
+
+def export_network_graphs(networks: List[nn.Module], folds: List[Union[int, str]], output_folder: str,
+                          model_training_output_dir: str, patch_size: Union[Tuple[int, ...], List[int]],
+                          num_input_channels: int, metadata: dict, backends: Tuple[str, ...] = ('torchscript', 'onnxruntime'),
+                          export_fold_average: bool = False, opset_version: int = 17) -> None:
+    """
+    networks: one network (with the weights of its fold) per entry of folds, without deep supervision.
+    metadata: trainer_name, configuration and inference_allowed_mirroring_axes (see initialize_from_exported_model)
+    The batch axis of the exported graphs is dynamic, the spatial axes are fixed to patch_size.
+    """
+    if 'onnxruntime' in backends:
+        try:
+            import onnx
+        except ImportError:
+            raise ImportError('Exporting for onnxruntime requires onnx (pip install onnx onnxruntime)') from None
+    maybe_mkdir_p(output_folder)
+    example_input = torch.rand((1, num_input_channels, *patch_size))
+    to_export = [(f, n.cpu().eval()) for f, n in zip(folds, networks)]
+    if export_fold_average and len(networks) > 1:
+        to_export.append((None, FoldAverage([n for _, n in to_export]).eval()))
+
+    for fold, network in to_export:
+        if 'torchscript' in backends:
+            with torch.no_grad():
+                traced = torch.jit.trace(network, example_input)
+            traced = torch.jit.freeze(traced)
+            traced.save(join(output_folder, get_exported_network_name(fold, 'torchscript')))
+        if 'onnxruntime' in backends:
+            kwargs = {}
+            # newer torch versions default to the dynamo exporter, which needs onnxscript
+            if 'dynamo' in inspect.signature(torch.onnx.export).parameters.keys():
+                kwargs['dynamo'] = False
+            with torch.no_grad():
+                torch.onnx.export(network, example_input, join(output_folder, get_exported_network_name(fold, 'onnxruntime')),
+                                  input_names=['data'], output_names=['logits'],
+                                  dynamic_axes={'data': {0: 'batch'}, 'logits': {0: 'batch'}},
+                                  opset_version=opset_version, **kwargs)
+
+    for f in ('plans.json', 'dataset.json'):
+        shutil.copy(join(model_training_output_dir, f), join(output_folder, f))
+    save_json({**metadata, 'folds': list(folds), 'backends': list(backends),
+               'fold_average': export_fold_average and len(networks) > 1,
+               'patch_size': [int(i) for i in patch_size]},
+              join(output_folder, 'export.json'), sort_keys=False)
+
@@ -2,8 +2,9 @@ import inspect
 import itertools
 import multiprocessing
 import os
+import tempfile
 from copy import deepcopy
-from time import sleep
+from time import sleep, time, perf_counter
 from typing import Tuple, Union, List, Optional
 
 import numpy as np
@@ -22,15 +23,23 @@ from nnunetv2.configuration import default_num_processes
 from nnunetv2.inference.data_iterators import PreprocessAdapterFromNpy, preprocessing_iterator_fromfiles, \
     preprocessing_iterator_fromnpy
 from nnunetv2.inference.export_prediction import export_prediction_from_logits, \
-    convert_predicted_logits_to_segmentation_with_correct_shape
+    convert_predicted_logits_to_segmentation_with_correct_shape, initialize_export_worker, \
+    export_prediction_from_shared_logits, convert_shared_logits_to_segmentation_with_correct_shape
+from nnunetv2.inference.fold_ensemble import FoldEnsemble
+from nnunetv2.inference.inference_backends import INFERENCE_BACKENDS, get_exported_network_name, \
+    load_exported_network
+from nnunetv2.inference.quantization import build_int8_network
 from nnunetv2.inference.sliding_window_prediction import compute_gaussian, \
-    compute_steps_for_sliding_window
+    compute_steps_for_sliding_window, compute_step_sizes_for_tile_budget
 from nnunetv2.utilities.file_path_utilities import get_output_folder, check_workers_alive_and_busy
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
-from nnunetv2.utilities.helpers import empty_cache, dummy_context
+from nnunetv2.utilities.helpers import empty_cache, dummy_context, get_available_memory, cpu_supports_bf16, \
+    get_peak_rss, create_disk_backed_tensor, create_shared_memory_tensor, get_shared_memory_descriptor, \
+    release_shared_memory, release_finished_shared_memory
 from nnunetv2.utilities.json_export import recursive_fix_for_json_export
 from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.telemetry import span, record_span, telemetry_enabled, set_telemetry_case, synchronize_device
 from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
 
 
@@ -43,7 +52,60 @@ class nnUNetPredictor(object):
                  device: torch.device = torch.device('cuda'),
                  verbose: bool = False,
                  verbose_preprocessing: bool = False,
-                 allow_tqdm: bool = True):
+                 allow_tqdm: bool = True,
+                 keep_folds_resident: bool = False,
+                 fuse_folds: bool = False,
+                 tile_batch_size: Union[int, str] = 1,
+                 batched_mirroring: bool = False,
+                 mirror_axes_combinations: Optional[List[Tuple[int, ...]]] = None,
+                 tile_skip_threshold: Optional[float] = None,
+                 max_tiles: Optional[int] = None,
+                 target_latency: Optional[float] = None,
+                 refine_threshold: Optional[float] = None,
+                 cpu_precision: str = 'fp32',
+                 accumulate_folds_on_device: bool = False,
+                 max_memory: Optional[int] = None,
+                 memmap_dir: Optional[str] = None):
+        """
+        keep_folds_resident: build one network per fold once (on device) instead of calling load_state_dict for every
+        fold and case. Costs the memory of one network per fold.
+        fuse_folds: requires keep_folds_resident. Runs all folds on the same tile in a single forward pass (see
+        FoldEnsemble) and aggregates the sliding window only once.
+        tile_batch_size: number of sliding window tiles that are predicted in one forward pass. 'auto' picks the
+        largest batch size that fits into half of the free memory of the device (see
+        _internal_determine_tile_batch_size).
+        batched_mirroring: predict the original and all mirrored versions of a tile in one forward pass instead of one
+        pass per mirroring. Needs (number of mirrorings + 1) times the activation memory.
+        mirror_axes_combinations: subset of mirror axes combinations used for test time augmentation, for example
+        [(0,), (1,), (2,)] to only mirror along single axes. Axes are spatial (0 is the first spatial axis) and must be
+        allowed by the trained model. None uses all combinations of the allowed mirroring axes.
+        tile_skip_threshold: if not None, sliding window tiles whose foreground fraction is <= tile_skip_threshold are
+        not predicted. They get the prediction of an empty (all zero) tile instead, which is computed once. The
+        foreground is every voxel that is nonzero after preprocessing. This only works for models normalized with
+        use_mask_for_norm (background is 0 after normalization, like for skull-stripped inputs). With 0, only tiles
+        without any foreground are skipped and the result is the same as without skipping.
+        max_tiles: maximum number of sliding window tiles per image (and fold, unless fuse_folds). If the default
+        tile_step_size needs more tiles, the step size is increased per axis, starting with the axis with the most
+        steps (see compute_step_sizes_for_tile_budget).
+        target_latency: target time in seconds for predicting one case. It is converted into a tile budget with the
+        measured time per tile (see _internal_get_tile_budget). Can be combined with max_tiles (the smaller budget
+        wins).
+        refine_threshold: coarse-then-refine. The image is first predicted with the budgeted step size (step size 1
+        without budget). Then every tile of the default tile_step_size that was not predicted yet is predicted if the
+        fraction of its voxels where the mirrored predictions change the segmentation is > refine_threshold.
+        Refined tiles are not part of the tile budget. Requires mirroring.
+        cpu_precision: 'fp32', 'bf16' or 'auto'. With 'bf16' the network runs under bfloat16 autocast on CPU devices.
+        'auto' only does that if the CPU has native bfloat16 support (see cpu_supports_bf16). The logits are still
+        aggregated in fp16. Ignored on other devices (cuda always uses autocast).
+        accumulate_folds_on_device: sum the logits of the folds on device instead of on the CPU. Saves the transfer of
+        every fold, but needs one more logits array in VRAM while the next fold is predicted.
+        max_memory: memory budget in bytes for the logits. If the logits of a fold and the fold accumulator do not fit
+        into it together, they are kept in memory mapped fp16 files in memmap_dir (default: the system's temp
+        directory, see create_disk_backed_tensor) instead of RAM. The export then resamples and converts them to a
+        segmentation in slabs within the same budget (see convert_predicted_logits_to_segmentation_with_correct_shape)
+        and runs in the main process, because handing a memory mapped array to an export worker would pickle it.
+        Forces perform_everything_on_device=False.
+        """
         self.verbose = verbose
         self.verbose_preprocessing = verbose_preprocessing
         self.allow_tqdm = allow_tqdm
@@ -51,6 +113,63 @@ class nnUNetPredictor(object):
         self.plans_manager, self.configuration_manager, self.list_of_parameters, self.network, self.dataset_json, \
         self.trainer_name, self.allowed_mirroring_axes, self.label_manager = None, None, None, None, None, None, None, None
 
+        assert keep_folds_resident or not fuse_folds, 'fuse_folds requires keep_folds_resident'
+        self.keep_folds_resident = keep_folds_resident
+        self.fuse_folds = fuse_folds
+        self.fold_networks = None
+        # set by initialize_from_trained_model_folder if the checkpoints are int8 (see gouhfi_quantize)
+        self.int8_quantization = None
+        # set by initialize_from_exported_model
+        self.backend = 'torch'
+
+        assert tile_batch_size == 'auto' or (isinstance(tile_batch_size, int) and tile_batch_size > 0), \
+            f"tile_batch_size must be a positive int or 'auto', got {tile_batch_size}"
+        self.tile_batch_size = tile_batch_size
+        self._auto_tile_batch_size = None
+
+        self.batched_mirroring = batched_mirroring
+        self.mirror_axes_combinations = [tuple(i) for i in mirror_axes_combinations] \
+            if mirror_axes_combinations is not None else None
+
+        assert tile_skip_threshold is None or 0 <= tile_skip_threshold < 1, \
+            f'tile_skip_threshold must be in [0, 1), got {tile_skip_threshold}'
+        self.tile_skip_threshold = tile_skip_threshold
+
+        assert max_tiles is None or max_tiles > 0, f'max_tiles must be positive, got {max_tiles}'
+        assert target_latency is None or target_latency > 0, f'target_latency must be positive, got {target_latency}'
+        assert refine_threshold is None or 0 <= refine_threshold < 1, \
+            f'refine_threshold must be in [0, 1), got {refine_threshold}'
+        self.max_tiles = max_tiles
+        self.target_latency = target_latency
+        self.refine_threshold = refine_threshold
+        self._seconds_per_tile = None
+        # time spent in mirrored predictions during the current fold (telemetry, see _internal_predict_fold)
+        self._mirroring_seconds = 0.
+        self.sliding_window_stats = None
+        # utilization of the preprocessing workers and of the predictor of the last predict_from_files
+        self.preprocessing_stats = None
+        self.accumulate_folds_on_device = accumulate_folds_on_device
+        assert max_memory is None or max_memory > 0, f'max_memory must be positive, got {max_memory}'
+        assert max_memory is None or not accumulate_folds_on_device, \
+            'max_memory cannot be combined with accumulate_folds_on_device'
+        self.max_memory = max_memory
+        self.memmap_dir = memmap_dir
+        # peak memory of the last predict_logits_from_preprocessed_data call
+        self.memory_stats = None
+
+        assert cpu_precision in ('fp32', 'bf16', 'auto'), \
+            f"cpu_precision must be 'fp32', 'bf16' or 'auto', got {cpu_precision}"
+        self.cpu_precision = cpu_precision
+        if cpu_precision == 'auto':
+            self.use_cpu_bf16 = device.type == 'cpu' and cpu_supports_bf16()
+        else:
+            self.use_cpu_bf16 = device.type == 'cpu' and cpu_precision == 'bf16'
+            if self.use_cpu_bf16 and not cpu_supports_bf16():
+                print('WARNING: cpu_precision bf16 was requested but this CPU has no native bfloat16 support (AMX or '
+                      'AVX512-BF16). Inference will likely be slower than with fp32')
+        if device.type == 'cpu' and verbose:
+            print(f'cpu_precision {cpu_precision}: running the network in {"bf16" if self.use_cpu_bf16 else "fp32"}')
+
         self.tile_step_size = tile_step_size
         self.use_gaussian = use_gaussian
         self.use_mirroring = use_mirroring
@@ -59,6 +178,9 @@ class nnUNetPredictor(object):
         else:
             print(f'perform_everything_on_device=True is only supported for cuda devices! Setting this to False')
             perform_everything_on_device = False
+        if max_memory is not None and perform_everything_on_device:
+            print('max_memory keeps the logits on the CPU. Setting perform_everything_on_device to False')
+            perform_everything_on_device = False
         self.device = device
         self.perform_everything_on_device = perform_everything_on_device
 
@@ -66,7 +188,8 @@ class nnUNetPredictor(object):
                                              use_folds: Union[Tuple[Union[int, str]], None],
                                              checkpoint_name: str = 'checkpoint_final.pth'):
         """
-        This is used when making predictions with a trained model
+        This is used when making predictions with a trained model. int8 checkpoints (written by gouhfi_quantize, for
+        example checkpoint_best_int8.pth) are detected automatically. They only run on CPU.
         """
         if use_folds is None:
             use_folds = nnUNetPredictor.auto_detect_available_folds(model_training_output_dir, checkpoint_name)
@@ -88,6 +211,7 @@ class nnUNetPredictor(object):
                 configuration_name = checkpoint['init_args']['configuration']
                 inference_allowed_mirroring_axes = checkpoint['inference_allowed_mirroring_axes'] if \
                     'inference_allowed_mirroring_axes' in checkpoint.keys() else None
+                int8_quantization = checkpoint.get('int8_quantization')
 
             parameters.append(checkpoint['network_weights'])
 
@@ -105,6 +229,14 @@ class nnUNetPredictor(object):
             plans_manager.get_label_manager(dataset_json).num_segmentation_heads,
             enable_deep_supervision=False
         )
+        if int8_quantization is not None:
+            assert self.device.type == 'cpu', f'{checkpoint_name} is an int8 checkpoint, these only run on CPU'
+            network = build_int8_network(network, configuration_manager.patch_size, num_input_channels,
+                                         int8_quantization['backend'], int8_quantization['fp32_modules'])
+            if self.use_cpu_bf16:
+                print('cpu_precision is ignored for int8 checkpoints')
+                self.use_cpu_bf16 = False
+        self.int8_quantization = int8_quantization
 
         self.plans_manager = plans_manager
         self.configuration_manager = configuration_manager
@@ -115,9 +247,56 @@ class nnUNetPredictor(object):
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
         self.label_manager = plans_manager.get_label_manager(dataset_json)
         if ('nnUNet_compile' in os.environ.keys()) and (os.environ['nnUNet_compile'].lower() in ('true', '1', 't')) \
-                and not isinstance(self.network, OptimizedModule):
+                and not isinstance(self.network, OptimizedModule) and int8_quantization is None:
             print('Using torch.compile')
             self.network = torch.compile(self.network)
+        self._maybe_build_resident_fold_networks()
+
+    def initialize_from_exported_model(self, export_folder: str, use_folds: Union[Tuple[Union[int, str]], None],
+                                       backend: str):
+        """
+        Same as initialize_from_trained_model_folder, but for the networks written by export_network_graphs. backend
+        is 'torchscript' or 'onnxruntime'. Each fold is a separate exported network and they are always kept resident.
+        If fuse_folds, the exported fold average is used instead (use_folds is ignored).
+        """
+        assert backend in INFERENCE_BACKENDS and backend != 'torch', \
+            f'backend must be one of {[i for i in INFERENCE_BACKENDS if i != "torch"]}, got {backend}'
+        # the memory estimate of tile_batch_size 'auto' needs to look into the network (or the cuda allocator)
+        assert self.tile_batch_size != 'auto', 'tile_batch_size auto is not supported with exported networks'
+        export_info = load_json(join(export_folder, 'export.json'))
+        assert backend in export_info['backends'], f'{export_folder} has no {backend} export. ' \
+                                                   f'Available: {export_info["backends"]}'
+        dataset_json = load_json(join(export_folder, 'dataset.json'))
+        plans_manager = PlansManager(load_json(join(export_folder, 'plans.json')))
+        configuration_manager = plans_manager.get_configuration(export_info['configuration'])
+        assert list(configuration_manager.patch_size) == export_info['patch_size'], \
+            'The exported networks do not match the patch size of the plans'
+
+        if self.fuse_folds:
+            assert export_info['fold_average'], f'{export_folder} has no exported fold average'
+            exported_files = [get_exported_network_name(None, backend)]
+        else:
+            if use_folds is None:
+                use_folds = export_info['folds']
+            elif isinstance(use_folds, str):
+                use_folds = [use_folds]
+            use_folds = [int(f) if f != 'all' else f for f in use_folds]
+            missing_folds = [f for f in use_folds if f not in export_info['folds']]
+            assert len(missing_folds) == 0, f'Folds {missing_folds} were not exported to {export_folder}'
+            exported_files = [get_exported_network_name(f, backend) for f in use_folds]
+
+        self.plans_manager = plans_manager
+        self.configuration_manager = configuration_manager
+        self.list_of_parameters = None
+        self.fold_networks = [load_exported_network(join(export_folder, f), backend, self.device)
+                              for f in exported_files]
+        self.network = self.fold_networks[0]
+        self.dataset_json = dataset_json
+        self.trainer_name = export_info['trainer_name']
+        self.allowed_mirroring_axes = tuple(export_info['inference_allowed_mirroring_axes']) \
+            if export_info['inference_allowed_mirroring_axes'] is not None else None
+        self.label_manager = plans_manager.get_label_manager(dataset_json)
+        self.backend = backend
 
     def manual_initialization(self, network: nn.Module, plans_manager: PlansManager,
                               configuration_manager: ConfigurationManager, parameters: Optional[List[dict]],
@@ -143,6 +322,34 @@ class nnUNetPredictor(object):
         if allow_compile:
             print('Using torch.compile')
             self.network = torch.compile(self.network)
+        self._maybe_build_resident_fold_networks()
+
+    def _maybe_build_resident_fold_networks(self):
+        """
+        If keep_folds_resident, builds one network per entry of self.list_of_parameters (or a single FoldEnsemble if
+        fuse_folds) and moves it to the device. predict_logits_from_preprocessed_data then uses these networks
+        instead of loading the state dicts into self.network.
+        """
+        self.fold_networks = None
+        if not self.keep_folds_resident or self.list_of_parameters is None:
+            return
+        compiled = isinstance(self.network, OptimizedModule)
+        template = self.network._orig_mod if compiled else self.network
+        if isinstance(template, DistributedDataParallel):
+            template = template.module
+
+        assert not (self.fuse_folds and self.int8_quantization is not None), 'fuse_folds does not support int8 models'
+        fold_networks = []
+        for params in self.list_of_parameters:
+            network = deepcopy(template)
+            network.load_state_dict(params)
+            fold_networks.append(network.to(self.device).eval())
+
+        if self.fuse_folds and len(fold_networks) > 1:
+            fold_networks = [FoldEnsemble(fold_networks)]
+        if compiled:
+            fold_networks = [torch.compile(i) for i in fold_networks]
+        self.fold_networks = fold_networks
 
     @staticmethod
     def auto_detect_available_folds(model_training_output_dir, checkpoint_name):
@@ -260,10 +467,14 @@ class nnUNetPredictor(object):
                                                             seg_from_prev_stage_files: Union[List[str], None],
                                                             output_filenames_truncated: Union[List[str], None],
                                                             num_processes: int):
+        self.preprocessing_stats = {}
+        # without output files the results are returned, so they must come in the order of the input
         return preprocessing_iterator_fromfiles(input_list_of_lists, seg_from_prev_stage_files,
                                                 output_filenames_truncated, self.plans_manager, self.dataset_json,
                                                 self.configuration_manager, num_processes, self.device.type == 'cuda',
-                                                self.verbose_preprocessing)
+                                                self.verbose_preprocessing,
+                                                in_order=output_filenames_truncated is None,
+                                                stats=self.preprocessing_stats)
         # preprocessor = self.configuration_manager.preprocessor_class(verbose=self.verbose_preprocessing)
         # # hijack batchgenerators, yo
         # # we use the multiprocessing of the batchgenerators dataloader to handle all the background worker stuff. This
@@ -342,70 +553,92 @@ class nnUNetPredictor(object):
         """
         each element returned by data_iterator must be a dict with 'data', 'ofile' and 'data_properties' keys!
         If 'ofile' is None, the result will be returned instead of written to a file
+        The logits are handed to the export workers in shared memory and the workers get the plans, configuration
+        and dataset.json once when they start (initialize_export_worker), so nothing large is pickled per case.
         """
-        with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export) as export_pool:
+        with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export,
+                                                       initializer=initialize_export_worker,
+                                                       initargs=(self.plans_manager, self.configuration_manager,
+                                                                 self.dataset_json)) as export_pool:
             worker_list = [i for i in export_pool._pool]
             r = []
-            for preprocessed in data_iterator:
-                data = preprocessed['data']
-                if isinstance(data, str):
-                    delfile = data
-                    data = torch.from_numpy(np.load(data))
-                    os.remove(delfile)
-
-                ofile = preprocessed['ofile']
-                if ofile is not None:
-                    print(f'\nPredicting {os.path.basename(ofile)}:')
-                else:
-                    print(f'\nPredicting image of shape {data.shape}:')
-
-                print(f'perform_everything_on_device: {self.perform_everything_on_device}')
-
-                properties = preprocessed['data_properties']
-
-                # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
-                # npy files
-                proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-                while not proceed:
-                    sleep(0.1)
+            # results of the exports that ran in the main process (max_memory)
+            ret_main_process = []
+            # (export, shared memory with its logits). The memory is released once the export is done
+            shared_blocks = []
+            try:
+                for preprocessed in data_iterator:
+                    data = preprocessed['data']
+                    if isinstance(data, str):
+                        delfile = data
+                        data = torch.from_numpy(np.load(data))
+                        os.remove(delfile)
+
+                    ofile = preprocessed['ofile']
+                    set_telemetry_case(os.path.basename(ofile) if ofile is not None else None)
+                    if ofile is not None:
+                        print(f'\nPredicting {os.path.basename(ofile)}:')
+                    else:
+                        print(f'\nPredicting image of shape {data.shape}:')
+
+                    print(f'perform_everything_on_device: {self.perform_everything_on_device}')
+
+                    properties = preprocessed['data_properties']
+
+                    # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
+                    # npy files
                     proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-
-                prediction = self.predict_logits_from_preprocessed_data(data).cpu()
-
-                if ofile is not None:
-                    # this needs to go into background processes
-                    # export_prediction_from_logits(prediction, properties, self.configuration_manager, self.plans_manager,
-                    #                               self.dataset_json, ofile, save_probabilities)
-                    print('sending off prediction to background worker for resampling and export')
-                    r.append(
-                        export_pool.starmap_async(
-                            export_prediction_from_logits,
-                            ((prediction, properties, self.configuration_manager, self.plans_manager,
-                              self.dataset_json, ofile, save_probabilities),)
-                        )
-                    )
-                else:
-                    # convert_predicted_logits_to_segmentation_with_correct_shape(
-                    #             prediction, self.plans_manager,
-                    #              self.configuration_manager, self.label_manager,
-                    #              properties,
-                    #              save_probabilities)
-
-                    print('sending off prediction to background worker for resampling')
-                    r.append(
-                        export_pool.starmap_async(
-                            convert_predicted_logits_to_segmentation_with_correct_shape, (
-                                (prediction, self.plans_manager,
-                                 self.configuration_manager, self.label_manager,
-                                 properties,
-                                 save_probabilities),)
-                        )
-                    )
-                if ofile is not None:
-                    print(f'done with {os.path.basename(ofile)}')
-                else:
-                    print(f'\nDone with image of shape {data.shape}:')
-            ret = [i.get()[0] for i in r]
+                    while not proceed:
+                        sleep(0.1)
+                        proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
+                    shared_blocks = release_finished_shared_memory(shared_blocks)
+
+                    if self.max_memory is not None:
+                        prediction = self.predict_logits_from_preprocessed_data(data).cpu()
+                        # the logits may be memory mapped, sending them to a worker would pickle all of them
+                        print('resampling and exporting in the main process (max_memory)')
+                        if ofile is not None:
+                            export_prediction_from_logits(prediction, properties, self.configuration_manager,
+                                                          self.plans_manager, self.dataset_json, ofile,
+                                                          save_probabilities, self.max_memory)
+                            ret_main_process.append(None)
+                        else:
+                            ret_main_process.append(convert_predicted_logits_to_segmentation_with_correct_shape(
+                                prediction, self.plans_manager, self.configuration_manager, self.label_manager,
+                                properties, save_probabilities, max_memory=self.max_memory))
+                        del prediction
+                    else:
+                        block, prediction = create_shared_memory_tensor(
+                            (self.label_manager.num_segmentation_heads, *data.shape[1:]))
+                        self.predict_logits_from_preprocessed_data(data, out=prediction)
+                        shared_logits = get_shared_memory_descriptor(block, prediction)
+                        del prediction
+                        if ofile is not None:
+                            print('sending off prediction to background worker for resampling and export')
+                            r.append(
+                                export_pool.starmap_async(
+                                    export_prediction_from_shared_logits,
+                                    ((shared_logits, properties, ofile, save_probabilities),)
+                                )
+                            )
+                        else:
+                            print('sending off prediction to background worker for resampling')
+                            r.append(
+                                export_pool.starmap_async(
+                                    convert_shared_logits_to_segmentation_with_correct_shape,
+                                    ((shared_logits, properties, save_probabilities),)
+                                )
+                            )
+                        shared_blocks.append((r[-1], block))
+                    if ofile is not None:
+                        print(f'done with {os.path.basename(ofile)}')
+                    else:
+                        print(f'\nDone with image of shape {data.shape}:')
+                ret = [i.get()[0] for i in r] if self.max_memory is None else ret_main_process
+            finally:
+                set_telemetry_case(None)
+                for _, block in shared_blocks:
+                    release_shared_memory(block)
 
         if isinstance(data_iterator, MultiThreadedAugmenter):
             data_iterator._finish()
@@ -450,65 +683,164 @@ class nnUNetPredictor(object):
         if output_file_truncated is not None:
             export_prediction_from_logits(predicted_logits, dct['data_properties'], self.configuration_manager,
                                           self.plans_manager, self.dataset_json, output_file_truncated,
-                                          save_or_return_probabilities)
+                                          save_or_return_probabilities, self.max_memory)
         else:
             ret = convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits, self.plans_manager,
                                                                               self.configuration_manager,
                                                                               self.label_manager,
                                                                               dct['data_properties'],
                                                                               return_probabilities=
-                                                                              save_or_return_probabilities)
+                                                                              save_or_return_probabilities,
+                                                                              max_memory=self.max_memory)
             if save_or_return_probabilities:
                 return ret[0], ret[1]
             else:
                 return ret
 
-    def predict_logits_from_preprocessed_data(self, data: torch.Tensor) -> torch.Tensor:
+    def predict_logits_from_preprocessed_data(self, data: torch.Tensor, out: Optional[torch.Tensor] = None) \
+            -> torch.Tensor:
         """
         IMPORTANT! IF YOU ARE RUNNING THE CASCADE, THE SEGMENTATION FROM THE PREVIOUS STAGE MUST ALREADY BE STACKED ON
         TOP OF THE IMAGE AS ONE-HOT REPRESENTATION! SEE PreprocessAdapter ON HOW THIS SHOULD BE DONE!
 
         RETURNED LOGITS HAVE THE SHAPE OF THE INPUT. THEY MUST BE CONVERTED BACK TO THE ORIGINAL IMAGE SIZE.
         SEE convert_predicted_logits_to_segmentation_with_correct_shape
+
+        out: optional zero-initialized fp16 CPU tensor of shape (num_segmentation_heads, *data.shape[1:]) that receives
+        the logits and is returned, for example in shared memory (see predict_from_data_iterator). If possible, the
+        first fold accumulates into it directly, so that the logits are never copied.
         """
         n_threads = torch.get_num_threads()
         torch.set_num_threads(default_num_processes if default_num_processes < n_threads else n_threads)
+        prediction_stats_start = self._internal_start_prediction_stats()
         prediction = None
+        num_predictions = len(self.fold_networks) if self.fold_networks is not None else len(self.list_of_parameters)
+        network = self.network
 
-        for params in self.list_of_parameters:
+        for i in range(num_predictions):
 
+            if self.fold_networks is not None:
+                # resident networks already hold the weights of their fold
+                self.network = self.fold_networks[i]
             # messing with state dict names...
-            if not isinstance(self.network, OptimizedModule):
-                self.network.load_state_dict(params)
+            elif not isinstance(self.network, OptimizedModule):
+                self.network.load_state_dict(self.list_of_parameters[i])
             else:
-                self.network._orig_mod.load_state_dict(params)
+                self.network._orig_mod.load_state_dict(self.list_of_parameters[i])
 
             # why not leave prediction on device if perform_everything_on_device? Because this may cause the
             # second iteration to crash due to OOM. Grabbing that with try except cause way more bloated code than
-            # this actually saves computation time
-
-            """ OG code from nnunet_v2, manually modified on 27/06/25 to avoid crashing when running on CPU
-            if prediction is None:
-                prediction = self.predict_sliding_window_return_logits(data).to('cpu')
-            else:
-                prediction += self.predict_sliding_window_return_logits(data).to('cpu')
-            """
-            # New code to avoid crashing on CPU from 27/06/25
-            if prediction is None:
-                prediction = self.predict_sliding_window_return_logits(data).to('cpu')
-            else:
-                prediction = prediction.clone()
-                prediction += self.predict_sliding_window_return_logits(data).to('cpu')
-
+            # this actually saves computation time. accumulate_folds_on_device lets the user take that risk
+            prediction = self._internal_accumulate_fold_logits(
+                prediction, self._internal_predict_fold(data, i, out if i == 0 else None))
+        self.network = network
 
-        if len(self.list_of_parameters) > 1:
-            prediction /= len(self.list_of_parameters)
+        prediction = self._internal_finalize_fold_logits(prediction, num_predictions, out)
 
-        if self.verbose: print('Prediction done')
+        self._internal_finish_prediction_stats(prediction_stats_start, num_predictions)
         torch.set_num_threads(n_threads)
         return prediction
 
-    def _internal_get_sliding_window_slicers(self, image_size: Tuple[int, ...]):
+    def _internal_start_prediction_stats(self, measure_device: bool = True) -> tuple:
+        """
+        Starts timing a prediction and measuring its peak memory, see _internal_finish_prediction_stats.
+        measure_device: reset the peak memory statistics of self.device (cuda only)
+        """
+        peak_rss_before = get_peak_rss()
+        device = self.device if measure_device and self.device.type == 'cuda' else None
+        if device is not None:
+            torch.cuda.reset_peak_memory_stats(device)
+        return time(), perf_counter(), peak_rss_before, device
+
+    def _internal_finish_prediction_stats(self, prediction_stats_start: tuple, num_folds: int,
+                                          worker_memory_stats: Optional[List[dict]] = None) -> None:
+        """
+        Sets self.memory_stats and records the prediction span of the case (all folds, with the memory of the case, see
+        run_gouhfi_speed_benchmark).
+        worker_memory_stats: memory_stats (same keys) of other processes that predicted folds of the case, see
+        fold_parallel. The largest values of this process and the workers are reported.
+        """
+        start, start_counter, peak_rss_before, device = prediction_stats_start
+        memory_stats = {
+            'peak_rss': get_peak_rss(),
+            'peak_rss_increase': max(0, get_peak_rss() - peak_rss_before),
+            'peak_device_memory': torch.cuda.max_memory_allocated(device) if device is not None else None
+        }
+        for stats in worker_memory_stats or []:
+            for k, v in stats.items():
+                if v is not None:
+                    memory_stats[k] = v if memory_stats[k] is None else max(memory_stats[k], v)
+        self.memory_stats = memory_stats
+        record_span('prediction', start, perf_counter() - start_counter, num_folds=num_folds, **self.memory_stats)
+        if self.verbose:
+            print('Prediction done')
+            print(f'peak RAM {self.memory_stats["peak_rss"] / 1e9:.2f} GB '
+                  f'(+{self.memory_stats["peak_rss_increase"] / 1e9:.2f} GB during prediction)' +
+                  (f', peak VRAM {self.memory_stats["peak_device_memory"] / 1e9:.2f} GB'
+                   if self.memory_stats['peak_device_memory'] is not None else ''))
+
+    def _internal_predict_fold(self, data: torch.Tensor, fold_index: int, out: Optional[torch.Tensor] = None) \
+            -> torch.Tensor:
+        """
+        predict_sliding_window_return_logits with the network of the fold at fold_index (already set) and telemetry:
+        one span for the sliding window and one for the mirrored predictions within it (their total duration)
+        """
+        self._mirroring_seconds = 0.
+        start = time()
+        with span('sliding_window', self.device, fold=fold_index):
+            prediction = self.predict_sliding_window_return_logits(data, out)
+        if self._mirroring_seconds > 0:
+            record_span('mirroring', start, self._mirroring_seconds, fold=fold_index)
+        return prediction
+
+    @torch.inference_mode()
+    def _internal_accumulate_fold_logits(self, accumulator: Optional[torch.Tensor], fold_logits: torch.Tensor,
+                                         slab_size: int = 16) -> torch.Tensor:
+        """
+        Adds the (fp16) logits of one fold to accumulator in place and returns it. The logits of the first fold become
+        the accumulator, on the CPU or, if accumulate_folds_on_device, on self.device. Logits on another device are
+        copied in slabs of slab_size slices along the first spatial axis, so the transfer never holds a second
+        full-size array.
+        This needs to run in inference mode: predict_sliding_window_return_logits returns inference tensors, which
+        cannot be updated in place outside of it (that is what crashed the CPU prediction before we cloned the
+        accumulator for every fold).
+        """
+        accumulation_device = self.device if self.accumulate_folds_on_device else torch.device('cpu')
+        if accumulator is None:
+            return fold_logits.to(accumulation_device)
+        if fold_logits.device == accumulator.device:
+            accumulator += fold_logits
+        else:
+            for s in range(0, accumulator.shape[1], slab_size):
+                accumulator[:, s:s + slab_size] += fold_logits[:, s:s + slab_size].to(accumulator.device)
+        return accumulator
+
+    def _internal_use_disk_backed_logits(self, logits_shape: Tuple[int, ...]) -> bool:
+        """
+        True if max_memory is set and the fp16 logits of a fold and the fold accumulator do not fit into it together
+        """
+        if self.max_memory is None:
+            return False
+        num_arrays = 2 if (self.fold_networks is not None and len(self.fold_networks) > 1) or \
+            (self.fold_networks is None and len(self.list_of_parameters) > 1) else 1
+        return num_arrays * int(np.prod(logits_shape)) * 2 > self.max_memory
+
+    @torch.inference_mode()
+    def _internal_finalize_fold_logits(self, accumulator: torch.Tensor, num_folds: int,
+                                       out: Optional[torch.Tensor] = None) -> torch.Tensor:
+        if num_folds > 1:
+            accumulator /= num_folds
+        if out is None:
+            return accumulator.to('cpu')
+        # nothing to do if the folds were accumulated in out
+        if accumulator.data_ptr() != out.data_ptr():
+            out.copy_(accumulator)
+        return out
+
+    def _internal_get_sliding_window_slicers(self, image_size: Tuple[int, ...],
+                                             tile_step_size: Union[float, List[float], None] = None):
+        if tile_step_size is None:
+            tile_step_size = self.tile_step_size
         slicers = []
         if len(self.configuration_manager.patch_size) < len(image_size):
             assert len(self.configuration_manager.patch_size) == len(
@@ -518,10 +850,10 @@ class nnUNetPredictor(object):
                                  '(only dimension ' \
                                  'discrepancy of 1 allowed).'
             steps = compute_steps_for_sliding_window(image_size[1:], self.configuration_manager.patch_size,
-                                                     self.tile_step_size)
+                                                     tile_step_size)
             if self.verbose: print(f'n_steps {image_size[0] * len(steps[0]) * len(steps[1])}, image size is'
                                    f' {image_size}, tile_size {self.configuration_manager.patch_size}, '
-                                   f'tile_step_size {self.tile_step_size}\nsteps:\n{steps}')
+                                   f'tile_step_size {tile_step_size}\nsteps:\n{steps}')
             for d in range(image_size[0]):
                 for sx in steps[0]:
                     for sy in steps[1]:
@@ -530,10 +862,10 @@ class nnUNetPredictor(object):
                                                      zip((sx, sy), self.configuration_manager.patch_size)]]))
         else:
             steps = compute_steps_for_sliding_window(image_size, self.configuration_manager.patch_size,
-                                                     self.tile_step_size)
+                                                     tile_step_size)
             if self.verbose: print(
                 f'n_steps {np.prod([len(i) for i in steps])}, image size is {image_size}, tile_size {self.configuration_manager.patch_size}, '
-                f'tile_step_size {self.tile_step_size}\nsteps:\n{steps}')
+                f'tile_step_size {tile_step_size}\nsteps:\n{steps}')
             for sx in steps[0]:
                 for sy in steps[1]:
                     for sz in steps[2]:
@@ -542,30 +874,219 @@ class nnUNetPredictor(object):
                                                   zip((sx, sy, sz), self.configuration_manager.patch_size)]]))
         return slicers
 
-    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor) -> torch.Tensor:
+    def _internal_get_mirror_axes_combinations(self, ndim: int) -> List[Tuple[int, ...]]:
+        """
+        Returns the mirror axes combinations used for test time augmentation as axes of a (b, c, x, y(, z)) tensor
+        with ndim dimensions. Empty if mirroring is disabled.
+        """
         mirror_axes = self.allowed_mirroring_axes if self.use_mirroring else None
-        prediction = self.network(x)
+        if mirror_axes is None:
+            return []
+        # check for invalid numbers in mirror_axes
+        # x should be 5d for 3d images and 4d for 2d. so the max value of mirror_axes cannot exceed len(x.shape) - 3
+        assert max(mirror_axes) <= ndim - 3, 'mirror_axes does not match the dimension of the input!'
 
-        if mirror_axes is not None:
-            # check for invalid numbers in mirror_axes
-            # x should be 5d for 3d images and 4d for 2d. so the max value of mirror_axes cannot exceed len(x.shape) - 3
-            assert max(mirror_axes) <= x.ndim - 3, 'mirror_axes does not match the dimension of the input!'
-
-            mirror_axes = [m + 2 for m in mirror_axes]
+        if self.mirror_axes_combinations is None:
             axes_combinations = [
                 c for i in range(len(mirror_axes)) for c in itertools.combinations(mirror_axes, i + 1)
             ]
+        else:
+            axes_combinations = self.mirror_axes_combinations
+            assert all([all([a in mirror_axes for a in c]) for c in axes_combinations]), \
+                f'mirror_axes_combinations {axes_combinations} contains axes that are not allowed for this model. ' \
+                f'Allowed mirroring axes: {mirror_axes}'
+        return [tuple(m + 2 for m in c) for c in axes_combinations if len(c) > 0]
+
+    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor, return_disagreement: bool = False) \
+            -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        return_disagreement: additionally return a (b, x, y(, z)) bool tensor that is True where the segmentation of
+        the unmirrored prediction differs from the segmentation of the averaged prediction
+        """
+        axes_combinations = self._internal_get_mirror_axes_combinations(x.ndim)
+
+        if self.batched_mirroring and len(axes_combinations) > 0:
+            # original and mirrored versions are stacked along the batch axis and predicted in one forward pass
+            b = x.shape[0]
+            predictions = self.network(torch.cat([x] + [torch.flip(x, axes) for axes in axes_combinations]))
+            prediction = predictions[:b]
+            unmirrored = prediction.clone() if return_disagreement else None
+            for i, axes in enumerate(axes_combinations):
+                prediction += torch.flip(predictions[(i + 1) * b:(i + 2) * b], axes)
+        else:
+            prediction = self.network(x)
+            unmirrored = prediction.clone() if return_disagreement else None
+            # the mirrored predictions are timed as a whole by _internal_predict_fold. The batched ones cannot be
+            # told apart from the unmirrored prediction
+            timed = telemetry_enabled() and len(axes_combinations) > 0
+            if timed:
+                synchronize_device(self.device)
+                start = perf_counter()
             for axes in axes_combinations:
                 prediction += torch.flip(self.network(torch.flip(x, axes)), axes)
+            if timed:
+                synchronize_device(self.device)
+                self._mirroring_seconds += perf_counter() - start
+        if len(axes_combinations) > 0:
             prediction /= (len(axes_combinations) + 1)
-        return prediction
+        if not return_disagreement:
+            return prediction
+        if self.label_manager.has_regions:
+            disagreement = torch.any((unmirrored > 0) != (prediction > 0), dim=1)
+        else:
+            disagreement = unmirrored.argmax(1) != prediction.argmax(1)
+        return prediction, disagreement
+
+    def _internal_get_tile_budget(self, data: torch.Tensor) -> Optional[int]:
+        """
+        Number of tiles allowed per sliding window (None if unlimited). target_latency is split evenly between the
+        sliding windows of one case (one per fold unless folds are fused). The time per tile is first estimated with a
+        zero tile (after a warm-up pass). This ignores the aggregation overhead, so predict_sliding_window_return_logits
+        replaces it with the time per tile it measured.
+        """
+        budgets = [] if self.max_tiles is None else [self.max_tiles]
+        if self.target_latency is not None:
+            if self._seconds_per_tile is None:
+                probe = torch.zeros((1, data.shape[0], *self.configuration_manager.patch_size), dtype=data.dtype,
+                                    device=self.device)
+                self._internal_maybe_mirror_and_predict(probe)
+                if self.device.type == 'cuda':
+                    torch.cuda.synchronize(self.device)
+                start = time()
+                self._internal_maybe_mirror_and_predict(probe)
+                if self.device.type == 'cuda':
+                    torch.cuda.synchronize(self.device)
+                self._seconds_per_tile = time() - start
+            num_sliding_windows = len(self.fold_networks) if self.fold_networks is not None else \
+                len(self.list_of_parameters)
+            budgets.append(max(1, int(self.target_latency / num_sliding_windows / self._seconds_per_tile)))
+            if self.verbose:
+                print(f'target_latency {self.target_latency}s: {self._seconds_per_tile:.3f}s per tile, '
+                      f'{num_sliding_windows} sliding window(s) per case -> {budgets[-1]} tiles')
+        return min(budgets) if len(budgets) > 0 else None
+
+    def _internal_get_coarse_tile_step_size(self, image_size: Tuple[int, ...], tile_budget: Optional[int]) \
+            -> Optional[List[float]]:
+        """
+        Per-axis step sizes of the first sliding window pass, or None if the default tile_step_size is used
+        """
+        patch_size = self.configuration_manager.patch_size
+        if len(patch_size) < len(image_size):
+            # 2d models predict every slice with its own sliding window
+            if tile_budget is not None:
+                tile_budget = max(1, tile_budget // image_size[0])
+            image_size = image_size[1:]
+        if tile_budget is not None:
+            tile_step_size = compute_step_sizes_for_tile_budget(image_size, patch_size, self.tile_step_size,
+                                                                tile_budget)
+            if tile_step_size != [self.tile_step_size] * len(patch_size):
+                return tile_step_size
+        # the default tiles fit into the budget. Without refinement there is nothing to do
+        return [1.] * len(patch_size) if self.refine_threshold is not None else None
+
+    def _internal_determine_tile_batch_size(self, data: torch.Tensor, num_tiles: int,
+                                            max_tile_batch_size: int = 32) -> int:
+        """
+        Estimates the memory needed to predict one tile and returns how many tiles fit into half of the free memory of
+        the device. On cuda the peak memory of a probe forward pass is measured. On CPU we sum the size of the outputs
+        of all network modules, which is an upper bound for inference. The result is cached.
+        """
+        if self._auto_tile_batch_size is None:
+            probe = torch.zeros((1, data.shape[0], *self.configuration_manager.patch_size), dtype=data.dtype,
+                                device=self.device)
+            if self.device.type == 'cuda':
+                torch.cuda.synchronize(self.device)
+                torch.cuda.reset_peak_memory_stats(self.device)
+                baseline = torch.cuda.memory_allocated(self.device)
+                self._internal_maybe_mirror_and_predict(probe)
+                memory_per_tile = torch.cuda.max_memory_allocated(self.device) - baseline
+            else:
+                network = self.network._orig_mod if isinstance(self.network, OptimizedModule) else self.network
+                num_networks = 1
+                if isinstance(network, FoldEnsemble):
+                    # the hooks see the outputs of a single fold
+                    network, num_networks = network.template_network, network.num_folds
+                output_sizes = []
+                hooks = [m.register_forward_hook(lambda m, i, o: output_sizes.append(o.numel() * o.element_size())
+                                                 if isinstance(o, torch.Tensor) else None)
+                         for m in network.modules()]
+                try:
+                    self.network(probe)
+                finally:
+                    for h in hooks:
+                        h.remove()
+                memory_per_tile = sum(output_sizes) * num_networks
+                if self.batched_mirroring:
+                    memory_per_tile *= len(self._internal_get_mirror_axes_combinations(probe.ndim)) + 1
+            available_memory = get_available_memory(self.device)
+            self._auto_tile_batch_size = max(1, min(max_tile_batch_size,
+                                                    int(available_memory * 0.5 // max(memory_per_tile, 1))))
+            if self.verbose:
+                print(f'tile_batch_size auto: {memory_per_tile / 1e6:.1f} MB per tile, '
+                      f'{available_memory / 1e6:.1f} MB available -> {self._auto_tile_batch_size}')
+        return min(self._auto_tile_batch_size, num_tiles)
+
+    def _internal_split_empty_tiles(self, data: torch.Tensor, slicers: List[tuple],
+                                    intensity_threshold: float = 1e-4) -> Tuple[List[tuple], List[tuple]]:
+        """
+        Splits slicers into the tiles that need to be predicted and the tiles whose foreground fraction is <=
+        self.tile_skip_threshold. Voxels are foreground if any channel is nonzero. We use a small intensity_threshold
+        instead of 0 because resampling can leave tiny values in the background.
+        """
+        foreground = torch.any(torch.abs(data) > intensity_threshold, dim=0)
+        predict, skip = [], []
+        for sl in slicers:
+            tile_foreground = foreground[sl[1:]]
+            if torch.count_nonzero(tile_foreground).item() <= self.tile_skip_threshold * tile_foreground.numel():
+                skip.append(sl)
+            else:
+                predict.append(sl)
+        return predict, skip
+
+    def _internal_predict_tiles(self, data: torch.Tensor, slicers: List[tuple], predicted_logits: torch.Tensor,
+                                n_predictions: torch.Tensor, gaussian: Union[torch.Tensor, int], tile_batch_size: int,
+                                results_device: torch.device, disagreement: Optional[torch.Tensor] = None):
+        """
+        Predicts the tiles in slicers and adds their (gaussian weighted) logits to predicted_logits and n_predictions.
+        If disagreement is given, the mirroring disagreement of every tile (see _internal_maybe_mirror_and_predict) is
+        or-ed into it.
+        """
+        with tqdm(total=len(slicers), disable=not self.allow_tqdm) as pbar:
+            for b in range(0, len(slicers), tile_batch_size):
+                batch_slicers = slicers[b:b + tile_batch_size]
+                if len(batch_slicers) == 1:
+                    workon = data[batch_slicers[0]][None]
+                else:
+                    workon = torch.stack([data[sl] for sl in batch_slicers])
+                workon = workon.to(self.device)
+
+                if disagreement is None:
+                    prediction = self._internal_maybe_mirror_and_predict(workon).to(results_device)
+                else:
+                    prediction, tile_disagreement = self._internal_maybe_mirror_and_predict(workon, True)
+                    prediction = prediction.to(results_device)
+                    for sl, d in zip(batch_slicers, tile_disagreement.to(results_device)):
+                        disagreement[sl[1:]] |= d
+
+                for sl, p in zip(batch_slicers, prediction):
+                    if self.use_gaussian:
+                        p *= gaussian
+                    predicted_logits[sl] += p
+                    n_predictions[sl[1:]] += gaussian
+                pbar.update(len(batch_slicers))
 
     def _internal_predict_sliding_window_return_logits(self,
                                                        data: torch.Tensor,
                                                        slicers,
                                                        do_on_device: bool = True,
-                                                       ):
-        predicted_logits = n_predictions = prediction = gaussian = workon = None
+                                                       refine_slicers: Optional[List[tuple]] = None,
+                                                       out: Optional[torch.Tensor] = None):
+        """
+        refine_slicers: candidate tiles for the refinement pass (see refine_threshold in __init__)
+        out: zero-initialized CPU tensor that is used as the logits array if the results are on the CPU and it has the
+        right shape (see predict_logits_from_preprocessed_data)
+        """
+        predicted_logits = n_predictions = prediction = gaussian = workon = disagreement = None
         results_device = self.device if do_on_device else torch.device('cpu')
 
         try:
@@ -579,9 +1100,17 @@ class nnUNetPredictor(object):
             # preallocate arrays
             if self.verbose:
                 print(f'preallocating results arrays on device {results_device}')
-            predicted_logits = torch.zeros((self.label_manager.num_segmentation_heads, *data.shape[1:]),
-                                           dtype=torch.half,
-                                           device=results_device)
+            logits_shape = (self.label_manager.num_segmentation_heads, *data.shape[1:])
+            disk_backed = self._internal_use_disk_backed_logits(logits_shape) and results_device.type == 'cpu'
+            if out is not None and results_device.type == 'cpu' and tuple(out.shape) == logits_shape:
+                predicted_logits = out
+            elif disk_backed:
+                if self.verbose:
+                    print(f'logits do not fit into max_memory, memory mapping them in '
+                          f'{self.memmap_dir or tempfile.gettempdir()}')
+                predicted_logits = create_disk_backed_tensor(logits_shape, np.float16, self.memmap_dir)
+            else:
+                predicted_logits = torch.zeros(logits_shape, dtype=torch.half, device=results_device)
             n_predictions = torch.zeros(data.shape[1:], dtype=torch.half, device=results_device)
 
             if self.use_gaussian:
@@ -591,35 +1120,71 @@ class nnUNetPredictor(object):
             else:
                 gaussian = 1
 
-            if not self.allow_tqdm and self.verbose:
-                print(f'running prediction: {len(slicers)} steps')
-            for sl in tqdm(slicers, disable=not self.allow_tqdm):
-                workon = data[sl][None]
-                workon = workon.to(self.device)
-
-                prediction = self._internal_maybe_mirror_and_predict(workon)[0].to(results_device)
-
-                if self.use_gaussian:
-                    prediction *= gaussian
-                predicted_logits[sl] += prediction
-                n_predictions[sl[1:]] += gaussian
+            if self.tile_skip_threshold is not None:
+                slicers, skipped_slicers = self._internal_split_empty_tiles(data, slicers)
+                print(f'skipping {len(skipped_slicers)} out of {len(slicers) + len(skipped_slicers)} tiles with '
+                      f'foreground fraction <= {self.tile_skip_threshold}')
+                if len(skipped_slicers) > 0:
+                    # all skipped tiles get the prediction of an empty tile
+                    workon = torch.zeros((1, data.shape[0], *self.configuration_manager.patch_size),
+                                         dtype=data.dtype, device=self.device)
+                    prediction = self._internal_maybe_mirror_and_predict(workon)[0].to(results_device)
+                    if self.use_gaussian:
+                        prediction *= gaussian
+                    for sl in skipped_slicers:
+                        predicted_logits[sl] += prediction
+                        n_predictions[sl[1:]] += gaussian
+
+            tile_batch_size = self.tile_batch_size if self.tile_batch_size != 'auto' else \
+                self._internal_determine_tile_batch_size(data, max(len(slicers), 1))
+
+            if refine_slicers is not None:
+                disagreement = torch.zeros(data.shape[1:], dtype=torch.bool, device=results_device)
 
-            predicted_logits /= n_predictions
+            if not self.allow_tqdm and self.verbose:
+                print(f'running prediction: {len(slicers)} steps, {tile_batch_size} tiles per forward pass')
+            self._internal_predict_tiles(data, slicers, predicted_logits, n_predictions, gaussian, tile_batch_size,
+                                         results_device, disagreement)
+
+            if refine_slicers is not None:
+                refine_slicers = [sl for sl in refine_slicers
+                                  if torch.count_nonzero(disagreement[sl[1:]]).item() >
+                                  self.refine_threshold * disagreement[sl[1:]].numel()]
+                disagreement = None
+                if self.verbose:
+                    print(f'refining {len(refine_slicers)} tiles')
+                if len(refine_slicers) > 0:
+                    self._internal_predict_tiles(data, refine_slicers, predicted_logits, n_predictions, gaussian,
+                                                 tile_batch_size, results_device)
+                self.sliding_window_stats['num_refined_tiles'] = len(refine_slicers)
+
+            if disk_backed:
+                # slab by slab so that only the pages of one slab are needed at a time
+                found_inf = False
+                for s in range(0, predicted_logits.shape[1], 16):
+                    predicted_logits[:, s:s + 16] /= n_predictions[s:s + 16]
+                    found_inf = found_inf or torch.any(torch.isinf(predicted_logits[:, s:s + 16])).item()
+            else:
+                predicted_logits /= n_predictions
+                found_inf = torch.any(torch.isinf(predicted_logits))
             # check for infs
-            if torch.any(torch.isinf(predicted_logits)):
+            if found_inf:
                 raise RuntimeError('Encountered inf in predicted array. Aborting... If this problem persists, '
                                    'reduce value_scaling_factor in compute_gaussian or increase the dtype of '
                                    'predicted_logits to fp32')
         except Exception as e:
-            del predicted_logits, n_predictions, prediction, gaussian, workon
+            del predicted_logits, n_predictions, prediction, gaussian, workon, disagreement
             empty_cache(self.device)
             empty_cache(results_device)
             raise e
         return predicted_logits
 
     @torch.inference_mode()
-    def predict_sliding_window_return_logits(self, input_image: torch.Tensor) \
+    def predict_sliding_window_return_logits(self, input_image: torch.Tensor, out: Optional[torch.Tensor] = None) \
             -> Union[np.ndarray, torch.Tensor]:
+        """
+        out: see _internal_predict_sliding_window_return_logits
+        """
         assert isinstance(input_image, torch.Tensor)
         self.network = self.network.to(self.device)
         self.network.eval()
@@ -631,14 +1196,21 @@ class nnUNetPredictor(object):
         # and needs to be disabled.
         # If the device_type is 'mps' then it will complain that mps is not implemented, even if enabled=False
         # is set. Whyyyyyyy. (this is why we don't make use of enabled=False)
-        # So autocast will only be active if we have a cuda device.
-        with torch.autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
+        # So autocast will only be active if we have a cuda device, or if bf16 was requested for the CPU (use_cpu_bf16).
+        if self.device.type == 'cuda':
+            autocast_context = torch.autocast(self.device.type, enabled=True)
+        elif self.use_cpu_bf16:
+            autocast_context = torch.autocast('cpu', dtype=torch.bfloat16)
+        else:
+            autocast_context = dummy_context()
+        with autocast_context:
             assert input_image.ndim == 4, 'input_image must be a 4D np.ndarray or torch.Tensor (c, x, y, z)'
 
             if self.verbose: 
                 print(f'Input shape: {input_image.shape}')
                 print("step_size:", self.tile_step_size)
                 print("mirror_axes:", self.allowed_mirroring_axes if self.use_mirroring else None)
+                print("mirror_axes_combinations:", self.mirror_axes_combinations if self.use_mirroring else None)
 
             # if input_image is smaller than tile_size we need to pad it to tile_size.
             data, slicer_revert_padding = pad_nd_image(input_image, self.configuration_manager.patch_size,
@@ -646,20 +1218,54 @@ class nnUNetPredictor(object):
                                                        None)
 
             slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
-
+            refine_slicers = None
+            coarse_tile_step_size = self._internal_get_coarse_tile_step_size(data.shape[1:],
+                                                                             self._internal_get_tile_budget(data))
+            self.sliding_window_stats = {'tile_step_size': coarse_tile_step_size or self.tile_step_size,
+                                         'num_tiles': len(slicers), 'num_default_tiles': len(slicers),
+                                         'num_refined_tiles': 0}
+            if coarse_tile_step_size is not None:
+                default_slicers = slicers
+                slicers = self._internal_get_sliding_window_slicers(data.shape[1:], coarse_tile_step_size)
+                self.sliding_window_stats['num_tiles'] = len(slicers)
+                if self.refine_threshold is not None:
+                    if len(self._internal_get_mirror_axes_combinations(data.ndim + 1)) == 0:
+                        print('WARNING: refine_threshold requires mirroring to detect uncertain tiles. Skipping '
+                              'refinement')
+                    else:
+                        # slice objects are not hashable
+                        predicted_starts = {tuple(i.start if isinstance(i, slice) else i for i in sl) for sl in slicers}
+                        refine_slicers = [sl for sl in default_slicers if
+                                          tuple(i.start if isinstance(i, slice) else i for i in sl)
+                                          not in predicted_starts]
+                print(f'predicting {len(slicers)} tiles instead of {len(default_slicers)} with tile_step_size '
+                      f'{[round(i, 3) for i in coarse_tile_step_size]}')
+
+            start = time()
             if self.perform_everything_on_device and self.device != 'cpu':
                 # we need to try except here because we can run OOM in which case we need to fall back to CPU as a results device
                 try:
                     predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers,
-                                                                                           self.perform_everything_on_device)
+                                                                                           self.perform_everything_on_device,
+                                                                                           refine_slicers, out)
                 except RuntimeError:
                     print(
                         'Prediction on device was unsuccessful, probably due to a lack of memory. Moving results arrays to CPU')
                     empty_cache(self.device)
-                    predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers, False)
+                    predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers, False,
+                                                                                           refine_slicers, out)
             else:
                 predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers,
-                                                                                       self.perform_everything_on_device)
+                                                                                       self.perform_everything_on_device,
+                                                                                       refine_slicers, out)
+            if refine_slicers is not None:
+                print(f'refined {self.sliding_window_stats["num_refined_tiles"]} out of {len(refine_slicers)} '
+                      f'remaining tiles (refine_threshold {self.refine_threshold})')
+            if self.target_latency is not None:
+                if self.device.type == 'cuda':
+                    torch.cuda.synchronize(self.device)
+                self._seconds_per_tile = (time() - start) / \
+                    (self.sliding_window_stats['num_tiles'] + self.sliding_window_stats['num_refined_tiles'])
 
             empty_cache(self.device)
             # revert padding
@@ -824,6 +1430,67 @@ def predict_entry_point():
     parser.add_argument('--disable_progress_bar', action='store_true', required=False, default=False,
                         help='Set this flag to disable progress bar. Recommended for HPC environments (non interactive '
                              'jobs)')
+    parser.add_argument('--resident_folds', action='store_true', required=False, default=False,
+                        help='Set this flag to build one network per fold once instead of loading the weights of '
+                             'every fold for every case. Faster, but needs the memory of one network per fold.')
+    parser.add_argument('--fuse_folds', action='store_true', required=False, default=False,
+                        help='Requires --resident_folds. Set this flag to run all folds on the same tile in a single '
+                             'forward pass.')
+    parser.add_argument('--batched_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to predict the original and all mirrored versions of a patch in a single '
+                             'forward pass. Faster, but needs more memory.')
+    parser.add_argument('-tta_subset', nargs='+', type=str, required=False, default=None,
+                        help='Mirror axes combinations used for test time augmentation, each given as comma-separated '
+                             'spatial axes. Example: -tta_subset 0 1 2 only mirrors along single axes (3 instead of 7 '
+                             'additional predictions for 3d). Default: all combinations of the allowed axes')
+    parser.add_argument('-tile_skip_threshold', type=float, required=False, default=None,
+                        help='Skip sliding window tiles whose foreground (nonzero voxels after preprocessing) fraction '
+                             'is <= this value. They get the prediction of an empty tile. Only for skull-stripped '
+                             'inputs and models normalized with use_mask_for_norm. 0 only skips tiles without any '
+                             'foreground. Default: None (all tiles are predicted)')
+    parser.add_argument('-tile_batch_size', type=str, required=False, default='1',
+                        help="Number of sliding window tiles predicted in one forward pass, or 'auto' to derive it "
+                             "from the free memory of the device. Default: 1")
+    parser.add_argument('-fold_workers', type=int, required=False, default=0,
+                        help='Number of background workers that predict the folds concurrently, each holding the '
+                             'weights of its folds. The CPU cores are split between the workers. Default: 0 (folds '
+                             'are predicted one after the other)')
+    parser.add_argument('-fold_devices', nargs='+', type=str, required=False, default=None,
+                        help='Predict the folds concurrently with one worker per device, for example -fold_devices '
+                             'cuda:0 cuda:1. Folds are distributed round-robin.')
+    parser.add_argument('-max_tiles', type=int, required=False, default=None,
+                        help='Maximum number of sliding window tiles per case and fold. The step size is increased '
+                             'per axis until the tiles fit. Default: None (no limit)')
+    parser.add_argument('-target_latency', type=float, required=False, default=None,
+                        help='Target time in seconds for predicting one case. Converted into a tile budget using the '
+                             'measured time per tile. Default: None (no limit)')
+    parser.add_argument('-refine_threshold', type=float, required=False, default=None,
+                        help='Coarse-then-refine: predict with a coarse step size first (the budgeted one, 1 '
+                             'otherwise), then also predict the tiles of -step_size whose fraction of voxels where '
+                             'mirroring changes the segmentation is > this value. Requires test time augmentation. '
+                             'Default: None (no refinement)')
+    parser.add_argument('-cpu_precision', type=str, required=False, default='fp32', choices=['fp32', 'bf16', 'auto'],
+                        help='Precision of the network on CPU (-device cpu). bf16 uses bfloat16 autocast, auto only '
+                             'does that if the CPU supports bfloat16 natively (AMX or AVX512-BF16). Default: fp32')
+    parser.add_argument('--accumulate_folds_on_device', action='store_true', required=False, default=False,
+                        help='Set this flag to sum the logits of the folds on the GPU instead of on the CPU. Saves '
+                             'the transfer of every fold but needs more VRAM. Not used with fold workers.')
+    parser.add_argument('-backend', type=str, required=False, default='torch', choices=INFERENCE_BACKENDS,
+                        help='Runtime of the network. torchscript and onnxruntime run the networks exported with '
+                             'export_network_graphs (see run_gouhfi_export) instead of the checkpoints. The folds are '
+                             'then always kept resident and --fuse_folds uses the exported fold average. '
+                             'Default: torch')
+    parser.add_argument('-export_dir', type=str, required=False, default=None,
+                        help='Folder with the exported networks, for -backend torchscript or onnxruntime. Default: '
+                             'the exported subfolder of the model folder')
+    parser.add_argument('-max_memory', type=float, required=False, default=None,
+                        help='Memory budget in GB for the logits. Larger logits are kept in memory mapped files '
+                             '(see -memmap_dir) and resampled and exported in slabs in the main process. Use this for '
+                             'images whose logits do not fit into RAM. Not supported with fold workers. Default: None '
+                             '(no limit)')
+    parser.add_argument('-memmap_dir', type=str, required=False, default=None,
+                        help='Folder for the memory mapped logits of -max_memory. Should be on a fast local disk. '
+                             'Default: the system\'s temp directory')
 
     print(
         "\n#######################################################################\nPlease cite the following paper "
@@ -834,6 +1501,17 @@ def predict_entry_point():
 
     args = parser.parse_args()
     args.f = [i if i == 'all' else int(i) for i in args.f]
+    assert args.resident_folds or not args.fuse_folds or args.backend != 'torch', \
+        '--fuse_folds requires --resident_folds'
+    assert args.backend == 'torch' or (args.fold_workers == 0 and args.fold_devices is None), \
+        '-fold_workers and -fold_devices require -backend torch'
+    assert args.max_memory is None or (args.fold_workers == 0 and args.fold_devices is None), \
+        '-max_memory cannot be combined with -fold_workers or -fold_devices'
+    assert args.max_memory is None or not args.accumulate_folds_on_device, \
+        '-max_memory cannot be combined with --accumulate_folds_on_device'
+    args.tile_batch_size = args.tile_batch_size if args.tile_batch_size == 'auto' else int(args.tile_batch_size)
+    if args.tta_subset is not None:
+        args.tta_subset = [tuple(int(a) for a in c.split(',')) for c in args.tta_subset]
 
     model_folder = get_output_folder(args.d, args.tr, args.p, args.c)
 
@@ -858,19 +1536,60 @@ def predict_entry_point():
     else:
         device = torch.device('mps')
 
-    predictor = nnUNetPredictor(tile_step_size=args.step_size,
-                                use_gaussian=True,
-                                use_mirroring=not args.disable_tta,
-                                perform_everything_on_device=True,
-                                device=device,
-                                verbose=args.verbose,
-                                verbose_preprocessing=args.verbose,
-                                allow_tqdm=not args.disable_progress_bar)
-    predictor.initialize_from_trained_model_folder(
-        model_folder,
-        args.f,
-        checkpoint_name=args.chk
-    )
+    if args.fold_workers > 0 or args.fold_devices is not None:
+        from nnunetv2.inference.fold_parallel import nnUNetFoldParallelPredictor
+        predictor = nnUNetFoldParallelPredictor(tile_step_size=args.step_size,
+                                                use_gaussian=True,
+                                                use_mirroring=not args.disable_tta,
+                                                perform_everything_on_device=True,
+                                                device=device,
+                                                verbose=args.verbose,
+                                                verbose_preprocessing=args.verbose,
+                                                allow_tqdm=not args.disable_progress_bar,
+                                                tile_batch_size=args.tile_batch_size,
+                                                batched_mirroring=args.batched_tta,
+                                                mirror_axes_combinations=args.tta_subset,
+                                                tile_skip_threshold=args.tile_skip_threshold,
+                                                max_tiles=args.max_tiles,
+                                                target_latency=args.target_latency,
+                                                refine_threshold=args.refine_threshold,
+                                                cpu_precision=args.cpu_precision,
+                                                num_fold_workers=args.fold_workers if args.fold_workers > 0 else None,
+                                                fold_devices=args.fold_devices)
+    else:
+        predictor = nnUNetPredictor(tile_step_size=args.step_size,
+                                    use_gaussian=True,
+                                    use_mirroring=not args.disable_tta,
+                                    perform_everything_on_device=True,
+                                    device=device,
+                                    verbose=args.verbose,
+                                    verbose_preprocessing=args.verbose,
+                                    allow_tqdm=not args.disable_progress_bar,
+                                    keep_folds_resident=args.resident_folds or args.backend != 'torch',
+                                    fuse_folds=args.fuse_folds,
+                                    tile_batch_size=args.tile_batch_size,
+                                    batched_mirroring=args.batched_tta,
+                                    mirror_axes_combinations=args.tta_subset,
+                                    tile_skip_threshold=args.tile_skip_threshold,
+                                    max_tiles=args.max_tiles,
+                                    target_latency=args.target_latency,
+                                    refine_threshold=args.refine_threshold,
+                                    cpu_precision=args.cpu_precision,
+                                    accumulate_folds_on_device=args.accumulate_folds_on_device,
+                                    max_memory=int(args.max_memory * 1e9) if args.max_memory is not None else None,
+                                    memmap_dir=args.memmap_dir)
+    if args.backend == 'torch':
+        predictor.initialize_from_trained_model_folder(
+            model_folder,
+            args.f,
+            checkpoint_name=args.chk
+        )
+    else:
+        predictor.initialize_from_exported_model(
+            args.export_dir if args.export_dir is not None else join(model_folder, 'exported'),
+            args.f,
+            args.backend
+        )
     predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
                                  overwrite=not args.continue_prediction,
                                  num_processes_preprocessing=args.npp,
@@ -0,0 +1,66 @@
+from copy import deepcopy
+from typing import List, Tuple, Union, Iterable
+
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping, QConfigMapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+
+def get_int8_checkpoint_name(checkpoint_name: str) -> str:
+    """checkpoint_best.pth -> checkpoint_best_int8.pth"""
+    assert checkpoint_name.endswith('.pth'), f'Expected a .pth checkpoint, got {checkpoint_name}'
+    return checkpoint_name[:-len('.pth')] + '_int8.pth'
+
+
+def get_int8_qconfig_mapping(backend: str = 'x86', fp32_modules: Iterable[str] = ()) -> QConfigMapping:
+    """
+    Static int8 quantization (weights and activations) for backend. The modules in fp32_modules (qualified names as
+    in network.named_modules(), for example 'decoder.seg_layers') and their children are not quantized.
+    """
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    for name in fp32_modules:
+        qconfig_mapping.set_module_name(name, None)
+    return qconfig_mapping
+
+
+def prepare_network_for_int8(network: nn.Module, example_input: torch.Tensor, backend: str = 'x86',
+                             fp32_modules: Iterable[str] = ()) -> nn.Module:
+    """
+    Returns a copy of network with observers that record the activation ranges of everything that is passed through it
+    (calibration). The network must not use deep supervision.
+    """
+    assert backend in torch.backends.quantized.supported_engines, \
+        f'Quantization backend {backend} is not supported by this torch build. ' \
+        f'Supported: {torch.backends.quantized.supported_engines}'
+    torch.backends.quantized.engine = backend
+    network = deepcopy(network).cpu().eval()
+    for m in network.modules():
+        # quantized leaky_relu cannot run inplace
+        if isinstance(m, (nn.LeakyReLU, nn.ReLU)):
+            m.inplace = False
+    return prepare_fx(network, get_int8_qconfig_mapping(backend, fp32_modules), (example_input.cpu(),))
+
+
+@torch.inference_mode()
+def calibrate_int8(prepared_network: nn.Module, tiles: Iterable[torch.Tensor]) -> None:
+    for tile in tiles:
+        prepared_network(tile.cpu())
+
+
+def convert_to_int8(prepared_network: nn.Module) -> nn.Module:
+    return convert_fx(prepared_network).eval()
+
+
+def build_int8_network(network: nn.Module, patch_size: Union[Tuple[int, ...], List[int]], num_input_channels: int,
+                       backend: str = 'x86', fp32_modules: Iterable[str] = ()) -> nn.Module:
+    """
+    Builds the int8 architecture of network without calibrating it. It only becomes useful once the state dict of a
+    calibrated network (network_weights of an int8 checkpoint, see gouhfi_quantize) is loaded into it, which also
+    restores the quantization parameters.
+    """
+    example_input = torch.zeros((1, num_input_channels, *patch_size))
+    prepared_network = prepare_network_for_int8(network, example_input, backend, fp32_modules)
+    # without calibration the observers would complain about their empty ranges
+    calibrate_int8(prepared_network, [example_input])
+    return convert_to_int8(prepared_network)
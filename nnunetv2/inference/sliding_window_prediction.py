@@ -27,14 +27,19 @@ def compute_gaussian(tile_size: Union[Tuple[int, ...], List[int]], sigma_scale:
     return gaussian_importance_map
 
 
-def compute_steps_for_sliding_window(image_size: Tuple[int, ...], tile_size: Tuple[int, ...], tile_step_size: float) -> \
-        List[List[int]]:
+def compute_steps_for_sliding_window(image_size: Tuple[int, ...], tile_size: Tuple[int, ...],
+                                     tile_step_size: Union[float, Tuple[float, ...], List[float]]) -> List[List[int]]:
+    """
+    tile_step_size can be given per axis
+    """
     assert [i >= j for i, j in zip(image_size, tile_size)], "image size must be as large or larger than patch_size"
-    assert 0 < tile_step_size <= 1, 'step_size must be larger than 0 and smaller or equal to 1'
+    if not isinstance(tile_step_size, (tuple, list)):
+        tile_step_size = [tile_step_size] * len(tile_size)
+    assert all([0 < i <= 1 for i in tile_step_size]), 'step_size must be larger than 0 and smaller or equal to 1'
 
     # our step width is patch_size*step_size at most, but can be narrower. For example if we have image size of
     # 110, patch size of 64 and step_size of 0.5, then we want to make 3 steps starting at coordinate 0, 23, 46
-    target_step_sizes_in_voxels = [i * tile_step_size for i in tile_size]
+    target_step_sizes_in_voxels = [i * j for i, j in zip(tile_size, tile_step_size)]
 
     num_steps = [int(np.ceil((i - k) / j)) + 1 for i, j, k in zip(image_size, target_step_sizes_in_voxels, tile_size)]
 
@@ -54,6 +59,30 @@ def compute_steps_for_sliding_window(image_size: Tuple[int, ...], tile_size: Tup
     return steps
 
 
+def compute_step_sizes_for_tile_budget(image_size: Tuple[int, ...], tile_size: Tuple[int, ...],
+                                       tile_step_size: Union[float, Tuple[float, ...], List[float]],
+                                       max_num_tiles: int) -> List[float]:
+    """
+    Returns per-axis step sizes (>= tile_step_size) so that the sliding window over image_size has at most
+    max_num_tiles tiles. The number of steps along the axis with the most steps is reduced first. The result can
+    exceed max_num_tiles if even non-overlapping tiles do not fit into the budget.
+    """
+    if not isinstance(tile_step_size, (tuple, list)):
+        tile_step_size = [tile_step_size] * len(tile_size)
+    default_num_steps = [len(i) for i in compute_steps_for_sliding_window(image_size, tile_size, tile_step_size)]
+    num_steps = list(default_num_steps)
+    min_num_steps = [int(np.ceil(i / j)) for i, j in zip(image_size, tile_size)]
+    while np.prod(num_steps) > max_num_tiles:
+        reducible = [d for d in range(len(num_steps)) if num_steps[d] > min_num_steps[d]]
+        if len(reducible) == 0:
+            break
+        num_steps[max(reducible, key=lambda d: num_steps[d])] -= 1
+    # the step size that yields exactly num_steps in compute_steps_for_sliding_window. Make it a tiny bit larger so
+    # that rounding does not give us one step more
+    return [s if n == d else (min(1., (i - j) / (n - 1) / j * (1 + 1e-6)) if n > 1 else 1.)
+            for i, j, n, d, s in zip(image_size, tile_size, num_steps, default_num_steps, tile_step_size)]
+
+
 if __name__ == '__main__':
     a = torch.rand((4, 2, 32, 23))
     a_npy = a.numpy()
@@ -4,6 +4,7 @@ import shutil
 from multiprocessing import Pool
 from typing import Union, Tuple, List, Callable
 
+import cc3d
 import numpy as np
 from acvl_utils.morphology.morphology_helper import remove_all_but_largest_component
 from batchgenerators.utilities.file_and_folder_operations import load_json, subfiles, maybe_mkdir_p, join, isfile, \
@@ -17,6 +18,7 @@ from nnunetv2.paths import nnUNet_raw
 from nnunetv2.utilities.file_path_utilities import folds_tuple_to_string
 from nnunetv2.utilities.json_export import recursive_fix_for_json_export
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+from nnunetv2.utilities.telemetry import span, telemetry_case, case_from_file
 
 
 def remove_all_but_largest_component_from_segmentation(segmentation: np.ndarray,
@@ -34,9 +36,84 @@ def remove_all_but_largest_component_from_segmentation(segmentation: np.ndarray,
     return ret
 
 
-def apply_postprocessing(segmentation: np.ndarray, pp_fns: List[Callable], pp_fn_kwargs: List[dict]):
+def remove_all_but_largest_component_per_label(segmentation: np.ndarray, labels: List[int],
+                                               background_label: int = 0) -> np.ndarray:
+    """
+    Same as remove_all_but_largest_component_from_segmentation(segmentation, label, background_label) for every label
+    in labels, but the connected components of all labels are computed in a single pass over the label map (cc3d
+    labels every value at once with union-find) instead of one full-volume pass per label. The smaller components are
+    then removed within their bounding boxes. Like skimage's default, components are fully connected (26-connectivity
+    in 3D) and all components of the largest size are kept.
+    labels must be nonzero and must not include background_label.
+    """
+    assert all([l != 0 and l != background_label for l in labels]), 'labels must not be 0 or background_label'
+    if segmentation.ndim not in (2, 3):
+        # cc3d only supports 2D and 3D
+        for label in labels:
+            segmentation = remove_all_but_largest_component_from_segmentation(segmentation, label, background_label)
+        return segmentation
+    ret = np.copy(segmentation)  # do not modify the input!
+    if not np.issubdtype(ret.dtype, np.integer):
+        # label maps are often read as float
+        seg_int = ret.astype(np.int32)
+    else:
+        seg_int = ret
+    components, num_components = cc3d.connected_components(seg_int, connectivity=26 if ret.ndim == 3 else 8,
+                                                           return_N=True)
+    if num_components == 0:
+        return ret
+    stats = cc3d.statistics(components)
+    sizes = stats['voxel_counts'].astype(np.int64)
+    label_of_component = np.zeros(num_components + 1, dtype=seg_int.dtype)
+    label_of_component[components.ravel()] = seg_int.ravel()
+
+    to_remove = []
+    for label in np.unique(labels):
+        ids = np.flatnonzero(label_of_component == label)
+        # component 0 is the background of cc3d, it can never hold a label != 0
+        ids = ids[ids > 0]
+        if len(ids) > 1:
+            to_remove.extend(ids[sizes[ids] != sizes[ids].max()])
+    if len(to_remove) > 64:
+        remove = np.zeros(num_components + 1, dtype=bool)
+        remove[to_remove] = True
+        ret[remove[components]] = background_label
+    else:
+        for i in to_remove:
+            bbox = stats['bounding_boxes'][i]
+            ret[bbox][components[bbox] == i] = background_label
+    return ret
+
+
+def fuse_postprocessing_steps(pp_fns: List[Callable], pp_fn_kwargs: List[dict]) -> List[Tuple[Callable, dict]]:
+    """
+    Every run of consecutive remove_all_but_largest_component_from_segmentation steps on single labels (as written by
+    determine_postprocessing for every label) is replaced by one remove_all_but_largest_component_per_label step.
+    Removing the components of one label only turns its voxels into background, so the steps do not interact (unless
+    the background label is one of the labels, these steps are left alone) and the label map stays the same.
+    Other steps (whole foreground, regions, other functions) are kept in their place.
+    """
+    steps = []
     for fn, kwargs in zip(pp_fns, pp_fn_kwargs):
-        segmentation = fn(segmentation, **kwargs)
+        label = kwargs.get('labels_or_regions')
+        background_label = kwargs.get('background_label', 0)
+        if fn is not remove_all_but_largest_component_from_segmentation or not np.isscalar(label) or label == 0 or \
+                label == background_label:
+            steps.append((fn, kwargs))
+            continue
+        if len(steps) > 0 and steps[-1][0] is remove_all_but_largest_component_per_label and \
+                steps[-1][1]['background_label'] == background_label:
+            steps[-1][1]['labels'].append(label)
+        else:
+            steps.append((remove_all_but_largest_component_per_label,
+                          {'labels': [label], 'background_label': background_label}))
+    return steps
+
+
+def apply_postprocessing(segmentation: np.ndarray, pp_fns: List[Callable], pp_fn_kwargs: List[dict]):
+    with span('postprocessing'):
+        for fn, kwargs in fuse_postprocessing_steps(pp_fns, pp_fn_kwargs):
+            segmentation = fn(segmentation, **kwargs)
     return segmentation
 
 
@@ -45,9 +122,12 @@ def load_postprocess_save(segmentation_file: str,
                           image_reader_writer: BaseReaderWriter,
                           pp_fns: List[Callable],
                           pp_fn_kwargs: List[dict]):
-    seg, props = image_reader_writer.read_seg(segmentation_file)
-    seg = apply_postprocessing(seg[0], pp_fns, pp_fn_kwargs)
-    image_reader_writer.write_seg(seg, output_fname, props)
+    with telemetry_case(case_from_file(segmentation_file)):
+        with span('read'):
+            seg, props = image_reader_writer.read_seg(segmentation_file)
+        seg = apply_postprocessing(seg[0], pp_fns, pp_fn_kwargs)
+        with span('write'):
+            image_reader_writer.write_seg(seg, output_fname, props)
 
 
 def determine_postprocessing(folder_predictions: str,
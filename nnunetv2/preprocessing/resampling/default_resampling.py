@@ -4,6 +4,7 @@ from typing import Union, Tuple, List
 import numpy as np
 import pandas as pd
 import torch
+import torch.nn.functional as F
 from batchgenerators.augmentations.utils import resize_segmentation
 from scipy.ndimage.interpolation import map_coordinates
 from skimage.transform import resize
@@ -87,6 +88,23 @@ def resample_data_or_seg_to_shape(data: Union[torch.Tensor, np.ndarray],
     """
     if isinstance(data, torch.Tensor):
         data = data.cpu().numpy()
+    do_separate_z, axis = get_separate_z_for_shape_resampling(current_spacing, new_spacing, force_separate_z,
+                                                              separate_z_anisotropy_threshold)
+
+    if data is not None:
+        assert data.ndim == 4, "data must be c x y z"
+
+    data_reshaped = resample_data_or_seg(data, new_shape, is_seg, axis, order, do_separate_z, order_z=order_z)
+    return data_reshaped
+
+
+def get_separate_z_for_shape_resampling(current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                        new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                        force_separate_z: Union[bool, None] = False,
+                                        separate_z_anisotropy_threshold: float = ANISO_THRESHOLD):
+    """
+    returns do_separate_z and the low resolution axis (or None) as used by resample_data_or_seg_to_shape
+    """
     if force_separate_z is not None:
         do_separate_z = force_separate_z
         if force_separate_z:
@@ -114,12 +132,105 @@ def resample_data_or_seg_to_shape(data: Union[torch.Tensor, np.ndarray],
             do_separate_z = False
         else:
             pass
+    return do_separate_z, axis
 
-    if data is not None:
-        assert data.ndim == 4, "data must be c x y z"
 
-    data_reshaped = resample_data_or_seg(data, new_shape, is_seg, axis, order, do_separate_z, order_z=order_z)
-    return data_reshaped
+def can_resample_data_to_shape_in_slabs(current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                        new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                        force_separate_z: Union[bool, None] = False,
+                                        separate_z_anisotropy_threshold: float = ANISO_THRESHOLD,
+                                        order: int = 3, order_z: int = 0, require_exact: bool = False,
+                                        **kwargs) -> bool:
+    """
+    resample_data_to_shape_in_slab splits the first axis, so separate z resampling only works if that is the low
+    resolution axis. require_exact: also require that the result is identical to resample_data_or_seg_to_shape up to
+    rounding (no spline of order > 1 along the first axis). kwargs are ignored so that the resampling kwargs of the plans can be
+    passed as they are
+    """
+    do_separate_z, axis = get_separate_z_for_shape_resampling(current_spacing, new_spacing, force_separate_z,
+                                                              separate_z_anisotropy_threshold)
+    if do_separate_z and not (len(axis) == 1 and axis[0] == 0):
+        return False
+    return not require_exact or (order_z if do_separate_z else order) <= 1
+
+
+def resample_data_to_shape_in_slab(data: Union[torch.Tensor, np.ndarray],
+                                   new_shape: Union[Tuple[int, ...], List[int], np.ndarray],
+                                   current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                   new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                   output_slice: slice,
+                                   is_seg: bool = False,
+                                   order: int = 3, order_z: int = 0,
+                                   force_separate_z: Union[bool, None] = False,
+                                   separate_z_anisotropy_threshold: float = ANISO_THRESHOLD,
+                                   spline_halo: int = 8) -> np.ndarray:
+    """
+    Returns resample_data_or_seg_to_shape(data, new_shape, ...)[:, output_slice], where output_slice is a slab along
+    the first spatial axis, but only reads the rows of data that this slab depends on. data can therefore be a memory
+    mapped array that does not fit into RAM. Only for data, not segmentations (is_seg must be False).
+    The result is identical (up to float64 rounding for order 1, see below) unless a spline of order > 1 is applied
+    along the first axis (order without separate z, order_z with it). Its prefilter runs over the whole image, which is
+    approximated with spline_halo extra rows on either side of the slab, and values are not clipped to the range of
+    the whole image. See
+    can_resample_data_to_shape_in_slabs for which separate z configurations are supported.
+    """
+    assert not is_seg, 'resample_data_to_shape_in_slab does not support segmentations'
+    assert data.ndim == 4, "data must be (c, x, y, z)"
+    if isinstance(data, torch.Tensor):
+        data = data.cpu().numpy()
+    shape = np.array(data.shape[1:])
+    new_shape = np.array(new_shape)
+    start, stop, _ = output_slice.indices(new_shape[0])
+    if np.all(shape == new_shape):
+        return np.array(data[:, start:stop])
+
+    do_separate_z, axis = get_separate_z_for_shape_resampling(current_spacing, new_spacing, force_separate_z,
+                                                              separate_z_anisotropy_threshold)
+    assert not do_separate_z or (len(axis) == 1 and axis[0] == 0), \
+        'separate z resampling in slabs requires the first axis to be the low resolution axis'
+    # same coordinate mapping as skimage's resize and the separate z code in resample_data_or_seg
+    row_coordinates = float(shape[0]) / new_shape[0] * (np.arange(start, stop) + 0.5) - 0.5
+    halo = 1 + (spline_halo if (order_z if do_separate_z else order) > 1 else 0)
+    first_row = max(0, int(np.floor(row_coordinates.min())) - halo + 1)
+    last_row = min(shape[0], int(np.floor(row_coordinates.max())) + halo + 1)
+    # converted to float64 one channel at a time
+    rows = data[:, first_row:last_row]
+    row_coordinates = row_coordinates - first_row
+
+    reshaped = np.zeros((data.shape[0], stop - start, *new_shape[1:]), dtype=data.dtype)
+    if do_separate_z:
+        kwargs = {'mode': 'edge', 'anti_aliasing': False}
+        for c in range(rows.shape[0]):
+            rows_c = rows[c].astype(float)
+            reshaped_data = np.stack([resize(rows_c[slice_id], new_shape[1:], order, **kwargs)
+                                      for slice_id in range(rows.shape[1])])
+            if shape[0] != new_shape[0]:
+                coord_map = np.array(np.meshgrid(row_coordinates, np.arange(new_shape[1]), np.arange(new_shape[2]),
+                                                 indexing='ij'), dtype=float)
+                reshaped[c] = map_coordinates(reshaped_data, coord_map, order=order_z, mode='nearest')
+            else:
+                reshaped[c] = reshaped_data[int(row_coordinates[0]):int(row_coordinates[0]) + stop - start]
+    elif order == 1:
+        # trilinear is separable: linear along the first axis, then bilinear in-plane with torch, which is several
+        # times faster than map_coordinates. Identical up to float64 rounding, which can change a value by one step
+        # of its dtype (fp16 logits)
+        row_coordinates = np.clip(row_coordinates, 0, rows.shape[1] - 1)
+        lower = np.floor(row_coordinates).astype(int)
+        upper = np.minimum(lower + 1, rows.shape[1] - 1)
+        weights = torch.from_numpy(row_coordinates - lower)[:, None, None]
+        for c in range(rows.shape[0]):
+            rows_c = torch.from_numpy(rows[c].astype(float))
+            interpolated = rows_c[lower] * (1 - weights) + rows_c[upper] * weights
+            reshaped[c] = F.interpolate(interpolated[:, None], size=tuple(new_shape[1:]), mode='bilinear',
+                                        align_corners=False)[:, 0].numpy()
+    else:
+        coord_map = np.array(np.meshgrid(row_coordinates,
+                                         *[float(i) / j * (np.arange(j) + 0.5) - 0.5 for i, j in
+                                           zip(shape[1:], new_shape[1:])],
+                                         indexing='ij'))
+        for c in range(rows.shape[0]):
+            reshaped[c] = map_coordinates(rows[c].astype(float), coord_map, order=order, mode='nearest')
+    return reshaped
 
 
 def resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[float, ...], List[float], np.ndarray],
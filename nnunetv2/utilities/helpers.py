@@ -1,3 +1,12 @@
+import os
+import sys
+import tempfile
+from functools import lru_cache
+from multiprocessing import shared_memory
+from multiprocessing.pool import AsyncResult
+from typing import Tuple, Optional, List
+
+import numpy as np
 import torch
 
 
@@ -19,6 +28,122 @@ def empty_cache(device: torch.device):
         pass
 
 
+def get_available_memory(device: torch.device) -> int:
+    """
+    Free memory in bytes on device. Returns 0 if this cannot be determined (mps, non-linux systems).
+    """
+    if device.type == 'cuda':
+        free, total = torch.cuda.mem_get_info(device)
+        # memory held by torch's caching allocator can be reused by us
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    elif device.type == 'cpu':
+        try:
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+            return 0
+    return 0
+
+
+def get_peak_rss() -> int:
+    """
+    High-water mark of the resident memory of this process in bytes. It never decreases, so the peak of a stage is the
+    value after the stage if it is larger than the value before. Returns 0 where this cannot be determined (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def create_disk_backed_tensor(shape: Tuple[int, ...], dtype: np.dtype = np.float16,
+                              directory: Optional[str] = None) -> torch.Tensor:
+    """
+    Zero-initialized CPU tensor whose storage is a memory mapped temporary file in directory (default: the system's
+    temp directory). The operating system pages it in and out as needed, so it can be larger than the available RAM.
+    The file has no name and is removed by the operating system once the tensor (and every view of it) is gone.
+    """
+    with tempfile.TemporaryFile(dir=directory) as f:
+        # the memory map keeps its own handle of the file, closing ours does not remove it
+        array = np.memmap(f, dtype=dtype, mode='w+', shape=tuple(shape))
+    return torch.from_numpy(array)
+
+
+def create_shared_memory_tensor(shape: Tuple[int, ...], dtype: np.dtype = np.float16) \
+        -> Tuple[shared_memory.SharedMemory, torch.Tensor]:
+    """
+    Zero-initialized CPU tensor in a new shared memory block. Other processes can map it with open_shared_memory_array
+    and get_shared_memory_descriptor(block, tensor) without copying or pickling the data. The caller owns the block: it
+    must keep it alive until the other processes are done and then close() and unlink() it.
+    """
+    dtype = np.dtype(dtype)
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    array = np.ndarray(tuple(shape), dtype=dtype, buffer=block.buf)
+    return block, torch.from_numpy(array)
+
+
+def get_shared_memory_descriptor(block: shared_memory.SharedMemory, tensor: torch.Tensor) -> dict:
+    """Everything open_shared_memory_array needs to map tensor (created by create_shared_memory_tensor) elsewhere"""
+    return {'name': block.name, 'shape': tuple(tensor.shape), 'dtype': str(tensor.numpy().dtype)}
+
+
+def open_shared_memory_array(descriptor: dict) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    """
+    Maps the array described by descriptor (see get_shared_memory_descriptor). Delete every reference to the array
+    before closing the block (close_shared_memory). Only the creator unlinks it.
+    """
+    block = shared_memory.SharedMemory(name=descriptor['name'])
+    return block, np.ndarray(descriptor['shape'], dtype=np.dtype(descriptor['dtype']), buffer=block.buf)
+
+
+def close_shared_memory(block: shared_memory.SharedMemory) -> None:
+    try:
+        block.close()
+    except BufferError:
+        # an array of this process still maps it. The mapping is removed together with its last reference
+        pass
+
+
+def release_shared_memory(block: shared_memory.SharedMemory) -> None:
+    """Closes and unlinks a block created by create_shared_memory_tensor"""
+    close_shared_memory(block)
+    block.unlink()
+
+
+def release_finished_shared_memory(shared_blocks: List[Tuple[AsyncResult, shared_memory.SharedMemory]]) \
+        -> List[Tuple[AsyncResult, shared_memory.SharedMemory]]:
+    """
+    shared_blocks holds the shared memory handed to pool tasks. Releases the blocks of the finished tasks and returns
+    the others
+    """
+    pending = []
+    for result, block in shared_blocks:
+        if result.ready():
+            release_shared_memory(block)
+        else:
+            pending.append((result, block))
+    return pending
+
+
+@lru_cache(maxsize=None)
+def cpu_supports_bf16() -> bool:
+    """
+    True if the CPU has native bfloat16 instructions (AMX or AVX512-BF16). Without them bfloat16 is emulated and slower
+    than fp32. Only implemented for linux (/proc/cpuinfo), returns False otherwise.
+    """
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            flags = set()
+            for line in f:
+                if line.startswith('flags'):
+                    flags.update(line.split(':', 1)[1].split())
+    except OSError:
+        return False
+    return 'amx_bf16' in flags or 'avx512_bf16' in flags
+
+
 class dummy_context(object):
     def __enter__(self):
         pass
@@ -176,7 +176,21 @@ class LabelManager(object):
 
     def convert_logits_to_segmentation(self, predicted_logits: Union[np.ndarray, torch.Tensor]) -> \
             Union[np.ndarray, torch.Tensor]:
+        """
+        The default softmax does not change which class has the largest value. Without regions the argmax is therefore
+        taken on the (float32) logits and the probabilities are never computed.
+        """
         input_is_numpy = isinstance(predicted_logits, np.ndarray)
+        if not self.has_regions and self.inference_nonlin is softmax_helper_dim0:
+            assert predicted_logits.shape[0] == self.num_segmentation_heads, \
+                f'unexpected number of channels in predicted_logits. Expected {self.num_segmentation_heads}, ' \
+                f'got {predicted_logits.shape[0]}.'
+            if input_is_numpy:
+                predicted_logits = torch.from_numpy(predicted_logits)
+            with torch.no_grad():
+                # the logits are usually fp16, which is slow on most CPUs
+                segmentation = predicted_logits.float().argmax(0)
+            return segmentation.cpu().numpy() if input_is_numpy else segmentation
         probabilities = self.apply_inference_nonlin(predicted_logits)
         if input_is_numpy and isinstance(probabilities, torch.Tensor):
             probabilities = probabilities.cpu().numpy()
@@ -0,0 +1,158 @@
+"""
+Stage-level timing of the inference. Every span (reading, cropping, normalization, resampling, the sliding window of
+each fold, ...) is appended as one JSON line to the file in the environment variable nnUNet_telemetry. Processes started
+afterwards (preprocessing and export workers, nnUNetv2_predict subprocesses) inherit it and write to the same file.
+Without nnUNet_telemetry, span and record_span do nothing.
+
+A span is a dict with name, case, start (seconds since the epoch), duration (seconds), pid, tid and optional attributes
+(fold, ...). write_chrome_trace converts them for chrome://tracing or https://ui.perfetto.dev and summarize_spans
+computes percentiles of the durations per span name.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Union, Iterable
+
+import numpy as np
+
+TELEMETRY_ENV_VAR = 'nnUNet_telemetry'
+
+# case the spans of this process belong to, see telemetry_case
+_current_case = None
+
+
+def enable_telemetry(output_file: str) -> None:
+    """Starts a new telemetry file. Must be called before the workers are started so that they inherit it"""
+    output_file = os.path.abspath(output_file)
+    if os.path.dirname(output_file) != '':
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    open(output_file, 'w').close()
+    os.environ[TELEMETRY_ENV_VAR] = output_file
+
+
+def disable_telemetry() -> None:
+    os.environ.pop(TELEMETRY_ENV_VAR, None)
+
+
+def telemetry_enabled() -> bool:
+    return os.environ.get(TELEMETRY_ENV_VAR) is not None
+
+
+def set_telemetry_case(case: Union[str, None]) -> None:
+    """The spans recorded from now on belong to case (unless they set case themselves)"""
+    global _current_case
+    _current_case = case
+
+
+def get_telemetry_case() -> Union[str, None]:
+    return _current_case
+
+
+@contextmanager
+def telemetry_case(case: Union[str, None]):
+    """Spans recorded within belong to case"""
+    previous_case = get_telemetry_case()
+    set_telemetry_case(case)
+    try:
+        yield
+    finally:
+        set_telemetry_case(previous_case)
+
+
+def case_from_file(file_name: str) -> str:
+    """/path/sub01.nii.gz -> sub01"""
+    case = os.path.basename(file_name)
+    if case.endswith('.gz'):
+        case = case[:-len('.gz')]
+    return os.path.splitext(case)[0]
+
+
+def record_span(name: str, start: float, duration: float, **attributes) -> None:
+    """
+    Records a span that was timed elsewhere, for example the sum of many short calls. start is in seconds since the
+    epoch (time.time())
+    """
+    output_file = os.environ.get(TELEMETRY_ENV_VAR)
+    if output_file is None:
+        return
+    entry = {'name': name, 'case': attributes.pop('case', _current_case), 'start': start, 'duration': duration,
+             'pid': os.getpid(), 'tid': threading.get_native_id(), **attributes}
+    # a single short write in append mode, so that the lines of several processes do not interleave
+    with open(output_file, 'a') as f:
+        f.write(json.dumps(entry, default=str) + '\n')
+
+
+@contextmanager
+def span(name: str, device=None, **attributes):
+    """
+    Times the code within. If device is a cuda device (torch.device) it is synchronized before and after (only if
+    telemetry is enabled), otherwise the asynchronous kernels would be attributed to whatever waits for them
+    """
+    if not telemetry_enabled():
+        yield
+        return
+    synchronize_device(device)
+    start = time.time()
+    start_counter = time.perf_counter()
+    try:
+        yield
+    finally:
+        synchronize_device(device)
+        record_span(name, start, time.perf_counter() - start_counter, **attributes)
+
+
+def synchronize_device(device) -> None:
+    # torch is only imported for cuda devices so that CLIs without torch (run_labels_reordering) start quickly
+    if device is not None and device.type == 'cuda':
+        import torch
+        torch.cuda.synchronize(device)
+
+
+def load_spans(telemetry_file: str) -> List[dict]:
+    with open(telemetry_file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip() != '']
+
+
+def write_chrome_trace(spans: List[dict], output_file: str) -> None:
+    """Trace Event Format (complete events), one row per process and thread"""
+    events = []
+    for s in spans:
+        args = {k: v for k, v in s.items() if k not in ('name', 'start', 'duration', 'pid', 'tid')}
+        events.append({'name': s['name'], 'cat': 'nnunet', 'ph': 'X', 'ts': s['start'] * 1e6,
+                       'dur': s['duration'] * 1e6, 'pid': s['pid'], 'tid': s['tid'], 'args': args})
+    with open(output_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def summarize_spans(spans: List[dict], percentiles: Iterable[float] = (50, 90, 99)) -> dict:
+    """
+    Number of spans, cases, total and percentiles of the durations (seconds) of every span name, in the order the
+    names first appear. The durations of spans with the same name and case are added up first (for example the sliding
+    window of all folds), so the percentiles are over cases
+    """
+    durations_per_case = {}
+    counts = {}
+    for s in spans:
+        durations = durations_per_case.setdefault(s['name'], {})
+        durations[s['case']] = durations.get(s['case'], 0.) + s['duration']
+        counts[s['name']] = counts.get(s['name'], 0) + 1
+    summary = {}
+    for name, durations in durations_per_case.items():
+        durations = np.array(list(durations.values()))
+        summary[name] = {'count': counts[name], 'cases': len(durations), 'total': float(np.sum(durations)),
+                         **{f'p{p:g}': float(np.percentile(durations, p)) for p in percentiles},
+                         'max': float(np.max(durations))}
+    return summary
+
+
+def format_summary_table(summary: dict) -> str:
+    columns = [k for k in next(iter(summary.values())).keys() if k not in ('count', 'cases')] if len(summary) > 0 \
+        else []
+    name_width = max([len('span')] + [len(i) for i in summary.keys()])
+    lines = [f"{'span':<{name_width}}  {'cases':>6}" + ''.join(f'  {c + " [s]":>10}' for c in columns)]
+    for name, stats in summary.items():
+        lines.append(f'{name:<{name_width}}  {stats["cases"]:>6}' + ''.join(f'  {stats[c]:>10.3f}' for c in columns))
+    return '\n'.join(lines)
+
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+#----------------------------------------------------------------------------------#
+# Copyright 2025 [Marc-Antoine Fortin, MR Physics, NTNU]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#---------------------------------------------------------------------------------#
+"""
+Compares the speed and the label maps of GOUHFI inference settings (run_gouhfi_benchmark).
+
+Every case is preprocessed once and segmented with the default settings (the reference) and with the candidate
+settings. The inference time, the number of sliding window tiles, the voxel agreement and the Dice of every label of the
+post-processed label maps are reported. If expected label maps are given (e.g., test_data/expected-results), the Dice of
+both settings against them is reported as well, so that the drift of the candidate can be judged against the
+reference's own error.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+
+def dice_per_label(reference, prediction, labels=None):
+    """Dice of every label in labels (default: all labels except 0 found in either label map). NaN if a label is in neither."""
+    if labels is None:
+        labels = [int(i) for i in np.union1d(np.unique(reference), np.unique(prediction)) if i != 0]
+    dices = {}
+    for label in labels:
+        ref, pred = reference == label, prediction == label
+        denominator = np.count_nonzero(ref) + np.count_nonzero(pred)
+        dices[label] = 2 * np.count_nonzero(ref & pred) / denominator if denominator > 0 else float('nan')
+    return dices
+
+
+def segment_and_time(pipeline, data, properties):
+    start_time = time.time()
+    segmentations = pipeline.segment_preprocessed_case(data, properties)
+    return segmentations, time.time() - start_time
+
+
+def benchmark(reference_pipeline, candidate_pipeline, list_of_lists, stage='postpro', expected_files=None):
+    """
+    Segments every case (list of input files) with both pipelines and returns one result dict per case. Both pipelines
+    must use the same model, the reference pipeline's preprocessing is used for both.
+    expected_files: optional list with one expected label map (in the label space of stage) per case, None for cases
+    without one.
+    """
+    if expected_files is None:
+        expected_files = [None] * len(list_of_lists)
+    rw = reference_pipeline.predictor.plans_manager.image_reader_writer_class()
+    results = []
+    for image_files, expected_file in zip(list_of_lists, expected_files):
+        print(f"Benchmarking {image_files[0]}")
+        data, properties = reference_pipeline.preprocess_files(image_files)
+        reference, reference_seconds = segment_and_time(reference_pipeline, data, properties)
+        candidate, candidate_seconds = segment_and_time(candidate_pipeline, data, properties)
+        dices = dice_per_label(reference[stage], candidate[stage])
+        results.append({
+            'case': image_files[0],
+            'reference_seconds': reference_seconds,
+            'candidate_seconds': candidate_seconds,
+            'reference_tiles': reference_pipeline.predictor.sliding_window_stats,
+            'candidate_tiles': candidate_pipeline.predictor.sliding_window_stats,
+            'voxel_agreement': float(np.mean(reference[stage] == candidate[stage])),
+            'mean_dice': float(np.nanmean(list(dices.values()))) if len(dices) > 0 else 1.,
+            'min_dice': float(np.nanmin(list(dices.values()))) if len(dices) > 0 else 1.,
+            'dice_per_label': {str(k): v for k, v in dices.items()},
+        })
+        if expected_file is not None:
+            expected = rw.read_seg(expected_file)[0][0]
+            for name, seg in (('reference', reference[stage]), ('candidate', candidate[stage])):
+                results[-1][f'{name}_dice_vs_expected'] = float(np.nanmean(list(dice_per_label(expected, seg).values())))
+        r = results[-1]
+        print(f"  reference: {reference_seconds:.2f} s, {r['reference_tiles']['num_tiles']} tiles | candidate: "
+              f"{candidate_seconds:.2f} s, {r['candidate_tiles']['num_tiles']} tiles "
+              f"(+{r['candidate_tiles']['num_refined_tiles']} refined) | agreement {r['voxel_agreement']:.5f}, "
+              f"mean Dice {r['mean_dice']:.4f}, min Dice {r['min_dice']:.4f}")
+        if expected_file is not None:
+            print(f"  mean Dice vs expected: reference {r['reference_dice_vs_expected']:.4f}, candidate "
+                  f"{r['candidate_dice_vs_expected']:.4f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the speed and the segmentations of GOUHFI inference settings against the default settings.")
+    parser.add_argument("-i", "--input_dir", required=True, help="Directory containing the input images ({SUBJECT_ID}_0000.nii.gz).")
+    parser.add_argument("--expected_dir", default=None, help="Optional directory with the expected label maps ({SUBJECT_ID}.nii.gz, GOUHFI's labels, e.g. $GOUHFI_HOME/test_data/expected-results).")
+    parser.add_argument("--output_json", default=None, help="Optional JSON file the per-case results and the summary are written to.")
+    parser.add_argument("--num_cases", type=int, default=None, help="Only benchmark the first N cases. Default: all.")
+    parser.add_argument("--folds", default="0 1 2 3 4", help="Folds to use for inference. By default all folds are used and combined together.")
+    parser.add_argument("--cpu", action="store_true", help="Set flag to use the CPU to run the inference.")
+    parser.add_argument("--max_tiles", type=int, default=None, help="Candidate setting. See run_gouhfi.")
+    parser.add_argument("--target_latency", type=float, default=None, help="Candidate setting. See run_gouhfi.")
+    parser.add_argument("--refine_threshold", type=float, default=None, help="Candidate setting. See run_gouhfi.")
+    parser.add_argument("--cpu_precision", "--cpu-precision", default="fp32", choices=["fp32", "bf16", "auto"], help="Candidate setting. See run_gouhfi. The reference always runs in fp32.")
+    parser.add_argument("--int8", action="store_true", help="Candidate setting. Set flag to use the int8 quantized folds (see run_gouhfi_quantize, requires --cpu).")
+    args = parser.parse_args()
+    if args.int8 and not args.cpu:
+        parser.error("--int8 requires --cpu")
+
+    # Importing this module sets up GOUHFI_HOME and the nnUNet environment variables
+    from run_inference.gouhfi_inference_postpro_reo import get_model_paths, setup_torch_device, get_checkpoint_name
+    from run_inference.gouhfi_pipeline import GouhfiPipeline
+    from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
+
+    device = setup_torch_device(args.cpu)
+    model_dir, pp_pkl_file = get_model_paths()
+    folds = [i if i == 'all' else int(i) for i in args.folds.split()]
+    # folds are kept resident in both pipelines so that reloading the weights does not dominate the timings
+    pipeline_kwargs = dict(use_folds=folds, pp_pkl_file=str(pp_pkl_file), device=device, allow_tqdm=False,
+                           keep_folds_resident=True)
+    reference_pipeline = GouhfiPipeline(str(model_dir), checkpoint_name=get_checkpoint_name(), **pipeline_kwargs)
+    candidate_pipeline = GouhfiPipeline(str(model_dir), checkpoint_name=get_checkpoint_name(args.int8),
+                                        max_tiles=args.max_tiles, target_latency=args.target_latency,
+                                        refine_threshold=args.refine_threshold, cpu_precision=args.cpu_precision,
+                                        **pipeline_kwargs)
+    reference_pipeline.warm_up()
+    candidate_pipeline.warm_up()
+
+    list_of_lists = create_lists_from_splitted_dataset_folder(args.input_dir, reference_pipeline.file_ending)
+    if args.num_cases is not None:
+        list_of_lists = list_of_lists[:args.num_cases]
+    expected_files = None
+    if args.expected_dir is not None:
+        file_ending = reference_pipeline.file_ending
+        expected_files = [os.path.join(args.expected_dir, os.path.basename(i[0])[:-(len(file_ending) + 5)] + file_ending)
+                          for i in list_of_lists]
+        expected_files = [i if os.path.isfile(i) else None for i in expected_files]
+    results = benchmark(reference_pipeline, candidate_pipeline, list_of_lists, expected_files=expected_files)
+
+    summary = {
+        'speedup': sum(r['reference_seconds'] for r in results) / max(sum(r['candidate_seconds'] for r in results), 1e-8),
+        'mean_voxel_agreement': float(np.mean([r['voxel_agreement'] for r in results])),
+        'mean_dice': float(np.mean([r['mean_dice'] for r in results])),
+        'min_dice': float(np.min([r['min_dice'] for r in results])),
+    }
+    print(f"Speed-up: {summary['speedup']:.2f}x, mean voxel agreement: {summary['mean_voxel_agreement']:.5f}, "
+          f"mean Dice: {summary['mean_dice']:.4f}, worst label Dice: {summary['min_dice']:.4f}")
+    with_expected = [r for r in results if 'candidate_dice_vs_expected' in r]
+    if len(with_expected) > 0:
+        summary['dice_drift_vs_expected'] = float(np.mean([r['candidate_dice_vs_expected'] - r['reference_dice_vs_expected']
+                                                           for r in with_expected]))
+        print(f"Dice drift against the expected label maps ({len(with_expected)} cases): "
+              f"{summary['dice_drift_vs_expected']:+.4f}")
+    if args.output_json is not None:
+        with open(args.output_json, 'w') as f:
+            json.dump({'settings': vars(args), 'summary': summary, 'cases': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+#----------------------------------------------------------------------------------#
+# Copyright 2025 [Marc-Antoine Fortin, MR Physics, NTNU]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#---------------------------------------------------------------------------------#
+"""
+Result cache of run_gouhfi (--cache_dir).
+
+The label maps of every subject are stored under a key combining the content hash of its input image(s) with the model
+fingerprint: the hashes of the checkpoints (or exported graphs) of the folds, of the plans, of postprocessing.pkl and of
+the lookuptables, and every setting that changes the label maps (folds, test-time augmentation, patch overlap limits,
+precision, backend, ...). Settings that only change the speed (--np, --resident_folds, --fold_workers, --tile_batch_size,
+...) are not part of the key. Re-running run_gouhfi on a growing cohort then only segments the new or changed images.
+
+Layout: {cache_dir}/entries/{key[:2]}/{key}/{stage}.nii.gz plus entry.json. The modification time of entry.json is the
+last use of the entry, the least recently used entries are removed once the cache is larger than its maximum size.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# file names of the label maps of every stage (see gouhfi_label_stages.GOUHFI_STAGES) in a cache entry
+STAGE_FILE_ENDING = '.nii.gz'
+
+
+def hash_file(file_name, chunk_size=2 ** 20):
+    """sha256 of the file's content"""
+    h = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_json(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResultCache(object):
+    def __init__(self, cache_dir, max_size=None):
+        """
+        max_size: in bytes. None for no limit.
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.entries_dir = os.path.join(self.cache_dir, 'entries')
+        self.max_size = max_size
+        os.makedirs(self.entries_dir, exist_ok=True)
+
+    def hash_file(self, file_name):
+        """
+        hash_file, memoized by path, size and modification time in the cache folder. Used for the checkpoints, which are
+        too large to be hashed on every run.
+        """
+        memo_file = os.path.join(self.cache_dir, 'file_hashes.json')
+        memo = {}
+        if os.path.isfile(memo_file):
+            try:
+                with open(memo_file, 'r') as f:
+                    memo = json.load(f)
+            except ValueError:
+                # written concurrently or truncated. It is just a memo
+                memo = {}
+        file_name = os.path.abspath(file_name)
+        stat = os.stat(file_name)
+        memo_key = f'{file_name}|{stat.st_size}|{stat.st_mtime_ns}'
+        if memo_key not in memo:
+            memo[memo_key] = hash_file(file_name)
+            self._write_json_atomically(memo, memo_file)
+        return memo[memo_key]
+
+    def get_model_fingerprint(self, model_files, settings):
+        """
+        model_files: every file the label maps depend on besides the input images (checkpoints, plans, postprocessing,
+        lookuptables). settings: dict of the settings that change the label maps.
+        """
+        return hash_json({'files': {os.path.basename(f): self.hash_file(f) for f in sorted(model_files)},
+                          'settings': settings})
+
+    @staticmethod
+    def get_case_key(image_files, model_fingerprint):
+        return hash_json({'images': [hash_file(i) for i in image_files], 'model': model_fingerprint})
+
+    def _get_entry_dir(self, key):
+        return os.path.join(self.entries_dir, key[:2], key)
+
+    def lookup(self, key, stages):
+        """Returns {stage: cached file} if the entry holds the label maps of all stages, otherwise None."""
+        entry_dir = self._get_entry_dir(key)
+        files = {s: os.path.join(entry_dir, s + STAGE_FILE_ENDING) for s in stages}
+        if not os.path.isfile(os.path.join(entry_dir, 'entry.json')) or \
+                not all(os.path.isfile(f) for f in files.values()):
+            return None
+        return files
+
+    def restore(self, key, output_files):
+        """
+        Copies the cached label maps to output_files ({stage: file}). Returns False (and copies nothing) on a cache
+        miss.
+        """
+        cached_files = self.lookup(key, list(output_files.keys()))
+        if cached_files is None:
+            return False
+        for stage, output_file in output_files.items():
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            shutil.copyfile(cached_files[stage], output_file)
+        # last use, for the LRU eviction
+        os.utime(os.path.join(self._get_entry_dir(key), 'entry.json'))
+        return True
+
+    def store(self, key, files, metadata=None):
+        """
+        Adds the label maps in files ({stage: file}) to the entry of key. Stages that are already cached are kept. The
+        new entry is written next to the old one and renamed, so concurrent runs never see a partial entry.
+        """
+        entry_dir = self._get_entry_dir(key)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        new_entry_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir), prefix='.tmp_')
+        stages = dict(files)
+        if os.path.isdir(entry_dir):
+            for f in os.listdir(entry_dir):
+                if f.endswith(STAGE_FILE_ENDING) and f[:-len(STAGE_FILE_ENDING)] not in stages.keys():
+                    stages[f[:-len(STAGE_FILE_ENDING)]] = os.path.join(entry_dir, f)
+        for stage, f in stages.items():
+            shutil.copyfile(f, os.path.join(new_entry_dir, stage + STAGE_FILE_ENDING))
+        with open(os.path.join(new_entry_dir, 'entry.json'), 'w') as f:
+            json.dump({'key': key, 'stages': sorted(stages.keys()), 'created': time.time(), **(metadata or {})}, f,
+                      indent=2)
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        try:
+            os.replace(new_entry_dir, entry_dir)
+        except OSError:
+            # another run stored the same entry in the meantime
+            shutil.rmtree(new_entry_dir, ignore_errors=True)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is no larger than max_size. Returns their number."""
+        if self.max_size is None:
+            return 0
+        entries = []
+        for prefix in os.listdir(self.entries_dir):
+            prefix_dir = os.path.join(self.entries_dir, prefix)
+            for key in os.listdir(prefix_dir):
+                entry_json = os.path.join(prefix_dir, key, 'entry.json')
+                if key.startswith('.tmp_') or not os.path.isfile(entry_json):
+                    continue
+                size = sum(os.path.getsize(os.path.join(prefix_dir, key, f))
+                           for f in os.listdir(os.path.join(prefix_dir, key)))
+                entries.append((os.path.getmtime(entry_json), size, os.path.join(prefix_dir, key)))
+        total_size = sum(e[1] for e in entries)
+        num_evicted = 0
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+            num_evicted += 1
+        return num_evicted
+
+    @staticmethod
+    def _write_json_atomically(obj, file_name):
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(file_name), prefix='.tmp_')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_file, file_name)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+#----------------------------------------------------------------------------------#
+# Copyright 2025 [Marc-Antoine Fortin, MR Physics, NTNU]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#---------------------------------------------------------------------------------#
+"""
+Exports the trained GOUHFI folds as TorchScript and/or ONNX graphs (run_gouhfi_export).
+
+The exported folder (by default exported/ in the model folder) holds one frozen graph per fold, optionally the average of
+all folds as a single graph, and the plans and dataset files, so it can be deployed without the training checkpoints.
+It is used by run_gouhfi --backend torchscript/onnxruntime. Every exported graph is checked against the eager network
+on a random patch.
+"""
+import argparse
+import os
+import time
+from copy import deepcopy
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the trained GOUHFI folds as TorchScript and/or ONNX graphs (run_gouhfi --backend).")
+    parser.add_argument("--folds", default="0 1 2 3 4", help="Folds to export. By default all folds are exported.")
+    parser.add_argument("--formats", default="torchscript", help="Space-separated backends to export for: torchscript and/or onnxruntime (requires onnx and onnxruntime, see the onnx extra). Default: torchscript.")
+    parser.add_argument("--fold_average", action="store_true", help="Set flag to also export the average of all folds as a single graph (used by run_gouhfi --backend ... --fuse_folds).")
+    parser.add_argument("--output_dir", default=None, help="Output directory. Default: the exported folder in the model folder, which is where run_gouhfi looks for it.")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset version. Default: 17.")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="Maximum absolute difference of the logits of an exported graph and the eager network. Default: 1e-3.")
+    args = parser.parse_args()
+    backends = args.formats.split()
+
+    # Importing this module sets up GOUHFI_HOME and the nnUNet environment variables
+    from run_inference.gouhfi_inference_postpro_reo import get_model_paths, get_checkpoint_name
+    import torch
+    from torch._dynamo import OptimizedModule
+    from nnunetv2.inference.inference_backends import EXPORT_FORMATS, export_network_graphs, load_exported_network, \
+        get_exported_network_name
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+    from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
+
+    unknown_backends = [i for i in backends if i not in EXPORT_FORMATS.keys()]
+    if len(unknown_backends) > 0:
+        parser.error(f"Unknown formats {unknown_backends}. Available: {list(EXPORT_FORMATS.keys())}")
+
+    model_dir, _ = get_model_paths()
+    output_dir = args.output_dir if args.output_dir is not None else os.path.join(model_dir, "exported")
+    folds = [i if i == 'all' else int(i) for i in args.folds.split()]
+    device = torch.device('cpu')
+    predictor = nnUNetPredictor(device=device, allow_tqdm=False)
+    predictor.initialize_from_trained_model_folder(str(model_dir), folds, get_checkpoint_name())
+    template_network = predictor.network._orig_mod if isinstance(predictor.network, OptimizedModule) \
+        else predictor.network
+    networks = []
+    for params in predictor.list_of_parameters:
+        network = deepcopy(template_network)
+        network.load_state_dict(params)
+        networks.append(network.eval())
+
+    patch_size = predictor.configuration_manager.patch_size
+    num_input_channels = determine_num_input_channels(predictor.plans_manager, predictor.configuration_manager,
+                                                      predictor.dataset_json)
+    checkpoint = torch.load(os.path.join(model_dir, f"fold_{folds[0]}", get_checkpoint_name()), map_location=device)
+    metadata = {
+        'trainer_name': predictor.trainer_name,
+        'configuration': checkpoint['init_args']['configuration'],
+        'inference_allowed_mirroring_axes': list(predictor.allowed_mirroring_axes)
+        if predictor.allowed_mirroring_axes is not None else None,
+        'source_checkpoint': get_checkpoint_name(),
+    }
+    start_time = time.time()
+    export_network_graphs(networks, folds, output_dir, str(model_dir), patch_size, num_input_channels, metadata,
+                          backends=tuple(backends), export_fold_average=args.fold_average, opset_version=args.opset)
+    print(f"Exported {len(folds)} fold(s) for {', '.join(backends)} to {output_dir} in {time.time() - start_time:.2f} seconds.")
+
+    example_input = torch.rand((2, num_input_channels, *patch_size))
+    # None is the fold average
+    to_check = list(folds) + ([None] if args.fold_average and len(networks) > 1 else [])
+    failed = []
+    with torch.no_grad():
+        eager_outputs = [n(example_input) for n in networks]
+        for backend in backends:
+            for fold in to_check:
+                expected = eager_outputs[folds.index(fold)] if fold is not None else \
+                    torch.stack(eager_outputs).mean(0)
+                exported = load_exported_network(os.path.join(output_dir, get_exported_network_name(fold, backend)),
+                                                 backend, device)
+                difference = torch.max(torch.abs(exported(example_input) - expected)).item()
+                name = f"fold {fold}" if fold is not None else "fold average"
+                print(f"{backend} {name}: max abs difference to the eager network {difference:.2e}")
+                if difference > args.tolerance:
+                    failed.append(f"{backend} {name}")
+    if len(failed) > 0:
+        raise RuntimeError(f"The logits of {', '.join(failed)} differ by more than {args.tolerance} from the eager "
+                           f"networks. Do not use them.")
+
+
+if __name__ == "__main__":
+    main()
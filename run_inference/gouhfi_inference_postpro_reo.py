@@ -18,11 +18,19 @@
 # under the terms of the Apache License, Version 2.0.
 #---------------------------------------------------------------------------------#
 import argparse
+import json
+import shutil
 import subprocess
 import os
+import tempfile
 import time
 from pathlib import Path
 
+from data_utils.get_volume_values import load_label_mapping
+from run_inference.gouhfi_manifest import RunManifest
+from nnunetv2.utilities.telemetry import enable_telemetry, disable_telemetry, load_spans, write_chrome_trace, \
+    summarize_spans, format_summary_table, span
+
 #---------------------------------------------------------------------------------#
 ### Setting up environment variables for nnUNet if not already set 
 # GOUHFI base directory
@@ -38,7 +46,30 @@ os.environ["nnUNet_preprocessed"] = os.path.join(gouhfi_home, "nnUNet_preprocess
 os.environ["nnUNet_results"] = os.path.join(gouhfi_home, "trained_model") # Only important path since the nnUNet framework will use it to find the trained GOUHFI#---------------------------------------------------------------------------------#
 
 
-def run_inference(dataset_id, input_dir, output_dir, config, trainer, plan, folds, num_pr, cpu):
+def get_model_paths():
+    """Returns the folder of the trained GOUHFI model and its postprocessing.pkl file."""
+    plans_dir = Path(gouhfi_home) / "trained_model/Dataset014_gouhfi/nnUNetTrainer_NoDA_500epochs_AdamW__nnUNetResEncL__3d_fullres"
+    pp_pkl_file = plans_dir / "crossval_results_folds_0_1_2_3_4" / "postprocessing.pkl"
+    return plans_dir, pp_pkl_file
+
+
+def get_checkpoint_name(int8=False):
+    """Checkpoint of every fold used for inference. The int8 checkpoints are written by run_gouhfi_quantize."""
+    return "checkpoint_best_int8.pth" if int8 else "checkpoint_best.pth"
+
+
+def get_lut_paths():
+    """Returns GOUHFI's lookuptable and the FreeSurfer lookuptable used to reorder the labels."""
+    in_lut = os.path.join(gouhfi_home, 'misc/gouhfi_v2p0_brain_labels_lut.txt')
+    out_lut = os.path.join(gouhfi_home, 'misc/freesurfer_brain_labels_lut.txt')
+    return in_lut, out_lut
+
+
+def run_inference(dataset_id, input_dir, output_dir, config, trainer, plan, folds, num_pr, cpu, resident_folds=False, fuse_folds=False,
+                  fold_workers=0, fold_devices=None, tile_batch_size="1", batched_tta=False, tta_subset=None,
+                  skip_empty_tiles=None, max_tiles=None, target_latency=None, refine_threshold=None,
+                  cpu_precision="fp32", int8=False, backend="torch", accumulate_folds_on_device=False,
+                  max_memory=None, memmap_dir=None):
     start_time = time.time()
     # Command for inference
     inference_command = [
@@ -51,7 +82,7 @@ def run_inference(dataset_id, input_dir, output_dir, config, trainer, plan, fold
                             "-p", plan,
                             "-f"
                         ] + folds + [
-                            "-chk", "checkpoint_best.pth",
+                            "-chk", get_checkpoint_name(int8),
                             "-npp", str(num_pr),
                             "-nps", str(num_pr)
                         ]
@@ -59,52 +90,152 @@ def run_inference(dataset_id, input_dir, output_dir, config, trainer, plan, fold
     if cpu:
         print("CPU will be used to run the inference. Expect a considerable increase in inference time.")
         inference_command += ["-device", "cpu"]
+    if resident_folds:
+        inference_command += ["--resident_folds"]
+    if fuse_folds:
+        inference_command += ["--fuse_folds"]
+    if fold_workers > 0:
+        inference_command += ["-fold_workers", str(fold_workers)]
+    if fold_devices is not None:
+        inference_command += ["-fold_devices"] + fold_devices
+    if str(tile_batch_size) != "1":
+        inference_command += ["-tile_batch_size", str(tile_batch_size)]
+    if batched_tta:
+        inference_command += ["--batched_tta"]
+    if tta_subset is not None:
+        if len(tta_subset) == 0:
+            inference_command += ["--disable_tta"]
+        else:
+            inference_command += ["-tta_subset"] + [",".join(map(str, c)) for c in tta_subset]
+    if skip_empty_tiles is not None:
+        inference_command += ["-tile_skip_threshold", str(skip_empty_tiles)]
+    if max_tiles is not None:
+        inference_command += ["-max_tiles", str(max_tiles)]
+    if target_latency is not None:
+        inference_command += ["-target_latency", str(target_latency)]
+    if refine_threshold is not None:
+        inference_command += ["-refine_threshold", str(refine_threshold)]
+    if cpu and cpu_precision != "fp32":
+        inference_command += ["-cpu_precision", cpu_precision]
+    if backend != "torch":
+        inference_command += ["-backend", backend]
+    if accumulate_folds_on_device:
+        inference_command += ["--accumulate_folds_on_device"]
+    if max_memory is not None:
+        inference_command += ["-max_memory", str(max_memory)]
+    if memmap_dir is not None:
+        inference_command += ["-memmap_dir", memmap_dir]
 
     
     print(f"Running inference with the following command: {' '.join(map(str, inference_command))}")
 
-    subprocess.run(inference_command)
+    result = subprocess.run(inference_command)
     end_time = time.time()
     duration = end_time - start_time
     print(f"Inference completed in {duration:.2f} seconds.")
-    return duration
+    return duration, result.returncode
 
 
-def apply_post_processing(input_dir, output_dir, pp_pkl_file, np, plans_json):
+def apply_label_stages(input_dir, output_pp_dir, output_pp_reo_dir, pp_pkl_file, np, plans_json, in_lut=None,
+                       out_lut=None, volumetry_file=None):
     start_time = time.time()
-    # Command for applying post processing
-    post_processing_command = [
-        "nnUNetv2_apply_postprocessing",
+    # Post-processing, label reordering and volumetry with a single read of every raw prediction
+    label_stages_command = [
+        "run_gouhfi_label_stages",
         "-i", input_dir,
-        "-o", output_dir,
-        "-pp_pkl_file", pp_pkl_file,
-        "-np", str(np),
-        "-plans_json", plans_json
+        "-o", output_pp_dir,
+        "--pp_pkl_file", pp_pkl_file,
+        "--np", str(np),
+        "--plans_json", plans_json
     ]
-    # print(f"Applying post-processing with the following command: {' '.join(post_processing_command)}")
-    print(f"Applying post-processing with the following command: {' '.join(map(str, post_processing_command))}")
-    subprocess.run(post_processing_command)
+    if output_pp_reo_dir is not None:
+        label_stages_command += ["--reordered_dir", output_pp_reo_dir, "--old_labels_file", in_lut,
+                                 "--new_labels_file", out_lut]
+    if volumetry_file is not None:
+        label_stages_command += ["--volumetry", volumetry_file]
+    print(f"Applying post-processing{', label reordering' if output_pp_reo_dir is not None else ''}"
+          f"{' and volumetry' if volumetry_file is not None else ''} with the following command: "
+          f"{' '.join(map(str, label_stages_command))}")
+    result = subprocess.run(label_stages_command)
     end_time = time.time()
     duration = end_time - start_time
     print(f"Post-processing completed in {duration:.2f} seconds.")
-    return duration
+    return duration, result.returncode
+
+def report_telemetry(spans_file, output_file, output_format, print_summary):
+    """Writes the spans collected in spans_file to output_file (if given) in output_format and prints the summary."""
+    disable_telemetry()
+    spans = load_spans(spans_file)
+    if output_file is not None and output_format == "chrome":
+        write_chrome_trace(spans, output_file)
+    if spans_file != output_file:
+        os.remove(spans_file)
+    if output_file is not None:
+        print(f"Telemetry ({len(spans)} spans) written to {output_file}.")
+    if print_summary:
+        print("Duration of every stage per subject:")
+        print(format_summary_table(summarize_spans(spans)))
+
+def parse_tta_subset(tta_subset):
+    """
+    "0 1 2" -> [(0,), (1,), (2,)]: space-separated mirror axes combinations, each with comma-separated axes.
+    "none" -> []: no mirroring at all.
+    """
+    if tta_subset.strip().lower() == "none":
+        return []
+    return [tuple(int(a) for a in c.split(",")) for c in tta_subset.split()]
 
 
-def apply_reordering(input_dir, output_dir, in_lut, out_lut):
+def setup_torch_device(cpu):
+    """Sets torch's number of threads the same way nnUNetv2_predict does and returns the device to run inference on."""
+    import torch
+
+    if cpu:
+        print("CPU will be used to run the inference. Expect a considerable increase in inference time.")
+        # let's allow torch to use hella threads (same as nnUNetv2_predict)
+        torch.set_num_threads(os.cpu_count())
+        return torch.device('cpu')
+    # multithreading in torch doesn't help nnU-Net if run on GPU
+    torch.set_num_threads(1)
+    torch.set_num_interop_threads(1)
+    return torch.device('cuda')
+
+
+def run_in_process(input_dir, output_folders, model_dir, folds, num_pr, cpu, pp_pkl_file, in_lut=None, out_lut=None,
+                   resident_folds=False, fuse_folds=False, fold_workers=0, fold_devices=None, tile_batch_size="1",
+                   batched_tta=False, tta_subset=None, skip_empty_tiles=None, max_tiles=None, target_latency=None,
+                   refine_threshold=None, cpu_precision="fp32", int8=False, backend="torch",
+                   accumulate_folds_on_device=False, max_memory=None, memmap_dir=None, volumetry_file=None):
     start_time = time.time()
-    # Command for reordering labels
-    reorder_command = [
-        "run_labels_reordering",
-        "--input_dir", input_dir,
-        "--output_dir", output_dir,
-        "--old_labels_file", in_lut,
-        "--new_labels_file", out_lut
-    ]
-    print(f"Reordering labels with the following command: {' '.join(map(str, reorder_command))}")
-    subprocess.run(reorder_command)
+    # Imported here so that nnUNet picks up the environment variables set above and the subprocess mode does not pay
+    # for importing torch
+    from run_inference.gouhfi_pipeline import GouhfiPipeline
+
+    device = setup_torch_device(cpu)
+    print(f"Running inference, post-processing{' and label reordering' if in_lut is not None else ''} in-process.")
+    print(f"Label maps will be written for the following stages: {', '.join(k for k, v in output_folders.items() if v is not None)}")
+    pipeline = GouhfiPipeline(str(model_dir), [i if i == 'all' else int(i) for i in folds],
+                              checkpoint_name=get_checkpoint_name(int8), pp_pkl_file=str(pp_pkl_file),
+                              in_lut=in_lut, out_lut=out_lut, device=device,
+                              keep_folds_resident=resident_folds, fuse_folds=fuse_folds,
+                              fold_workers=fold_workers, fold_devices=fold_devices,
+                              tile_batch_size=tile_batch_size if tile_batch_size == "auto" else int(tile_batch_size),
+                              batched_tta=batched_tta, tta_subset=tta_subset, tile_skip_threshold=skip_empty_tiles,
+                              max_tiles=max_tiles, target_latency=target_latency, refine_threshold=refine_threshold,
+                              cpu_precision=cpu_precision, backend=backend,
+                              accumulate_folds_on_device=accumulate_folds_on_device,
+                              max_memory=int(max_memory * 1e9) if max_memory is not None else None,
+                              memmap_dir=memmap_dir)
+    pipeline.predict_from_files(input_dir,
+                                {k: (str(v) if v is not None else None) for k, v in output_folders.items()},
+                                num_processes_preprocessing=num_pr,
+                                num_processes_segmentation_export=num_pr,
+                                volumetry_file=str(volumetry_file) if volumetry_file is not None else None,
+                                volumetry_label_map=load_label_mapping(get_lut_paths()[0])
+                                if volumetry_file is not None else None)
     end_time = time.time()
     duration = end_time - start_time
-    print(f"Label reordering completed in {duration:.2f} seconds.")
+    print(f"In-process inference, post-processing and reordering completed in {duration:.2f} seconds.")
     return duration
 
 def run_all(dataset_id='014', 
@@ -117,11 +248,38 @@ def run_all(dataset_id='014',
             folds="0 1 2 3 4", 
             reorder_labels=False,
             cpu=False,
+            in_process=False,
+            save_intermediates=False,
+            resident_folds=False,
+            fuse_folds=False,
+            fold_workers=0,
+            fold_devices=None,
+            tile_batch_size="1",
+            batched_tta=False,
+            tta_subset=None,
+            skip_empty_tiles=None,
+            max_tiles=None,
+            target_latency=None,
+            refine_threshold=None,
+            cpu_precision="fp32",
+            int8=False,
+            backend="torch",
+            accumulate_folds_on_device=False,
+            max_memory=None,
+            memmap_dir=None,
+            cache_dir=None,
+            cache_size=None,
+            resume=False,
+            volumetry=False,
             in_lut="/home/marcantf/Code/GOUHFI/misc/gouhfi_v2p0_brain_labels_lut.txt", 
             out_lut="/home/marcantf/Code/GOUHFI/misc/freesurfer-label-list-lut.txt"):
+    # arguments of this run, for the result cache and the manifests
+    run_kwargs = dict(locals())
 
     # Convert folds argument to a list of strings 
     folds_list = folds.split()
+    fold_devices_list = fold_devices.split() if fold_devices is not None else None
+    tta_subset = parse_tta_subset(tta_subset) if tta_subset is not None else None
     # Construct paths
     input_dir = input_dir.rstrip('/')
     base_dir = os.path.dirname(input_dir)
@@ -138,32 +296,195 @@ def run_all(dataset_id='014',
         output_pp_dir = output_path / "outputs_postpro"
         output_pp_reo_dir = output_path / "outputs_postpro_reo"
 
-    # Ensure directories exist
-    output_dir.mkdir(parents=True, exist_ok=True)
-    output_pp_dir.mkdir(parents=True, exist_ok=True)
-    if reorder_labels:
-        output_pp_reo_dir.mkdir(parents=True, exist_ok=True)
-
     # Set misc paths (unchanged)
-    pp_dir = Path(gouhfi_home) / "trained_model/Dataset014_gouhfi/nnUNetTrainer_NoDA_500epochs_AdamW__nnUNetResEncL__3d_fullres/crossval_results_folds_0_1_2_3_4"
-    pp_pkl_file = pp_dir / "postprocessing.pkl"
-    plans_dir = Path(gouhfi_home) / "trained_model/Dataset014_gouhfi/nnUNetTrainer_NoDA_500epochs_AdamW__nnUNetResEncL__3d_fullres"
+    plans_dir, pp_pkl_file = get_model_paths()
     plans_json_file = plans_dir / "plans.json"
 
+    if in_process:
+        # Only the final label maps are written, plus the intermediate ones if requested
+        output_folders = {
+            "raw": output_dir if save_intermediates else None,
+            "postpro": output_pp_dir if (save_intermediates or not reorder_labels) else None,
+            "reordered": output_pp_reo_dir if reorder_labels else None,
+        }
+    else:
+        output_folders = {"raw": output_dir, "postpro": output_pp_dir,
+                          "reordered": output_pp_reo_dir if reorder_labels else None}
+    # volumetry of the post-processed label maps of all subjects, next to the raw predictions
+    volumetry_file = output_dir / "volumetry_brain.csv" if volumetry else None
+
+    if cache_dir is not None:
+        run_all_cached(run_kwargs, {k: v for k, v in output_folders.items() if v is not None}, plans_dir, pp_pkl_file)
+        return
 
-    # Run inference
-    inference_duration = run_inference(dataset_id, input_dir, output_dir, config, trainer, plan, folds_list, np, cpu)
+    # with --resume, records which subjects every stage finished so that only the others are processed
+    manifest = None
+    if resume:
+        manifest = RunManifest(input_dir, get_file_ending(plans_dir),
+                               {k: v for k, v in output_folders.items() if v is not None})
+        manifest.set_fingerprints(get_stage_fingerprints(run_kwargs, plans_dir, pp_pkl_file, manifest.hash_file))
+    try:
+        if in_process:
+            in_lut, out_lut = get_lut_paths() if reorder_labels else (None, None)
+            stages = [k for k, v in output_folders.items() if v is not None]
+            stage_input_dir = manifest.start(stages) if manifest is not None else input_dir
+            if stage_input_dir is not None:
+                with span("run_in_process"):
+                    run_in_process(stage_input_dir, output_folders, plans_dir, folds_list, np, cpu, pp_pkl_file,
+                                   in_lut, out_lut, resident_folds, fuse_folds, fold_workers, fold_devices_list,
+                                   tile_batch_size, batched_tta, tta_subset, skip_empty_tiles, max_tiles,
+                                   target_latency, refine_threshold, cpu_precision, int8, backend,
+                                   accumulate_folds_on_device, max_memory, memmap_dir, volumetry_file)
+                if manifest is not None:
+                    manifest.finish(stages)
+            return
 
-    # Apply post-processing
-    post_processing_duration = apply_post_processing(output_dir, output_pp_dir, pp_pkl_file, np, plans_json_file)
+        # Ensure directories exist
+        output_dir.mkdir(parents=True, exist_ok=True)
+        output_pp_dir.mkdir(parents=True, exist_ok=True)
+        if reorder_labels:
+            output_pp_reo_dir.mkdir(parents=True, exist_ok=True)
 
-    # Reorder label maps to Freesurfer's lookuptable
-    if reorder_labels:
-        print("Reordering label maps to Freesurfer's lookuptable...")
-        in_lut = os.path.join(gouhfi_home, 'misc/gouhfi_v2p0_brain_labels_lut.txt')
-        out_lut = os.path.join(gouhfi_home, 'misc/freesurfer_brain_labels_lut.txt')
-        reordering_duration = apply_reordering(input_dir=output_pp_dir, output_dir=output_pp_reo_dir, in_lut=in_lut, out_lut=out_lut)
 
+        # Run inference
+        stage_input_dir = manifest.start(["raw"]) if manifest is not None else input_dir
+        if stage_input_dir is not None:
+            with span("run_inference"):
+                inference_duration, returncode = run_inference(dataset_id, stage_input_dir, output_dir, config, trainer, plan,
+                                                   folds_list, np, cpu, resident_folds, fuse_folds, fold_workers,
+                                                   fold_devices_list, tile_batch_size, batched_tta, tta_subset,
+                                                   skip_empty_tiles, max_tiles, target_latency, refine_threshold,
+                                                   cpu_precision, int8, backend, accumulate_folds_on_device,
+                                                   max_memory, memmap_dir)
+            if manifest is not None:
+                # outputs of a failed run may be incomplete
+                manifest.finish(["raw"], verify_outputs=returncode != 0)
+
+        # Apply post-processing and reorder label maps to Freesurfer's lookuptable, reading every raw prediction once
+        label_stages = ["postpro", "reordered"] if reorder_labels else ["postpro"]
+        stage_input_dir = manifest.start(label_stages, source_stage="raw") if manifest is not None else output_dir
+        if stage_input_dir is not None:
+            in_lut, out_lut = get_lut_paths()
+            with span("run_postprocessing"):
+                post_processing_duration, returncode = apply_label_stages(stage_input_dir, output_pp_dir,
+                                                              output_pp_reo_dir if reorder_labels else None,
+                                                              pp_pkl_file, np, plans_json_file, in_lut, out_lut,
+                                                              volumetry_file)
+            if manifest is not None:
+                manifest.finish(label_stages, verify_outputs=returncode != 0)
+    finally:
+        if manifest is not None:
+            manifest.cleanup()
+
+
+# run_all arguments that change the label maps and are therefore part of the cache key and of the manifests'
+# fingerprints. The others only change the speed. max_memory allows the export to resample non-linearly in slabs, which
+# is approximate (see export_prediction_from_logits)
+CACHE_KEY_SETTINGS = ("dataset_id", "config", "trainer", "plan", "folds", "reorder_labels", "cpu", "fuse_folds",
+                      "tta_subset", "skip_empty_tiles", "max_tiles", "refine_threshold", "cpu_precision", "int8",
+                      "backend", "max_memory")
+
+
+def get_file_ending(plans_dir):
+    with open(plans_dir / "dataset.json", "r") as f:
+        return json.load(f)["file_ending"]
+
+
+def get_stage_model_files(run_kwargs, plans_dir, pp_pkl_file):
+    """Files the label maps of every stage depend on besides the input images and the previous stages"""
+    folds = run_kwargs["folds"].split()
+    raw_files = [plans_dir / "plans.json", plans_dir / "dataset.json"]
+    if run_kwargs["backend"] == "torch":
+        raw_files += [plans_dir / f"fold_{f}" / get_checkpoint_name(run_kwargs["int8"]) for f in folds]
+    else:
+        exported_dir = plans_dir / "exported"
+        raw_files += [exported_dir / f for f in os.listdir(exported_dir) if f != "export.json"]
+    return {"raw": [str(i) for i in raw_files], "postpro": [str(pp_pkl_file)],
+            "reordered": list(get_lut_paths()) if run_kwargs["reorder_labels"] else []}
+
+
+def get_stage_fingerprints(run_kwargs, plans_dir, pp_pkl_file, hash_file):
+    """
+    Fingerprint of the label maps of every stage: the hashes of its model files (hash_file) and of the previous stage's
+    fingerprint, and for the raw predictions the settings that change them.
+    """
+    from run_inference.gouhfi_cache import hash_json
+
+    settings = {k: run_kwargs[k] for k in CACHE_KEY_SETTINGS if k != "reorder_labels"}
+    settings["folds"] = run_kwargs["folds"].split()
+    # not part of the cache key (--target_latency cannot be combined with --cache_dir), but it changes the label maps
+    settings["target_latency"] = run_kwargs["target_latency"]
+    fingerprints = {}
+    previous = settings
+    for stage, files in get_stage_model_files(run_kwargs, plans_dir, pp_pkl_file).items():
+        previous = fingerprints[stage] = hash_json({"previous": previous,
+                                                    "files": {os.path.basename(f): hash_file(f) for f in files}})
+    return fingerprints
+
+
+def run_all_cached(run_kwargs, output_folders, plans_dir, pp_pkl_file):
+    """
+    run_all with the result cache (see gouhfi_cache). The label maps of the subjects found in the cache are copied to
+    output_folders ({stage: folder}, only the stages written by this run). The other subjects are segmented by run_all
+    in a staging folder in the cache, added to the cache and moved to output_folders.
+    """
+    from run_inference.gouhfi_cache import ResultCache
+    from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
+
+    start_time = time.time()
+    cache = ResultCache(run_kwargs["cache_dir"],
+                        int(run_kwargs["cache_size"] * 1e9) if run_kwargs["cache_size"] is not None else None)
+    file_ending = get_file_ending(plans_dir)
+    model_files = [f for files in get_stage_model_files(run_kwargs, plans_dir, pp_pkl_file).values() for f in files]
+    settings = {k: run_kwargs[k] for k in CACHE_KEY_SETTINGS}
+    settings["folds"] = run_kwargs["folds"].split()
+    model_fingerprint = cache.get_model_fingerprint(model_files, settings)
+
+    list_of_lists = create_lists_from_splitted_dataset_folder(run_kwargs["input_dir"].rstrip("/"), file_ending)
+    misses = []
+    for image_files in list_of_lists:
+        case = os.path.basename(image_files[0])[:-(len(file_ending) + 5)]
+        key = cache.get_case_key(image_files, model_fingerprint)
+        if not cache.restore(key, {k: os.path.join(v, case + file_ending) for k, v in output_folders.items()}):
+            misses.append((case, key, image_files))
+    print(f"Result cache: {len(list_of_lists) - len(misses)} of {len(list_of_lists)} subjects restored from "
+          f"{cache.cache_dir}, {len(misses)} to segment.")
+
+    if len(misses) > 0:
+        staging_dir = Path(tempfile.mkdtemp(dir=cache.cache_dir, prefix="staging_"))
+        try:
+            staged_input_dir = staging_dir / "inputs"
+            staged_input_dir.mkdir()
+            for _, _, image_files in misses:
+                for f in image_files:
+                    os.symlink(os.path.abspath(f), staged_input_dir / os.path.basename(f))
+            staged_output_dir = staging_dir / "outputs"
+            staged_folders = {"raw": staged_output_dir, "postpro": staged_output_dir / "outputs_postpro",
+                              "reordered": staged_output_dir / "outputs_postpro_reo"}
+            run_all(**{**run_kwargs, "input_dir": str(staged_input_dir), "output_dir": str(staged_output_dir),
+                       "cache_dir": None, "cache_size": None})
+
+            for case, key, image_files in misses:
+                files = {k: str(staged_folders[k] / (case + file_ending)) for k in output_folders.keys()}
+                if not all(os.path.isfile(f) for f in files.values()):
+                    print(f"WARNING: {case} was not segmented, it is not added to the cache.")
+                    continue
+                cache.store(key, files, {"case": case, "images": [os.path.basename(i) for i in image_files]})
+                for k, f in files.items():
+                    Path(output_folders[k]).mkdir(parents=True, exist_ok=True)
+                    shutil.move(f, os.path.join(output_folders[k], case + file_ending))
+            if "raw" in output_folders.keys():
+                # dataset.json, plans.json, ... written next to the raw predictions
+                for f in os.listdir(staged_output_dir):
+                    if f.endswith(".json"):
+                        shutil.move(str(staged_output_dir / f), os.path.join(output_folders["raw"], f))
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    num_evicted = cache.evict()
+    if num_evicted > 0:
+        print(f"Result cache: removed the {num_evicted} least recently used entries.")
+    print(f"Cached run completed in {time.time() - start_time:.2f} seconds.")
 
 
 def main():
@@ -175,18 +496,99 @@ def main():
     parser.add_argument("--folds", default="0 1 2 3 4", help="Folds to use for inference. By default all folds are used and combined together.")
     parser.add_argument("--reorder_labels", action="store_true", help="Set flag if you want to reorder the label values from GOUHFI's values to the FreeSurfer lookuptable after post-processing.")
     parser.add_argument("--cpu", action="store_true", help="Set flag to use the CPU to run the inference. Expect a considerable increase in inference time.")
+    parser.add_argument("--in_process", "--in-process", action="store_true", help="Set flag to run inference, post-processing and label reordering in a single process. Segmentations are passed between the stages in memory and only the final label maps are written to disk.")
+    parser.add_argument("--save_intermediates", action="store_true", help="Only used with --in_process. Set flag to also write the raw predictions (and the post-processed label maps if --reorder_labels is set) to disk.")
+    parser.add_argument("--resident_folds", action="store_true", help="Set flag to keep one network per fold in memory instead of reloading the weights of every fold for every subject. Faster, mostly on CPU, but needs more (V)RAM.")
+    parser.add_argument("--fuse_folds", action="store_true", help="Only used with --resident_folds. Set flag to run all folds on the same tile in a single forward pass.")
+    parser.add_argument("--fold_workers", type=int, default=0, help="Number of background workers predicting the folds concurrently (e.g., 5 on a many-core CPU node). The CPU cores are split between the workers. Default: 0 (folds are predicted one after the other).")
+    parser.add_argument("--fold_devices", default=None, help="Space-separated string of devices to predict the folds concurrently with one worker per device (e.g., \"cuda:0 cuda:1\").")
+    parser.add_argument("--tile_batch_size", default="1", help="Number of patches predicted in one forward pass, or 'auto' to derive it from the free (V)RAM. Default: 1.")
+    parser.add_argument("--batched_tta", "--batched-tta", action="store_true", help="Set flag to predict a patch and all its mirrored versions (test-time augmentation) in a single forward pass. Faster, but needs more (V)RAM.")
+    parser.add_argument("--skip_empty_tiles", nargs="?", type=float, const=0.0, default=None, help="Set flag to skip the patches without brain (the images must be brain-extracted). An optional value skips the patches whose fraction of brain voxels is <= this value (faster, but approximate). Default: all patches are predicted.")
+    parser.add_argument("--tta_subset", "--tta-subset", default=None, help="Space-separated mirror axes combinations used for test-time augmentation, each with comma-separated axes (e.g., \"0 1 2\" only mirrors along single axes: 3 instead of 7 extra predictions). 'none' disables test-time augmentation. Default: all combinations.")
+    parser.add_argument("--max_tiles", type=int, default=None, help="Maximum number of patches per subject (and fold, unless --fuse_folds is set). The overlap between patches is reduced until they fit. Faster, but approximate. Default: no limit.")
+    parser.add_argument("--target_latency", type=float, default=None, help="Target inference time per subject in seconds. Converted to a maximum number of patches using the measured time per patch. Default: no limit.")
+    parser.add_argument("--refine_threshold", type=float, default=None, help="Set to predict with little overlap between patches first and then refine the patches where test-time augmentation changes more than this fraction of the voxels (e.g., 0.01). Default: no refinement.")
+    parser.add_argument("--cpu_precision", "--cpu-precision", default="fp32", choices=["fp32", "bf16", "auto"], help="Only used with --cpu. Precision of the network: bf16 is faster on CPUs with AMX or AVX512-BF16 support (e.g., Intel Xeon Sapphire Rapids or newer), 'auto' only uses it on these CPUs. Default: fp32.")
+    parser.add_argument("--int8", action="store_true", help="Only used with --cpu. Set flag to use the int8 quantized folds written by run_gouhfi_quantize. Faster, but approximate.")
+    parser.add_argument("--backend", default="torch", choices=["torch", "torchscript", "onnxruntime"], help="Runtime of the network. torchscript and onnxruntime use the folds exported by run_gouhfi_export (onnxruntime must be installed, see the onnx extra). The folds are then always kept in memory and --fuse_folds uses the exported fold average. Default: torch.")
+
+    parser.add_argument("--accumulate_folds_on_device", action="store_true", help="Set flag to sum the predictions of the folds in VRAM instead of RAM. Saves a transfer per fold, but needs more VRAM. Not used with --fold_workers/--fold_devices.")
+    parser.add_argument("--max_memory", "--max-memory", type=float, default=None, help="Memory budget in GB for the predictions of a subject. Larger predictions are kept in memory-mapped files (see --memmap_dir) and resampled slab by slab, so that very high resolution images (e.g., 0.5 mm whole-head) can be segmented on nodes with little RAM. Slower. Default: no limit.")
+    parser.add_argument("--memmap_dir", default=None, help="Only used with --max_memory. Directory for the memory-mapped predictions, preferably on a fast local disk. Default: the system's temp directory.")
+    parser.add_argument("--cache_dir", default=None, help="Directory of the result cache. The label maps of every subject are stored under the content hash of its image and the hashes of the model and of the settings that change the label maps, and subjects that are already in the cache are not segmented again. Cannot be combined with --target_latency. Default: no cache.")
+    parser.add_argument("--cache_size", type=float, default=20., help="Only used with --cache_dir. Maximum size of the cache in GB, the least recently used label maps are removed beyond it. Default: 20.")
+    parser.add_argument("--resume", action="store_true", help="Set flag to only process the subjects that are not finished yet in every stage, e.g. to continue a preempted or crashed run. Start the first run with --resume as well: only then does every output folder get a manifest (gouhfi_manifest.jsonl), recording the subjects written by every stage with the hashes of their images and of the model and settings, so subjects whose images, model or settings changed are processed again. Cannot be combined with --cache_dir.")
+    parser.add_argument("--volumetry", action="store_true", help="Set flag to also write the volumetry (absolute and TIV/BV-normalized volume of every label, see run_vol_extraction) of the post-processed label maps of all subjects to volumetry_brain.csv in the output directory. It is computed from the label maps in memory, without reading them again. Cannot be combined with --resume or --cache_dir.")
+    parser.add_argument("--telemetry", default=None, help="File the duration of every stage (reading, cropping, normalization, resampling, sliding window of every fold, mirroring, export resampling, post-processing, reordering, writing) of every subject is written to. See --telemetry_format. Default: no telemetry.")
+    parser.add_argument("--telemetry_format", default="jsonl", choices=["jsonl", "chrome"], help="Only used with --telemetry. jsonl writes one JSON object per line, chrome writes a trace that can be opened in chrome://tracing or https://ui.perfetto.dev. Default: jsonl.")
+    parser.add_argument("--telemetry_summary", action="store_true", help="Set flag to print the median, 90th and 99th percentile of the duration of every stage per subject at the end.")
 
     # Parse arguments
     args = parser.parse_args()
-    
+    if args.fuse_folds and not args.resident_folds and args.backend == "torch":
+        parser.error("--fuse_folds requires --resident_folds")
+    if args.int8 and not args.cpu:
+        parser.error("--int8 requires --cpu")
+    if args.int8 and args.fuse_folds:
+        parser.error("--int8 cannot be combined with --fuse_folds")
+    if args.backend != "torch" and (args.int8 or args.fold_workers > 0 or args.fold_devices is not None):
+        parser.error("--backend torchscript/onnxruntime cannot be combined with --int8, --fold_workers or --fold_devices")
+    if args.max_memory is not None and (args.fold_workers > 0 or args.fold_devices is not None or args.accumulate_folds_on_device):
+        parser.error("--max_memory cannot be combined with --fold_workers, --fold_devices or --accumulate_folds_on_device")
+    if args.resume and args.cache_dir is not None:
+        parser.error("--resume cannot be combined with --cache_dir")
+    if args.target_latency is not None and args.cache_dir is not None:
+        # the tile budget depends on the measured speed of the machine, the same key could hold different label maps
+        parser.error("--target_latency cannot be combined with --cache_dir, use --max_tiles instead")
+    if args.volumetry and (args.resume or args.cache_dir is not None):
+        parser.error("--volumetry cannot be combined with --resume or --cache_dir, use run_vol_extraction on the post-processed label maps instead")
+    if args.telemetry_format != "jsonl" and args.telemetry is None:
+        parser.error("--telemetry_format requires --telemetry")
+
+    spans_file = None
+    if args.telemetry is not None or args.telemetry_summary:
+        # every process appends its spans to the same JSON lines file, they are converted at the end
+        if args.telemetry is not None and args.telemetry_format == "jsonl":
+            spans_file = args.telemetry
+        else:
+            with tempfile.NamedTemporaryFile(suffix=".jsonl", delete=False) as f:
+                spans_file = f.name
+        enable_telemetry(spans_file)
+
     run_all(
         input_dir=args.input_dir,
         output_dir=args.output_dir,
         np=args.np,
         folds=args.folds,
         reorder_labels=args.reorder_labels,
-        cpu=args.cpu
+        cpu=args.cpu,
+        in_process=args.in_process,
+        save_intermediates=args.save_intermediates,
+        resident_folds=args.resident_folds,
+        fuse_folds=args.fuse_folds,
+        fold_workers=args.fold_workers,
+        fold_devices=args.fold_devices,
+        tile_batch_size=args.tile_batch_size,
+        batched_tta=args.batched_tta,
+        tta_subset=args.tta_subset,
+        skip_empty_tiles=args.skip_empty_tiles,
+        max_tiles=args.max_tiles,
+        target_latency=args.target_latency,
+        refine_threshold=args.refine_threshold,
+        cpu_precision=args.cpu_precision,
+        int8=args.int8,
+        backend=args.backend,
+        accumulate_folds_on_device=args.accumulate_folds_on_device,
+        max_memory=args.max_memory,
+        memmap_dir=args.memmap_dir,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+        resume=args.resume,
+        volumetry=args.volumetry
     )
+    if spans_file is not None:
+        report_telemetry(spans_file, args.telemetry, args.telemetry_format, args.telemetry_summary)
 
 
 if __name__ == "__main__":
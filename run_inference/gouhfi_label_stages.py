@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+#----------------------------------------------------------------------------------#
+# Copyright 2025 [Marc-Antoine Fortin, MR Physics, NTNU]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#---------------------------------------------------------------------------------#
+"""
+Label stages of GOUHFI applied to a segmentation in memory: post-processing (postprocessing.pkl), reordering to the
+FreeSurfer lookuptable and the voxel counts of every label for the volumetry (see data_utils/get_volume_values.py).
+
+Used by the in-process pipeline (gouhfi_pipeline) on the segmentations it predicts and by run_gouhfi_label_stages on a
+folder of raw predictions (run_gouhfi without --in_process). Every raw prediction is then read once and the
+post-processed and reordered label maps and the volumetry are computed from the same array, instead of
+nnUNetv2_apply_postprocessing, run_labels_reordering and run_vol_extraction each reading the previous stage from disk.
+"""
+import argparse
+import multiprocessing
+import os
+from collections import OrderedDict
+from typing import List, Union
+
+import nibabel as nib
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import load_json, load_pickle, subfiles, join, isfile, \
+    maybe_mkdir_p
+
+from data_utils.get_volume_values import count_labels, volumes_from_counts, load_label_mapping, VolumetryWriter, \
+    strip_nii_extension
+from data_utils.reorder_labels_freesurfer_lut import load_labels, create_mapping, reorder_label_array
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
+from nnunetv2.postprocessing.remove_connected_components import apply_postprocessing
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+from nnunetv2.utilities.telemetry import span, telemetry_case, case_from_file
+
+# label maps produced by the pipeline, in the order in which they are computed
+GOUHFI_STAGES = ('raw', 'postpro', 'reordered')
+
+# the volumetry is computed on GOUHFI's labels (CSF = 16, see get_volume_values)
+VOLUMETRY_TASK = 'brain'
+
+
+def run_label_stages(segmentation: np.ndarray, pp_fns: List, pp_fn_kwargs: List[dict],
+                     lut_mapping: Union[dict, None], return_label_counts: bool = False):
+    """
+    Runs post-processing and (optionally) the LUT reordering on a segmentation that is already in the original image
+    shape. Returns the label map of every stage, keyed by the names in GOUHFI_STAGES.
+    return_label_counts: also return the voxel count of every label of the post-processed label map (see count_labels).
+    The reordered label map has the same counts, under the new label IDs.
+    """
+    segmentations = OrderedDict()
+    segmentations['raw'] = segmentation
+    segmentations['postpro'] = apply_postprocessing(segmentation, pp_fns, pp_fn_kwargs)
+    if return_label_counts:
+        with span('volumetry'):
+            label_counts = count_labels(segmentations['postpro'])
+    if lut_mapping is not None:
+        segmentations['reordered'] = reorder_label_array(segmentations['postpro'], lut_mapping)
+    if return_label_counts:
+        return segmentations, label_counts
+    return segmentations
+
+
+def get_voxel_volume(properties: dict) -> float:
+    """
+    Voxel volume (mm³) of a label map written with properties, as run_vol_extraction reads it from the header of the
+    written file.
+    """
+    if 'nibabel_stuff' in properties.keys():
+        # nibabel derives the voxel sizes of the header from the affine
+        header = nib.Nifti1Image(np.zeros((1, 1, 1), dtype=np.uint8),
+                                 properties['nibabel_stuff']['original_affine']).header
+        return np.prod(header.get_zooms())
+    return np.prod(np.array(properties['spacing'], dtype=np.float32))
+
+
+def process_label_stages(segmentation_file: str, output_files: dict, image_reader_writer: BaseReaderWriter,
+                         pp_fns: List, pp_fn_kwargs: List[dict], lut_mapping: Union[dict, None]):
+    """
+    Reads a raw prediction, writes the label maps of the stages in output_files ({stage: file}, 'postpro' and/or
+    'reordered', None is not written) and returns the voxel counts of the labels of the post-processed label map and
+    its voxel volume.
+    """
+    with telemetry_case(case_from_file(segmentation_file)):
+        with span('read'):
+            seg, props = image_reader_writer.read_seg(segmentation_file)
+        segmentations, label_counts = run_label_stages(seg[0], pp_fns, pp_fn_kwargs,
+                                                       lut_mapping if output_files.get('reordered') else None,
+                                                       return_label_counts=True)
+        for stage in ('postpro', 'reordered'):
+            if output_files.get(stage) is not None:
+                with span('write', stage=stage):
+                    image_reader_writer.write_seg(segmentations[stage], output_files[stage], props)
+    return label_counts, get_voxel_volume(props)
+
+
+def apply_label_stages_to_folder(input_folder: str,
+                                 output_folders: dict,
+                                 pp_fns: List,
+                                 pp_fn_kwargs: List[dict],
+                                 lut_mapping: Union[dict, None] = None,
+                                 volumetry_file: Union[str, None] = None,
+                                 volumetry_label_map: Union[dict, None] = None,
+                                 plans_file_or_dict: Union[str, dict] = None,
+                                 dataset_json_file_or_dict: Union[str, dict] = None,
+                                 num_processes: int = 8) -> None:
+    """
+    output_folders: {stage: folder} for 'postpro' and/or 'reordered'. Stages mapped to None are not written.
+    volumetry_file: csv or parquet file the volumetry of the post-processed label maps is written to (see
+    get_volume_values). volumetry_label_map: label names, see load_label_mapping.
+    If plans_file_or_dict or dataset_json_file_or_dict are None, we will look for them in input_folder
+    """
+    output_folders = {k: v for k, v in output_folders.items() if v is not None}
+    assert len(output_folders) > 0 or volumetry_file is not None, 'Nothing to do: no output folder and no volumetry'
+    if 'reordered' in output_folders.keys():
+        assert lut_mapping is not None, 'Label reordering requires a lookuptable mapping'
+        # nnU-Net's reader/writers export segmentations as uint8
+        assert max(lut_mapping.values()) < 256, 'The target lookuptable has label values that do not fit into uint8 ' \
+                                                'and cannot be exported by the nnU-Net writers.'
+    if plans_file_or_dict is None:
+        plans_file_or_dict = join(input_folder, 'plans.json')
+    if dataset_json_file_or_dict is None:
+        dataset_json_file_or_dict = join(input_folder, 'dataset.json')
+    for f in (plans_file_or_dict, dataset_json_file_or_dict):
+        if not isinstance(f, dict) and not isfile(f):
+            raise RuntimeError(f"Expected file missing: {f}. It is written by nnUNetv2_predict next to the raw "
+                               f"predictions.")
+    plans_manager = PlansManager(plans_file_or_dict)
+    dataset_json = dataset_json_file_or_dict if isinstance(dataset_json_file_or_dict, dict) else \
+        load_json(dataset_json_file_or_dict)
+    rw = plans_manager.image_reader_writer_class()
+    file_ending = dataset_json['file_ending']
+
+    for folder in output_folders.values():
+        maybe_mkdir_p(folder)
+    files = subfiles(input_folder, suffix=file_ending, join=False)
+    with multiprocessing.get_context("spawn").Pool(num_processes) as p:
+        results = p.starmap(process_label_stages,
+                            zip(
+                                [join(input_folder, i) for i in files],
+                                [{k: join(v, i) for k, v in output_folders.items()} for i in files],
+                                [rw] * len(files),
+                                [pp_fns] * len(files),
+                                [pp_fn_kwargs] * len(files),
+                                [lut_mapping] * len(files)
+                            ))
+
+    if volumetry_file is not None:
+        write_volumetry(volumetry_file, [strip_nii_extension(i) for i in files], results, volumetry_label_map)
+
+
+def write_volumetry(volumetry_file: str, subjects: List[str], results: List[tuple], label_map: Union[dict, None]):
+    """results: (label counts, voxel volume) of every subject, see process_label_stages"""
+    maybe_mkdir_p(os.path.dirname(os.path.abspath(volumetry_file)))
+    writer = VolumetryWriter(volumetry_file, 'parquet' if volumetry_file.endswith('.parquet') else 'csv')
+    try:
+        for subject, (label_counts, voxel_volume) in zip(subjects, results):
+            writer.write(volumes_from_counts(subject, label_counts, label_map or {}, voxel_volume, VOLUMETRY_TASK))
+    finally:
+        writer.close()
+    print(f"Volumetry saved to: {volumetry_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post-processes GOUHFI's raw predictions, reorders their labels to "
+                                                 "the FreeSurfer lookuptable and extracts their volumetry, reading "
+                                                 "every prediction once.")
+    parser.add_argument('-i', '--input_dir', type=str, required=True,
+                        help="Folder with the raw predictions (and the plans.json and dataset.json written by "
+                             "nnUNetv2_predict).")
+    parser.add_argument('-o', '--output_dir', type=str, required=False, default=None,
+                        help="Folder the post-processed label maps are written to. Default: not written.")
+    parser.add_argument('--reordered_dir', type=str, required=False, default=None,
+                        help="Folder the post-processed label maps reordered to the FreeSurfer lookuptable are written "
+                             "to. Default: not written.")
+    parser.add_argument('--volumetry', type=str, required=False, default=None,
+                        help="File (.csv or .parquet) the volumetry of the post-processed label maps is written to. "
+                             "Default: not computed.")
+    parser.add_argument('--pp_pkl_file', type=str, required=True, help="postprocessing.pkl file.")
+    parser.add_argument('--old_labels_file', type=str, required=False, default=None,
+                        help="GOUHFI's lookuptable. Used for the label names of the volumetry and the reordering. "
+                             "Default: $GOUHFI_HOME/misc/gouhfi_v2p0_brain_labels_lut.txt.")
+    parser.add_argument('--new_labels_file', type=str, required=False, default=None,
+                        help="FreeSurfer/new lookuptable, required by --reordered_dir.")
+    parser.add_argument('--plans_json', type=str, required=False, default=None,
+                        help="plans file to use. Default: input_dir/plans.json")
+    parser.add_argument('--dataset_json', type=str, required=False, default=None,
+                        help="dataset.json file to use. Default: input_dir/dataset.json")
+    parser.add_argument('--np', type=int, required=False, default=default_num_processes,
+                        help=f"number of processes to use. Default: {default_num_processes}")
+    args = parser.parse_args()
+
+    if args.output_dir is None and args.reordered_dir is None and args.volumetry is None:
+        parser.error("Nothing to do: set -o, --reordered_dir and/or --volumetry")
+    if args.reordered_dir is not None and args.new_labels_file is None:
+        parser.error("--reordered_dir requires --new_labels_file")
+    old_labels_file = args.old_labels_file if args.old_labels_file is not None else \
+        os.path.expandvars("$GOUHFI_HOME/misc/gouhfi_v2p0_brain_labels_lut.txt")
+
+    pp_fns, pp_fn_kwargs = load_pickle(args.pp_pkl_file)
+    lut_mapping = create_mapping(load_labels(old_labels_file), load_labels(args.new_labels_file)) \
+        if args.reordered_dir is not None else None
+    apply_label_stages_to_folder(args.input_dir, {'postpro': args.output_dir, 'reordered': args.reordered_dir},
+                                 pp_fns, pp_fn_kwargs, lut_mapping, args.volumetry,
+                                 load_label_mapping(old_labels_file) if args.volumetry is not None else None,
+                                 args.plans_json, args.dataset_json, args.np)
+
+
+if __name__ == '__main__':
+    main()
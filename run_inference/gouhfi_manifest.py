@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+#----------------------------------------------------------------------------------#
+# Copyright 2025 [Marc-Antoine Fortin, MR Physics, NTNU]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#---------------------------------------------------------------------------------#
+"""
+Manifests of the output folders of run_gouhfi, used by run_gouhfi --resume.
+
+Every output folder gets a gouhfi_manifest.jsonl to which run_gouhfi appends one JSON line per event:
+- 'start': a stage starts on a list of subjects. It holds the fingerprint of the stage (hashes of the checkpoints,
+  plans, postprocessing.pkl, lookuptables and the settings that change the label maps, see run_all) and the digest of
+  the input images of every subject.
+- 'done': the label map of a subject was written. It holds the fingerprint, the digest of the input images, their
+  hashes and the size and modification time of the label map.
+
+The manifests are only kept by runs started with --resume. A subject is finished in a stage if its last 'done' record
+has the current fingerprint and input digest and its label map was not changed since. Once a stage returns, the label
+maps it wrote are recorded from their size and modification time. Label maps written by a run that was interrupted
+before it could record them (preempted, crashed) are adopted if that run started the subject with the same fingerprint
+and inputs, the label map was written after that start and it is complete (the gzip stream can be read to its end).
+Only the subjects that are not finished are processed, stage by stage.
+"""
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from run_inference.gouhfi_cache import hash_file, hash_json
+
+MANIFEST_FILE_NAME = 'gouhfi_manifest.jsonl'
+
+# modification times of some file systems are only accurate to a few seconds
+MTIME_SLACK_NS = int(2e9)
+
+
+def is_complete_file(file_name):
+    """True if the file can be read to its end. Gzip streams are checked against their length and checksum."""
+    try:
+        if file_name.endswith('.gz'):
+            with gzip.open(file_name, 'rb') as f:
+                while f.read(2 ** 24):
+                    pass
+        else:
+            import nibabel as nib
+            nib.load(file_name).get_fdata()
+        return True
+    except Exception:
+        return False
+
+
+class RunManifest(object):
+    def __init__(self, input_dir, file_ending, output_folders):
+        """
+        input_dir: folder with the input images ({SUBJECT_ID}_0000{file_ending}).
+        output_folders: {stage: folder} of the stages written by this run. One manifest is kept per folder.
+        """
+        from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
+
+        self.input_dir = os.path.abspath(input_dir)
+        self.file_ending = file_ending
+        self.images = {os.path.basename(i[0])[:-(len(file_ending) + 5)]: i
+                       for i in create_lists_from_splitted_dataset_folder(self.input_dir, file_ending)}
+        self.output_folders = {k: str(v) for k, v in output_folders.items()}
+        self.records = {stage: self._load(folder) for stage, folder in self.output_folders.items()}
+        # path -> (size, mtime_ns, sha256) of every file hashed by previous runs, so that unchanged files are not hashed
+        # again
+        self.hash_memo = {}
+        for records in self.records.values():
+            for r in records:
+                self.hash_memo.update({k: tuple(v) for k, v in r.get('files', {}).items()})
+        self.hashed_files = {}
+        self.model_file_hashes = {}
+        self.fingerprints = {}
+        self.input_digests = None
+        # {stage: time_ns} of the start of every stage by this run
+        self.start_times = {}
+        self.staging_dir = None
+
+    @staticmethod
+    def _load(folder):
+        manifest_file = os.path.join(folder, MANIFEST_FILE_NAME)
+        if not os.path.isfile(manifest_file):
+            return []
+        records = []
+        with open(manifest_file, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # last line of an interrupted run
+                    pass
+        return records
+
+    def _append(self, stage, records):
+        os.makedirs(self.output_folders[stage], exist_ok=True)
+        with open(os.path.join(self.output_folders[stage], MANIFEST_FILE_NAME), 'a') as f:
+            f.write(''.join(json.dumps(r) + '\n' for r in records))
+        self.records[stage].extend(records)
+
+    def hash_file(self, file_name):
+        """sha256 of the file, reused from the manifests if its size and modification time did not change"""
+        file_name = os.path.abspath(str(file_name))
+        stat = os.stat(file_name)
+        memo = self.hash_memo.get(file_name)
+        if memo is None or memo[0] != stat.st_size or memo[1] != stat.st_mtime_ns:
+            memo = (stat.st_size, stat.st_mtime_ns, hash_file(file_name))
+            self.hash_memo[file_name] = memo
+        self.hashed_files[file_name] = memo
+        return memo[2]
+
+    def set_fingerprints(self, fingerprints):
+        """{stage: fingerprint} of every stage. The model files must have been hashed with hash_file before"""
+        self.fingerprints = fingerprints
+        # only the model files are recorded with the start of a stage, the images with every subject
+        self.model_file_hashes = dict(self.hashed_files)
+        self.input_digests = {case: hash_json([self.hash_file(i) for i in images])
+                              for case, images in self.images.items()}
+
+    def _output_file(self, stage, case):
+        return os.path.join(self.output_folders[stage], case + self.file_ending)
+
+    def get_finished(self, stage, verify=True):
+        """
+        Subjects whose label map of stage is up to date. Label maps written after a start of the subject are adopted if
+        they are complete (see is_complete_file). Without verify, label maps written since this run started the stage
+        are adopted without checking them.
+        """
+        fingerprint = self.fingerprints[stage]
+        done, started_at = {}, {}
+        for r in self.records[stage]:
+            if r.get('fingerprint') != fingerprint:
+                continue
+            if r['event'] == 'done':
+                done[r['case']] = r
+            elif r['event'] == 'start':
+                for case, digest in r['cases'].items():
+                    started_at[case] = (digest, r['time_ns'])
+
+        finished, adopted = set(), []
+        for case, digest in self.input_digests.items():
+            output_file = self._output_file(stage, case)
+            if not os.path.isfile(output_file):
+                continue
+            stat = os.stat(output_file)
+            r = done.get(case)
+            if r is not None and r['inputs_digest'] == digest and r['output_size'] == stat.st_size and \
+                    r['output_mtime_ns'] == stat.st_mtime_ns:
+                finished.add(case)
+            elif case in started_at and started_at[case][0] == digest and \
+                    stat.st_mtime_ns >= started_at[case][1] - MTIME_SLACK_NS and \
+                    ((not verify and stat.st_mtime_ns >= self.start_times.get(stage, float('inf')) - MTIME_SLACK_NS) or
+                     is_complete_file(output_file)):
+                finished.add(case)
+                adopted.append(self._get_done_record(stage, case, stat))
+        if len(adopted) > 0:
+            self._append(stage, adopted)
+        return finished
+
+    def _get_done_record(self, stage, case, stat):
+        return {'event': 'done', 'stage': stage, 'case': case, 'fingerprint': self.fingerprints[stage],
+                'inputs_digest': self.input_digests[case],
+                'files': {os.path.abspath(i): self.hash_memo[os.path.abspath(i)] for i in self.images[case]},
+                'output_size': stat.st_size, 'output_mtime_ns': stat.st_mtime_ns, 'time': time.time()}
+
+    def start(self, stages, source_stage=None):
+        """
+        Records the start of stages (processed together, e.g. in-process) and returns a folder with links to their
+        inputs (the input images or the label maps of source_stage) for the subjects that are not finished in all of
+        stages, or None if there are none.
+        """
+        cases = sorted(self.images.keys())
+        finished = set.intersection(*[self.get_finished(s) for s in stages])
+        print(f"Resume: {', '.join(stages)} finished for {len(finished)} of {len(cases)} subjects, "
+              f"{len(cases) - len(finished)} to process.")
+        cases = [i for i in cases if i not in finished]
+        if len(cases) == 0:
+            return None
+
+        time_ns = time.time_ns()
+        for stage in stages:
+            self.start_times[stage] = time_ns
+            self._append(stage, [{'event': 'start', 'stage': stage, 'fingerprint': self.fingerprints[stage],
+                                  'cases': {i: self.input_digests[i] for i in cases}, 'time_ns': time_ns,
+                                  'files': self.model_file_hashes}])
+        source_folder = self.output_folders[source_stage] if source_stage is not None else self.input_dir
+        if self.staging_dir is None:
+            self.staging_dir = tempfile.mkdtemp(prefix='gouhfi_resume_')
+        staged_folder = tempfile.mkdtemp(dir=self.staging_dir, prefix=f"{'_'.join(stages)}_")
+        for case in cases:
+            files = self.images[case] if source_stage is None else [self._output_file(source_stage, case)]
+            for f in files:
+                os.symlink(os.path.abspath(f), os.path.join(staged_folder, os.path.basename(f)))
+        if source_stage is not None:
+            # plans.json and dataset.json written by nnUNetv2_predict
+            for f in os.listdir(source_folder):
+                if f.endswith('.json'):
+                    os.symlink(os.path.join(os.path.abspath(source_folder), f), os.path.join(staged_folder, f))
+        return staged_folder
+
+    def finish(self, stages, verify_outputs=False):
+        """
+        Records the label maps written since start(stages) from their size and modification time. verify_outputs: only
+        record complete label maps (decodes them), for stages that did not return successfully.
+        Returns the subjects that are not finished.
+        """
+        unfinished = set()
+        for stage in stages:
+            unfinished |= set(self.images.keys()) - self.get_finished(stage, verify_outputs)
+        if len(unfinished) > 0:
+            print(f"WARNING: {', '.join(stages)} did not finish for {len(unfinished)} subjects: "
+                  f"{', '.join(sorted(unfinished))}")
+        return unfinished
+
+    def cleanup(self):
+        if self.staging_dir is not None:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+            self.staging_dir = None
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+#----------------------------------------------------------------------------------#
+# Copyright 2025 [Marc-Antoine Fortin, MR Physics, NTNU]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This file is based from the nnUNet v2 framework (https://github.com/MIC-DKFZ/nnUNet)
+# under the terms of the Apache License, Version 2.0.
+#---------------------------------------------------------------------------------#
+"""
+In-process GOUHFI pipeline: inference, post-processing and label reordering without the three chained CLIs.
+
+One nnUNetPredictor is built for the whole run and each case's segmentation is piped through post-processing and LUT
+reordering in memory (see gouhfi_label_stages). Only the label maps of the requested stages are written to disk. The
+volumetry is computed from the same post-processed label maps.
+"""
+import multiprocessing
+import os
+from collections import OrderedDict
+from functools import partial
+from time import sleep
+from typing import List, Union, Tuple
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import load_pickle, join, maybe_mkdir_p, save_json
+
+from data_utils.reorder_labels_freesurfer_lut import load_labels, create_mapping
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape, \
+    initialize_export_worker, get_export_worker_state
+from nnunetv2.inference.fold_parallel import nnUNetFoldParallelPredictor
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.sliding_window_prediction import compute_gaussian
+from nnunetv2.utilities.file_path_utilities import check_workers_alive_and_busy
+from nnunetv2.utilities.helpers import empty_cache, get_peak_rss, create_shared_memory_tensor, \
+    get_shared_memory_descriptor, open_shared_memory_array, close_shared_memory, release_shared_memory, \
+    release_finished_shared_memory
+from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.telemetry import span, telemetry_case, set_telemetry_case, case_from_file
+from run_inference.gouhfi_label_stages import GOUHFI_STAGES, run_label_stages, get_voxel_volume, write_volumetry
+
+def export_gouhfi_stages_from_logits(predicted_logits: Union[np.ndarray, torch.Tensor], properties_dict: dict,
+                                     configuration_manager: ConfigurationManager, plans_manager: PlansManager,
+                                     dataset_json: dict, pp_fns: List, pp_fn_kwargs: List[dict],
+                                     lut_mapping: Union[dict, None], output_files: dict,
+                                     max_memory: Union[int, None] = None) -> Tuple[int, np.ndarray, float]:
+    """
+    output_files maps stage names (see GOUHFI_STAGES) to the file the label map of that stage is written to. Stages
+    that are missing or None are computed in memory (if needed by a later stage) but never written.
+    max_memory: resample and convert the logits in slabs within this budget (bytes, see
+    convert_predicted_logits_to_segmentation_with_correct_shape).
+    Returns the peak RAM (bytes) of the calling process, so that export workers can report it, and the voxel counts of
+    the labels of the post-processed label map and its voxel volume for the volumetry.
+    """
+    label_manager = plans_manager.get_label_manager(dataset_json)
+    segmentation = convert_predicted_logits_to_segmentation_with_correct_shape(
+        predicted_logits, plans_manager, configuration_manager, label_manager, properties_dict,
+        max_memory=max_memory
+    )
+    del predicted_logits
+
+    segmentations, label_counts = run_label_stages(segmentation, pp_fns, pp_fn_kwargs, lut_mapping,
+                                                   return_label_counts=True)
+    rw = plans_manager.image_reader_writer_class()
+    for stage, seg in segmentations.items():
+        if output_files.get(stage) is not None:
+            with span('write', stage=stage):
+                rw.write_seg(seg, output_files[stage], properties_dict)
+    return get_peak_rss(), label_counts, get_voxel_volume(properties_dict)
+
+
+def export_gouhfi_stages_from_shared_logits(shared_logits: dict, properties_dict: dict,
+                                            output_files: dict) -> Tuple[int, np.ndarray, float]:
+    """
+    export_gouhfi_stages_from_logits for export workers initialized with initialize_export_worker (with pp_fns,
+    pp_fn_kwargs and lut_mapping). shared_logits describes logits in shared memory (see get_shared_memory_descriptor).
+    """
+    state = get_export_worker_state()
+    block, predicted_logits = open_shared_memory_array(shared_logits)
+    try:
+        with telemetry_case(case_from_file(next(i for i in output_files.values() if i is not None))):
+            return export_gouhfi_stages_from_logits(predicted_logits, properties_dict, state['configuration_manager'],
+                                                    state['plans_manager'], state['dataset_json'], state['pp_fns'],
+                                                    state['pp_fn_kwargs'], state['lut_mapping'], output_files)
+    finally:
+        del predicted_logits
+        close_shared_memory(block)
+
+
+class GouhfiPipeline(object):
+    def __init__(self,
+                 model_training_output_dir: str,
+                 use_folds: Union[List[Union[int, str]], None],
+                 checkpoint_name: str = 'checkpoint_best.pth',
+                 pp_pkl_file: Union[str, None] = None,
+                 in_lut: Union[str, None] = None,
+                 out_lut: Union[str, None] = None,
+                 device: torch.device = torch.device('cuda'),
+                 verbose: bool = False,
+                 allow_tqdm: bool = True,
+                 keep_folds_resident: bool = False,
+                 fuse_folds: bool = False,
+                 fold_workers: int = 0,
+                 fold_devices: Union[List[str], None] = None,
+                 tile_batch_size: Union[int, str] = 1,
+                 batched_tta: bool = False,
+                 tta_subset: Union[List[Tuple[int, ...]], None] = None,
+                 tile_skip_threshold: Union[float, None] = None,
+                 max_tiles: Union[int, None] = None,
+                 target_latency: Union[float, None] = None,
+                 refine_threshold: Union[float, None] = None,
+                 cpu_precision: str = 'fp32',
+                 backend: str = 'torch',
+                 export_dir: Union[str, None] = None,
+                 accumulate_folds_on_device: bool = False,
+                 max_memory: Union[int, None] = None,
+                 memmap_dir: Union[str, None] = None):
+        """
+        pp_pkl_file is the postprocessing.pkl written by nnUNetv2_determine_postprocessing. If None, the 'postpro' stage
+        is identical to the raw prediction.
+        in_lut/out_lut are GOUHFI's and the target lookuptables. Label reordering is only done if both are given.
+        keep_folds_resident/fuse_folds: see nnUNetPredictor.
+        fold_workers/fold_devices: predict the folds concurrently in background workers (see
+        nnUNetFoldParallelPredictor). 0 and None means the folds are predicted one after the other.
+        tile_batch_size: number of sliding window tiles per forward pass, or 'auto' (see nnUNetPredictor).
+        batched_tta/tta_subset: see batched_mirroring and mirror_axes_combinations in nnUNetPredictor.
+        tile_skip_threshold: skip patches with foreground fraction <= tile_skip_threshold (see nnUNetPredictor). GOUHFI's
+        inputs are brain-extracted, so the background is 0. None predicts all patches.
+        max_tiles/target_latency/refine_threshold: tile budget and coarse-then-refine prediction (see nnUNetPredictor).
+        cpu_precision: 'fp32', 'bf16' or 'auto', precision of the network on CPU (see nnUNetPredictor).
+        backend: 'torch' runs the checkpoints. 'torchscript' and 'onnxruntime' run the networks exported to export_dir
+        (default: model_training_output_dir/exported, see run_gouhfi_export) instead. The folds are then always
+        resident, fuse_folds uses the exported fold average and fold workers are not supported.
+        accumulate_folds_on_device: sum the logits of the folds in VRAM (see nnUNetPredictor). Not used by fold
+        workers.
+        max_memory/memmap_dir: memory budget (bytes) for the logits. Larger logits are memory mapped and resampled in
+        slabs (see nnUNetPredictor). predict_from_files then exports in the main process. Not supported with fold
+        workers.
+        """
+        assert backend == 'torch' or (fold_workers == 0 and fold_devices is None), \
+            'fold_workers and fold_devices require the torch backend'
+        assert max_memory is None or (fold_workers == 0 and fold_devices is None), \
+            'max_memory cannot be combined with fold_workers or fold_devices'
+        if fold_workers > 0 or fold_devices is not None:
+            self.predictor = nnUNetFoldParallelPredictor(tile_step_size=0.5,
+                                                         use_gaussian=True,
+                                                         use_mirroring=True,
+                                                         perform_everything_on_device=True,
+                                                         device=device,
+                                                         verbose=verbose,
+                                                         verbose_preprocessing=verbose,
+                                                         allow_tqdm=allow_tqdm,
+                                                         tile_batch_size=tile_batch_size,
+                                                         batched_mirroring=batched_tta,
+                                                         mirror_axes_combinations=tta_subset,
+                                                         tile_skip_threshold=tile_skip_threshold,
+                                                         max_tiles=max_tiles,
+                                                         target_latency=target_latency,
+                                                         refine_threshold=refine_threshold,
+                                                         cpu_precision=cpu_precision,
+                                                         num_fold_workers=fold_workers if fold_workers > 0 else None,
+                                                         fold_devices=fold_devices)
+        else:
+            self.predictor = nnUNetPredictor(tile_step_size=0.5,
+                                             use_gaussian=True,
+                                             use_mirroring=True,
+                                             perform_everything_on_device=True,
+                                             device=device,
+                                             verbose=verbose,
+                                             verbose_preprocessing=verbose,
+                                             allow_tqdm=allow_tqdm,
+                                             keep_folds_resident=keep_folds_resident or backend != 'torch',
+                                             fuse_folds=fuse_folds,
+                                             tile_batch_size=tile_batch_size,
+                                             batched_mirroring=batched_tta,
+                                             mirror_axes_combinations=tta_subset,
+                                             tile_skip_threshold=tile_skip_threshold,
+                                             max_tiles=max_tiles,
+                                             target_latency=target_latency,
+                                             refine_threshold=refine_threshold,
+                                             cpu_precision=cpu_precision,
+                                             accumulate_folds_on_device=accumulate_folds_on_device,
+                                             max_memory=max_memory,
+                                             memmap_dir=memmap_dir)
+        if backend == 'torch':
+            self.predictor.initialize_from_trained_model_folder(model_training_output_dir, use_folds, checkpoint_name)
+        else:
+            self.predictor.initialize_from_exported_model(
+                export_dir if export_dir is not None else join(model_training_output_dir, 'exported'), use_folds,
+                backend)
+
+        if pp_pkl_file is not None:
+            self.pp_fns, self.pp_fn_kwargs = load_pickle(pp_pkl_file)
+        else:
+            self.pp_fns, self.pp_fn_kwargs = [], []
+
+        if in_lut is not None and out_lut is not None:
+            self.lut_mapping = create_mapping(load_labels(in_lut), load_labels(out_lut))
+            # nnU-Net's reader/writers export segmentations as uint8
+            assert max(self.lut_mapping.values()) < 256, 'The target lookuptable has label values that do not fit ' \
+                                                         'into uint8 and cannot be exported by the nnU-Net writers.'
+        else:
+            self.lut_mapping = None
+
+        self.file_ending = self.predictor.dataset_json['file_ending']
+        # peak RAM (bytes) per stage of the last case (segment_preprocessed_case) or run (predict_from_files)
+        self.memory_stats = None
+
+    @property
+    def stages(self) -> tuple:
+        """Stages (see GOUHFI_STAGES) this pipeline can produce"""
+        return tuple(i for i in GOUHFI_STAGES if i != 'reordered' or self.lut_mapping is not None)
+
+    def warm_up(self) -> None:
+        """
+        Predicts a single empty tile with every fold so that lazy initializations (gaussian, allocator, kernel
+        selection) are not paid by the first real case.
+        """
+        num_input_channels = determine_num_input_channels(self.predictor.plans_manager,
+                                                          self.predictor.configuration_manager,
+                                                          self.predictor.dataset_json)
+        data = torch.zeros((num_input_channels, *self.predictor.configuration_manager.patch_size), dtype=torch.float32)
+        self.predictor.predict_logits_from_preprocessed_data(data)
+
+    def preprocess_files(self, image_files: List[str]):
+        """
+        Preprocesses a single case in the calling process. Returns the data and the properties needed to export the
+        label maps.
+        """
+        preprocessor = self.predictor.configuration_manager.preprocessor_class(verbose=self.predictor.verbose_preprocessing)
+        data, _, properties = preprocessor.run_case(image_files, None, self.predictor.plans_manager,
+                                                    self.predictor.configuration_manager, self.predictor.dataset_json)
+        return torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format), properties
+
+    def preprocess_array(self, image: np.ndarray, properties: dict):
+        """
+        Same as preprocess_files but for an image that is already in memory. image must be (c, x, y, z) in the axis
+        ordering of the model's reader/writer and properties must have a 'spacing' key (see
+        nnUNetPredictor.predict_single_npy_array)
+        """
+        preprocessor = self.predictor.configuration_manager.preprocessor_class(verbose=self.predictor.verbose_preprocessing)
+        properties = dict(properties)
+        data, _ = preprocessor.run_case_npy(image, None, properties, self.predictor.plans_manager,
+                                            self.predictor.configuration_manager, self.predictor.dataset_json)
+        return torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format), properties
+
+    def write_stages(self, segmentations: dict, output_files: dict, properties: dict) -> None:
+        """
+        Writes the label maps returned by segment_preprocessed_case. output_files maps stage names to file names,
+        stages mapped to None (or missing) are not written.
+        """
+        rw = self.predictor.plans_manager.image_reader_writer_class()
+        for stage, output_file in output_files.items():
+            if output_file is not None:
+                maybe_mkdir_p(os.path.dirname(os.path.abspath(output_file)))
+                rw.write_seg(segmentations[stage], output_file, properties)
+
+    def segment_preprocessed_case(self, data: torch.Tensor, properties: dict) -> OrderedDict:
+        """
+        Runs every stage on a case preprocessed by the predictor's preprocessor and returns the label maps of all
+        stages (see GOUHFI_STAGES) in the original image shape. The peak RAM of the process (and of the fold workers
+        for the prediction) after each step is stored in self.memory_stats.
+        """
+        predicted_logits = self.predictor.predict_logits_from_preprocessed_data(data).cpu()
+        # the fold workers of nnUNetFoldParallelPredictor are included in the memory_stats of the predictor
+        memory_stats = {'prediction': max(get_peak_rss(), self.predictor.memory_stats['peak_rss'])}
+        segmentation = convert_predicted_logits_to_segmentation_with_correct_shape(
+            predicted_logits, self.predictor.plans_manager, self.predictor.configuration_manager,
+            self.predictor.label_manager, properties, max_memory=self.predictor.max_memory
+        )
+        del predicted_logits
+        memory_stats['export'] = get_peak_rss()
+        segmentations = run_label_stages(segmentation, self.pp_fns, self.pp_fn_kwargs, self.lut_mapping)
+        memory_stats['postpro'] = get_peak_rss()
+        self.memory_stats = memory_stats
+        return segmentations
+
+    def predict_from_files(self,
+                           source_folder: str,
+                           output_folders: dict,
+                           num_processes_preprocessing: int = default_num_processes,
+                           num_processes_segmentation_export: int = default_num_processes,
+                           volumetry_file: Union[str, None] = None,
+                           volumetry_label_map: Union[dict, None] = None):
+        """
+        output_folders maps stage names (see GOUHFI_STAGES) to the folder the label maps of that stage are written to.
+        Stages mapped to None (or missing) are not written.
+        volumetry_file: csv or parquet file the volumetry of the post-processed label maps is written to (see
+        write_volumetry). volumetry_label_map: label names, see get_volume_values.load_label_mapping.
+        """
+        output_folders = {k: v for k, v in output_folders.items() if v is not None}
+        assert len(output_folders) > 0, 'At least one stage must be written to disk'
+        assert all([k in GOUHFI_STAGES for k in output_folders.keys()]), \
+            f'Unknown stage(s) in output_folders. Allowed are {GOUHFI_STAGES}'
+        if 'reordered' in output_folders.keys():
+            assert self.lut_mapping is not None, 'Label reordering requires in_lut and out_lut'
+        for folder in output_folders.values():
+            maybe_mkdir_p(folder)
+        if 'raw' in output_folders.keys():
+            # same as nnUNetv2_predict: needed if the raw predictions are post-processed with nnU-Net's CLIs later on
+            save_json(self.predictor.dataset_json, join(output_folders['raw'], 'dataset.json'), sort_keys=False)
+            save_json(self.predictor.plans_manager.plans, join(output_folders['raw'], 'plans.json'), sort_keys=False)
+
+        # the folder of the last stage defines the case names. We just need it to derive the file names
+        list_of_lists, output_filename_truncated, _ = self.predictor._manage_input_and_output_lists(
+            source_folder, output_folders[[i for i in GOUHFI_STAGES if i in output_folders.keys()][-1]]
+        )
+        if len(list_of_lists) == 0:
+            return
+
+        data_iterator = self.predictor._internal_get_data_iterator_from_lists_of_filenames(
+            list_of_lists, None, output_filename_truncated, num_processes_preprocessing
+        )
+
+        predictor = self.predictor
+        prediction_peak_rss = 0
+        # the workers get everything but the logits once when they start, the logits are handed over in shared memory
+        worker_initializer = partial(initialize_export_worker, pp_fns=self.pp_fns, pp_fn_kwargs=self.pp_fn_kwargs,
+                                     lut_mapping=self.lut_mapping)
+        with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export, initializer=worker_initializer,
+                                                       initargs=(predictor.plans_manager,
+                                                                 predictor.configuration_manager,
+                                                                 predictor.dataset_json)) as export_pool:
+            worker_list = [i for i in export_pool._pool]
+            r = []
+            export_results_main_process = []
+            case_names = []
+            # (export, shared memory with its logits). The memory is released once the export is done
+            shared_blocks = []
+            try:
+                for preprocessed in data_iterator:
+                    data = preprocessed['data']
+                    if isinstance(data, str):
+                        delfile = data
+                        data = torch.from_numpy(np.load(data))
+                        os.remove(delfile)
+
+                    case_name = os.path.basename(preprocessed['ofile'])
+                    case_names.append(case_name)
+                    set_telemetry_case(case_name)
+                    print(f'\nPredicting {case_name}:')
+
+                    # let's not get into a runaway situation where we predict faster than we can export
+                    proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
+                    while not proceed:
+                        sleep(0.1)
+                        proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
+                    shared_blocks = release_finished_shared_memory(shared_blocks)
+
+                    output_files = {stage: join(folder, case_name + self.file_ending)
+                                    for stage, folder in output_folders.items()}
+                    if predictor.max_memory is not None:
+                        prediction = predictor.predict_logits_from_preprocessed_data(data).cpu()
+                        prediction_peak_rss = max(prediction_peak_rss, get_peak_rss())
+                        # the logits may be memory mapped, sending them to a worker would pickle all of them
+                        print('exporting, post-processing and reordering in the main process (max_memory)')
+                        export_results_main_process.append(export_gouhfi_stages_from_logits(
+                            prediction, preprocessed['data_properties'], predictor.configuration_manager,
+                            predictor.plans_manager, predictor.dataset_json, self.pp_fns, self.pp_fn_kwargs,
+                            self.lut_mapping, output_files, predictor.max_memory))
+                        del prediction
+                    else:
+                        block, prediction = create_shared_memory_tensor(
+                            (predictor.label_manager.num_segmentation_heads, *data.shape[1:]))
+                        predictor.predict_logits_from_preprocessed_data(data, out=prediction)
+                        prediction_peak_rss = max(prediction_peak_rss, get_peak_rss(),
+                                                  predictor.memory_stats['peak_rss'])
+                        shared_logits = get_shared_memory_descriptor(block, prediction)
+                        del prediction
+                        print('sending off prediction to background worker for export, post-processing and '
+                              'reordering')
+                        r.append(
+                            export_pool.starmap_async(
+                                export_gouhfi_stages_from_shared_logits,
+                                ((shared_logits, preprocessed['data_properties'], output_files),)
+                            )
+                        )
+                        shared_blocks.append((r[-1], block))
+                    print(f'done with {case_name}')
+                # (peak RAM, label counts, voxel volume) of every case, in the order of case_names
+                export_results = [i.get()[0] for i in r] + export_results_main_process
+                export_peak_rss = max(i[0] for i in export_results)
+            finally:
+                set_telemetry_case(None)
+                for _, block in shared_blocks:
+                    release_shared_memory(block)
+
+        self.memory_stats = {'prediction': prediction_peak_rss, 'export': export_peak_rss}
+        if volumetry_file is not None:
+            write_volumetry(volumetry_file, case_names, [i[1:] for i in export_results], volumetry_label_map)
+        if predictor.max_memory is not None:
+            print(f'Peak RAM: {prediction_peak_rss / 1e9:.2f} GB for the prediction, {export_peak_rss / 1e9:.2f} GB '
+                  f'after the export (resampling, post-processing and reordering, main process)')
+        else:
+            print(f'Peak RAM: {prediction_peak_rss / 1e9:.2f} GB for the prediction (main process or fold worker), '
+                  f'{export_peak_rss / 1e9:.2f} GB per export worker (resampling, post-processing and reordering, '
+                  f'{num_processes_segmentation_export} workers)')
+
+        # clear lru cache
+        compute_gaussian.cache_clear()
+        # clear device cache
+        empty_cache(predictor.device)
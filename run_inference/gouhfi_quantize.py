@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+#----------------------------------------------------------------------------------#
+# Copyright 2025 [Marc-Antoine Fortin, MR Physics, NTNU]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#---------------------------------------------------------------------------------#
+"""
+Post-training int8 quantization of the trained GOUHFI folds for CPU inference (run_gouhfi_quantize).
+
+The weights and activations of every fold are quantized to int8 (static quantization). The activation ranges are
+calibrated on patches of a few conformed and brain-extracted volumes. The int8 checkpoints are written next to the
+original ones (fold_X/checkpoint_best_int8.pth) and are used by run_gouhfi --int8. The accuracy of the int8 ensemble is
+then reported per label of the GOUHFI lookuptable against the fp32 ensemble.
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+
+def sample_calibration_tiles(predictor, data, num_tiles, rng):
+    """Randomly picks num_tiles sliding window patches of a preprocessed case that contain brain voxels."""
+    import torch
+    from acvl_utils.cropping_and_padding.padding import pad_nd_image
+
+    data = pad_nd_image(data, predictor.configuration_manager.patch_size, 'constant', {'value': 0}, False, None)
+    slicers = [sl for sl in predictor._internal_get_sliding_window_slicers(data.shape[1:])
+               if torch.count_nonzero(data[sl]).item() > 0]
+    return [data[sl][None] for sl in rng.sample(slicers, min(num_tiles, len(slicers)))]
+
+
+def quantize_folds(pipeline, model_dir, folds, calibration_tiles, backend, fp32_modules, checkpoint_name):
+    """Calibrates one int8 network per fold on calibration_tiles and writes it next to the fp32 checkpoint."""
+    import torch
+    from nnunetv2.inference.quantization import get_int8_checkpoint_name, prepare_network_for_int8, calibrate_int8, \
+        convert_to_int8
+
+    predictor = pipeline.predictor
+    int8_checkpoint_name = get_int8_checkpoint_name(checkpoint_name)
+    for fold, params in zip(folds, predictor.list_of_parameters):
+        start_time = time.time()
+        network = predictor.network
+        network.load_state_dict(params)
+        prepared_network = prepare_network_for_int8(network, calibration_tiles[0], backend, fp32_modules)
+        calibrate_int8(prepared_network, calibration_tiles)
+        int8_network = convert_to_int8(prepared_network)
+
+        checkpoint = torch.load(os.path.join(model_dir, f'fold_{fold}', checkpoint_name), map_location=torch.device('cpu'))
+        # only what nnUNetPredictor needs. The optimizer state is useless for inference
+        int8_checkpoint = {k: checkpoint[k] for k in ('trainer_name', 'init_args', 'inference_allowed_mirroring_axes')
+                           if k in checkpoint.keys()}
+        int8_checkpoint['network_weights'] = int8_network.state_dict()
+        int8_checkpoint['int8_quantization'] = {'backend': backend, 'fp32_modules': list(fp32_modules),
+                                                'source_checkpoint': checkpoint_name,
+                                                'num_calibration_tiles': len(calibration_tiles)}
+        output_file = os.path.join(model_dir, f'fold_{fold}', int8_checkpoint_name)
+        torch.save(int8_checkpoint, output_file)
+        print(f"Fold {fold}: int8 checkpoint written to {output_file} ({time.time() - start_time:.2f} seconds).")
+    return int8_checkpoint_name
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize the trained GOUHFI folds to int8 for faster CPU inference (run_gouhfi --int8).")
+    parser.add_argument("-i", "--input_dir", required=True, help="Directory containing the calibration images ({SUBJECT_ID}_0000.nii.gz, conformed and brain-extracted).")
+    parser.add_argument("--eval_dir", default=None, help="Directory containing the images used to compare the int8 and fp32 ensembles. Default: --input_dir.")
+    parser.add_argument("--num_cases", type=int, default=4, help="Number of calibration images. Default: 4.")
+    parser.add_argument("--num_eval_cases", type=int, default=2, help="Number of images used for the accuracy report. 0 skips the report. Default: 2.")
+    parser.add_argument("--tiles_per_case", type=int, default=16, help="Number of patches per calibration image. Default: 16.")
+    parser.add_argument("--folds", default="0 1 2 3 4", help="Folds to quantize. By default all folds are quantized.")
+    parser.add_argument("--backend", default="x86", help="Quantization backend: x86 (default, Intel/AMD CPUs), fbgemm or qnnpack (ARM CPUs).")
+    parser.add_argument("--fp32_modules", default="decoder.seg_layers", help="Space-separated names of network modules kept in fp32. Default: the segmentation layers (\"decoder.seg_layers\"). Use \"\" to quantize everything.")
+    parser.add_argument("--seed", type=int, default=1234, help="Seed for sampling the calibration patches. Default: 1234.")
+    parser.add_argument("--output_json", default=None, help="Optional JSON file for the accuracy report.")
+    args = parser.parse_args()
+
+    # Importing this module sets up GOUHFI_HOME and the nnUNet environment variables
+    from run_inference.gouhfi_inference_postpro_reo import get_model_paths, get_lut_paths, setup_torch_device, \
+        get_checkpoint_name
+    from run_inference.gouhfi_pipeline import GouhfiPipeline
+    from run_inference.gouhfi_benchmark import dice_per_label
+    from data_utils.reorder_labels_freesurfer_lut import load_labels
+    from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
+
+    device = setup_torch_device(cpu=True)
+    model_dir, pp_pkl_file = get_model_paths()
+    folds = [i if i == 'all' else int(i) for i in args.folds.split()]
+    checkpoint_name = get_checkpoint_name()
+    pipeline_kwargs = dict(use_folds=folds, pp_pkl_file=str(pp_pkl_file), device=device, allow_tqdm=False,
+                           keep_folds_resident=True)
+    fp32_pipeline = GouhfiPipeline(str(model_dir), checkpoint_name=checkpoint_name, **pipeline_kwargs)
+
+    rng = random.Random(args.seed)
+    calibration_tiles = []
+    for image_files in create_lists_from_splitted_dataset_folder(args.input_dir, fp32_pipeline.file_ending)[:args.num_cases]:
+        data, _ = fp32_pipeline.preprocess_files(image_files)
+        calibration_tiles += sample_calibration_tiles(fp32_pipeline.predictor, data, args.tiles_per_case, rng)
+    assert len(calibration_tiles) > 0, f"No calibration patches found in {args.input_dir}"
+    print(f"Calibrating on {len(calibration_tiles)} patches.")
+    int8_checkpoint_name = quantize_folds(fp32_pipeline, model_dir, folds, calibration_tiles, args.backend,
+                                          args.fp32_modules.split(), checkpoint_name)
+
+    if args.num_eval_cases <= 0:
+        return
+    int8_pipeline = GouhfiPipeline(str(model_dir), checkpoint_name=int8_checkpoint_name, **pipeline_kwargs)
+    # load_labels keeps the R value of lookuptables with RGBA columns in the name
+    label_names = {k: " ".join(i for i in v.split() if not i.isdigit()) for k, v in load_labels(get_lut_paths()[0]).items()}
+    eval_dir = args.eval_dir if args.eval_dir is not None else args.input_dir
+    dices, cases = {}, []
+    for image_files in create_lists_from_splitted_dataset_folder(eval_dir, fp32_pipeline.file_ending)[:args.num_eval_cases]:
+        data, properties = fp32_pipeline.preprocess_files(image_files)
+        start_time = time.time()
+        reference = fp32_pipeline.segment_preprocessed_case(data, properties)['postpro']
+        fp32_seconds = time.time() - start_time
+        start_time = time.time()
+        int8_segmentation = int8_pipeline.segment_preprocessed_case(data, properties)['postpro']
+        int8_seconds = time.time() - start_time
+        case_dices = dice_per_label(reference, int8_segmentation, labels=[i for i in label_names.keys() if i != 0])
+        for label, dice in case_dices.items():
+            dices.setdefault(label, []).append(dice)
+        cases.append({'case': image_files[0], 'fp32_seconds': fp32_seconds, 'int8_seconds': int8_seconds,
+                      'voxel_agreement': float(np.mean(reference == int8_segmentation))})
+        print(f"{image_files[0]}: fp32 {fp32_seconds:.2f} s, int8 {int8_seconds:.2f} s, "
+              f"voxel agreement {cases[-1]['voxel_agreement']:.5f}")
+
+    mean_dices = {label: float(np.nanmean(d)) if not np.all(np.isnan(d)) else float('nan') for label, d in dices.items()}
+    print("\nDice of the int8 ensemble against the fp32 ensemble:")
+    for label, dice in mean_dices.items():
+        print(f"{label:>4}  {label_names[label]:<40}{dice:.4f}")
+    print(f"Mean Dice: {np.nanmean(list(mean_dices.values())):.4f}, speed-up: "
+          f"{sum(c['fp32_seconds'] for c in cases) / sum(c['int8_seconds'] for c in cases):.2f}x")
+    if args.output_json is not None:
+        with open(args.output_json, 'w') as f:
+            json.dump({'settings': vars(args), 'cases': cases,
+                       'dice_per_label': {label_names[k]: v for k, v in mean_dices.items()}}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
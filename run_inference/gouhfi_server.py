@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+#----------------------------------------------------------------------------------#
+# Copyright 2025 [Marc-Antoine Fortin, MR Physics, NTNU]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#---------------------------------------------------------------------------------#
+"""
+Persistent GOUHFI inference server (run_gouhfi_server) and its thin client (run_gouhfi_client).
+
+The server loads the trained model once and keeps one network per fold resident, so single-subject jobs do not pay for
+importing torch, loading the checkpoints and building the network. Jobs are sent over localhost HTTP:
+
+    GET  /health          -> JSON with the server status
+    POST /segment         -> JSON {"input_files": [...], "output_files": {"postpro": ..., "reordered": ...}}
+                             Paths are read and written by the server. Returns the written files as JSON.
+    POST /segment_array   -> body: .npz with 'image' (c, x, y, z) and 'spacing'. Returns a .npz with the label map of
+                             every stage ('raw', 'postpro' and 'reordered' if the server reorders labels).
+"""
+import argparse
+import io
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8014
+
+
+class GouhfiRequestHandler(BaseHTTPRequestHandler):
+    # set by serve()
+    pipeline = None
+    pipeline_lock = None
+    server_info = None
+
+    def _send(self, code, body, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, dict(self.server_info, status='ok', busy=self.pipeline_lock.locked()))
+        else:
+            self._send(404, {'error': f'Unknown endpoint {self.path}'})
+
+    def do_POST(self):
+        start_time = time.time()
+        try:
+            if self.path == '/segment':
+                job = json.loads(self._read_body())
+                input_files = [os.path.abspath(i) for i in job['input_files']]
+                output_files = {k: os.path.abspath(v) for k, v in job['output_files'].items() if v is not None}
+                unknown_stages = [i for i in output_files.keys() if i not in self.pipeline.stages]
+                if len(unknown_stages) > 0:
+                    raise ValueError(f'This server cannot produce the stage(s) {unknown_stages}. Available: '
+                                     f'{list(self.pipeline.stages)}')
+                with self.pipeline_lock:
+                    data, properties = self.pipeline.preprocess_files(input_files)
+                    segmentations = self.pipeline.segment_preprocessed_case(data, properties)
+                    self.pipeline.write_stages(segmentations, output_files, properties)
+                self._send(200, {'output_files': output_files, 'seconds': time.time() - start_time})
+            elif self.path == '/segment_array':
+                arrays = np.load(io.BytesIO(self._read_body()), allow_pickle=False)
+                with self.pipeline_lock:
+                    data, properties = self.pipeline.preprocess_array(arrays['image'],
+                                                                      {'spacing': [float(i) for i in arrays['spacing']]})
+                    segmentations = self.pipeline.segment_preprocessed_case(data, properties)
+                buffer = io.BytesIO()
+                np.savez_compressed(buffer, **segmentations)
+                self._send(200, buffer.getvalue(), content_type='application/octet-stream')
+            else:
+                self._send(404, {'error': f'Unknown endpoint {self.path}'})
+                return
+            print(f"{self.path} job done in {time.time() - start_time:.2f} seconds.")
+        except (KeyError, ValueError, FileNotFoundError) as e:
+            self._send(400, {'error': f'{type(e).__name__}: {e}'})
+        except Exception as e:
+            self._send(500, {'error': f'{type(e).__name__}: {e}'})
+            raise e
+
+
+def serve(pipeline, host=DEFAULT_HOST, port=DEFAULT_PORT, server_info=None):
+    """Serves jobs with an already initialized GouhfiPipeline until interrupted. Jobs are run one at a time."""
+    GouhfiRequestHandler.pipeline = pipeline
+    GouhfiRequestHandler.pipeline_lock = threading.Lock()
+    GouhfiRequestHandler.server_info = server_info if server_info is not None else {}
+    httpd = ThreadingHTTPServer((host, port), GouhfiRequestHandler)
+    print(f"GOUHFI server listening on http://{host}:{port}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down GOUHFI server.")
+    finally:
+        httpd.server_close()
+
+
+def send_request(host, port, endpoint, body=None, content_type='application/json', timeout=None):
+    url = f"http://{host}:{port}{endpoint}"
+    if body is not None and content_type == 'application/json':
+        body = json.dumps(body).encode('utf-8')
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': content_type},
+                                     method='GET' if body is None else 'POST')
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            payload = response.read()
+            if response.headers.get('Content-Type') == 'application/json':
+                return json.loads(payload)
+            return payload
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f"GOUHFI server returned {e.code}: {e.read().decode('utf-8')}") from None
+
+
+def segment_files(input_files, output_files, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Client side of /segment. output_files maps stage names ('raw', 'postpro', 'reordered') to file names."""
+    return send_request(host, port, '/segment', {
+        'input_files': [os.path.abspath(i) for i in input_files],
+        'output_files': {k: os.path.abspath(v) for k, v in output_files.items() if v is not None},
+    })
+
+
+def segment_array(image, spacing, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Client side of /segment_array. Returns a dict with the label map of every stage."""
+    buffer = io.BytesIO()
+    np.savez(buffer, image=image, spacing=np.asarray(spacing, dtype=np.float64))
+    payload = send_request(host, port, '/segment_array', buffer.getvalue(), content_type='application/octet-stream')
+    with np.load(io.BytesIO(payload)) as arrays:
+        return {k: arrays[k] for k in arrays.files}
+
+
+def main_server():
+    parser = argparse.ArgumentParser(description="Run a persistent GOUHFI inference server keeping the trained model in memory.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"Host to listen on. Default: {DEFAULT_HOST} (local jobs only).")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port to listen on. Default: {DEFAULT_PORT}")
+    parser.add_argument("--folds", default="0 1 2 3 4", help="Folds to use for inference. By default all folds are used and combined together.")
+    parser.add_argument("--reorder_labels", action="store_true", help="Set flag if the server should also produce label maps reordered to the FreeSurfer lookuptable.")
+    parser.add_argument("--cpu", action="store_true", help="Set flag to use the CPU to run the inference. Expect a considerable increase in inference time.")
+    parser.add_argument("--fuse_folds", action="store_true", help="Set flag to run all folds on the same tile in a single forward pass.")
+    parser.add_argument("--fold_workers", type=int, default=0, help="Number of background workers predicting the folds concurrently. Default: 0 (folds are predicted one after the other).")
+    parser.add_argument("--fold_devices", default=None, help="Space-separated string of devices to predict the folds concurrently with one worker per device (e.g., \"cuda:0 cuda:1\").")
+    parser.add_argument("--tile_batch_size", default="1", help="Number of patches predicted in one forward pass, or 'auto' to derive it from the free (V)RAM. Default: 1.")
+    parser.add_argument("--batched_tta", "--batched-tta", action="store_true", help="Set flag to predict a patch and all its mirrored versions in a single forward pass.")
+    parser.add_argument("--tta_subset", "--tta-subset", default=None, help="Space-separated mirror axes combinations used for test-time augmentation (e.g., \"0 1 2\"). 'none' disables test-time augmentation. Default: all combinations.")
+    parser.add_argument("--skip_empty_tiles", nargs="?", type=float, const=0.0, default=None, help="Set flag to skip the patches without brain. An optional value skips the patches whose fraction of brain voxels is <= this value.")
+    parser.add_argument("--max_tiles", type=int, default=None, help="Maximum number of patches per subject (and fold, unless --fuse_folds is set). Default: no limit.")
+    parser.add_argument("--target_latency", type=float, default=None, help="Target inference time per subject in seconds. Default: no limit.")
+    parser.add_argument("--refine_threshold", type=float, default=None, help="Set to predict with little overlap first and refine the uncertain patches. Default: no refinement.")
+    parser.add_argument("--cpu_precision", "--cpu-precision", default="fp32", choices=["fp32", "bf16", "auto"], help="Only used with --cpu. Precision of the network (see run_gouhfi). Default: fp32.")
+    parser.add_argument("--int8", action="store_true", help="Only used with --cpu. Set flag to use the int8 quantized folds written by run_gouhfi_quantize.")
+    parser.add_argument("--backend", default="torch", choices=["torch", "torchscript", "onnxruntime"], help="Runtime of the network. torchscript and onnxruntime use the folds exported by run_gouhfi_export (see run_gouhfi). Default: torch.")
+    parser.add_argument("--accumulate_folds_on_device", action="store_true", help="Set flag to sum the predictions of the folds in VRAM instead of RAM (see run_gouhfi).")
+    parser.add_argument("--max_memory", "--max-memory", type=float, default=None, help="Memory budget in GB for the predictions of a subject. Larger predictions are memory-mapped and resampled slab by slab (see run_gouhfi). Default: no limit.")
+    parser.add_argument("--memmap_dir", default=None, help="Only used with --max_memory. Directory for the memory-mapped predictions. Default: the system's temp directory.")
+    parser.add_argument("--no_warmup", action="store_true", help="Set flag to skip predicting a dummy tile at start-up. The first job will then be slower.")
+    args = parser.parse_args()
+    if args.int8 and not args.cpu:
+        parser.error("--int8 requires --cpu")
+    if args.int8 and args.fuse_folds:
+        parser.error("--int8 cannot be combined with --fuse_folds")
+    if args.backend != "torch" and (args.int8 or args.fold_workers > 0 or args.fold_devices is not None):
+        parser.error("--backend torchscript/onnxruntime cannot be combined with --int8, --fold_workers or --fold_devices")
+    if args.max_memory is not None and (args.fold_workers > 0 or args.fold_devices is not None or args.accumulate_folds_on_device):
+        parser.error("--max_memory cannot be combined with --fold_workers, --fold_devices or --accumulate_folds_on_device")
+
+    # Importing this module sets up GOUHFI_HOME and the nnUNet environment variables
+    from run_inference.gouhfi_inference_postpro_reo import get_model_paths, get_lut_paths, setup_torch_device, \
+        parse_tta_subset, get_checkpoint_name
+    from run_inference.gouhfi_pipeline import GouhfiPipeline
+
+    device = setup_torch_device(args.cpu)
+    model_dir, pp_pkl_file = get_model_paths()
+    in_lut, out_lut = get_lut_paths() if args.reorder_labels else (None, None)
+    folds = [i if i == 'all' else int(i) for i in args.folds.split()]
+
+    start_time = time.time()
+    pipeline = GouhfiPipeline(str(model_dir), folds, checkpoint_name=get_checkpoint_name(args.int8),
+                              pp_pkl_file=str(pp_pkl_file), in_lut=in_lut, out_lut=out_lut, device=device,
+                              allow_tqdm=False, keep_folds_resident=True, fuse_folds=args.fuse_folds,
+                              fold_workers=args.fold_workers,
+                              fold_devices=args.fold_devices.split() if args.fold_devices is not None else None,
+                              tile_batch_size=args.tile_batch_size if args.tile_batch_size == "auto" else int(args.tile_batch_size),
+                              batched_tta=args.batched_tta,
+                              tta_subset=parse_tta_subset(args.tta_subset) if args.tta_subset is not None else None,
+                              tile_skip_threshold=args.skip_empty_tiles, max_tiles=args.max_tiles,
+                              target_latency=args.target_latency, refine_threshold=args.refine_threshold,
+                              cpu_precision=args.cpu_precision, backend=args.backend,
+                              accumulate_folds_on_device=args.accumulate_folds_on_device,
+                              max_memory=int(args.max_memory * 1e9) if args.max_memory is not None else None,
+                              memmap_dir=args.memmap_dir)
+    if not args.no_warmup:
+        pipeline.warm_up()
+    print(f"Model loaded in {time.time() - start_time:.2f} seconds.")
+    serve(pipeline, args.host, args.port,
+          server_info={'folds': folds, 'device': str(device), 'reorder_labels': args.reorder_labels,
+                       'fuse_folds': args.fuse_folds, 'int8': args.int8,
+                       'backend': args.backend})
+
+
+def main_client():
+    parser = argparse.ArgumentParser(description="Send a segmentation job to a running GOUHFI server (see run_gouhfi_server).")
+    parser.add_argument("-i", "--input_files", nargs="+", help="Input image(s) of one subject (one file per input channel, usually {SUBJECT_ID}_0000.nii.gz).")
+    parser.add_argument("-o", "--output_file", help="Output file for the post-processed label map.")
+    parser.add_argument("--output_reordered", help="Optional output file for the label map reordered to the FreeSurfer lookuptable (the server must run with --reorder_labels).")
+    parser.add_argument("--output_raw", help="Optional output file for the raw prediction (before post-processing).")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"Host of the server. Default: {DEFAULT_HOST}")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port of the server. Default: {DEFAULT_PORT}")
+    parser.add_argument("--status", action="store_true", help="Only print the status of the server and exit.")
+    args = parser.parse_args()
+
+    if args.status:
+        print(json.dumps(send_request(args.host, args.port, '/health'), indent=2))
+        return
+    if not args.input_files or not (args.output_file or args.output_reordered or args.output_raw):
+        parser.error("-i/--input_files and at least one output file are required unless --status is set")
+
+    result = segment_files(args.input_files,
+                           {'raw': args.output_raw, 'postpro': args.output_file, 'reordered': args.output_reordered},
+                           args.host, args.port)
+    for stage, output_file in result['output_files'].items():
+        print(f"{stage}: {output_file}")
+    print(f"Segmentation completed in {result['seconds']:.2f} seconds.")
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+#----------------------------------------------------------------------------------#
+# Copyright 2025 [Marc-Antoine Fortin, MR Physics, NTNU]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#---------------------------------------------------------------------------------#
+"""
+Inference speed benchmark of run_gouhfi configurations (run_gouhfi_speed_benchmark).
+
+The test images and/or synthetic head-shaped volumes are resampled to every requested resolution (e.g. 1.0, 0.7 and
+0.5 mm) and every configuration (a set of run_gouhfi options) is run on them with every requested number of folds, each
+run in a fresh run_gouhfi process with --telemetry. The cases per hour, the latency of every stage per case (from the
+telemetry), the peak RSS of the run and the peak device memory are reported and can be compared against the results of
+a previous benchmark (--baseline), e.g. before rolling out an upgrade. Runs whose throughput drops or whose memory grows
+by more than --tolerance are reported as regressions and the benchmark exits with code 1.
+"""
+import argparse
+import json
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def make_synthetic_volume(fov_mm, resolution, rng):
+    """
+    Brain-extracted head stand-in: an ellipsoid filling most of fov_mm with smooth intensity variations (two tissue
+    classes and a bias field) and noise, zero outside. Returns the volume and its affine.
+    """
+    shape = [int(round(f / resolution)) for f in fov_mm]
+    grid = np.meshgrid(*[np.linspace(-1, 1, s, dtype=np.float32) for s in shape], indexing='ij')
+    radius = np.sqrt(sum((g / 0.8) ** 2 for g in grid))
+    inner = np.sqrt(sum((g / 0.45) ** 2 for g in grid))
+    volume = np.where(radius < 1, np.where(inner < 1, 60., 100.), 0.).astype(np.float32)
+    volume *= 1 + 0.1 * grid[0] + 0.05 * grid[2]
+    volume[radius < 1] += rng.normal(0, 5, int(np.count_nonzero(radius < 1))).astype(np.float32)
+    affine = np.diag([resolution, resolution, resolution, 1.])
+    affine[:3, 3] = -np.array(shape) * resolution / 2
+    return volume, affine
+
+
+def resample_to_resolution(image_file, resolution):
+    """Resamples an image (trilinear) to isotropic resolution. Returns the volume and its affine."""
+    import nibabel as nib
+    from scipy.ndimage import zoom
+
+    img = nib.load(image_file)
+    spacing = np.array(img.header.get_zooms()[:3], dtype=float)
+    volume = zoom(np.asanyarray(img.dataobj).astype(np.float32), spacing / resolution, order=1)
+    affine = img.affine.copy()
+    affine[:3, :3] = affine[:3, :3] / spacing * resolution
+    return volume, affine
+
+
+def prepare_inputs(work_dir, sources, resolutions, test_data_dir, num_synthetic, fov_mm, seed):
+    """
+    Writes the input images of every source ('synthetic', 'test_data') and resolution to
+    work_dir/inputs/{source}_{resolution}mm. Existing folders are reused so that repeated benchmarks use the same images.
+    Returns {(source, resolution): folder}.
+    """
+    import nibabel as nib
+
+    folders = {}
+    for source in sources:
+        for resolution in resolutions:
+            folder = os.path.join(work_dir, 'inputs', f'{source}_{resolution:g}mm')
+            folders[(source, resolution)] = folder
+            if os.path.isdir(folder) and len(os.listdir(folder)) > 0:
+                continue
+            os.makedirs(folder, exist_ok=True)
+            if source == 'synthetic':
+                rng = np.random.default_rng(seed)
+                for i in range(num_synthetic):
+                    volume, affine = make_synthetic_volume(fov_mm, resolution, rng)
+                    nib.save(nib.Nifti1Image(volume, affine), os.path.join(folder, f'synthetic{i:03d}_0000.nii.gz'))
+            else:
+                for f in sorted(os.listdir(test_data_dir)):
+                    if f.endswith('.nii.gz'):
+                        volume, affine = resample_to_resolution(os.path.join(test_data_dir, f), resolution)
+                        nib.save(nib.Nifti1Image(volume, affine), os.path.join(folder, f))
+            print(f"Wrote the {source} images at {resolution:g} mm to {folder}")
+    return folders
+
+
+def run_gouhfi_and_measure(input_dir, output_dir, folds, options, telemetry_file):
+    """
+    Runs run_gouhfi in a new process. Returns the wall time, its return code and the peak RSS (bytes) of the largest
+    process of the run (run_gouhfi and the workers and subprocesses it waited for). None if not available.
+    """
+    command = [sys.executable, '-m', 'run_inference.gouhfi_inference_postpro_reo', '-i', input_dir, '-o', output_dir,
+               '--folds', ' '.join(str(i) for i in folds), '--telemetry', telemetry_file] + shlex.split(options)
+    print(f"Running: {' '.join(shlex.quote(i) for i in command)}")
+    start_time = time.time()
+    process = subprocess.Popen(command)
+    if hasattr(os, 'wait4'):
+        # the resource usage of this very process (and its waited-for descendants), not of all our children so far
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # kilobytes on linux, bytes on macOS
+        peak_rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    else:
+        process.wait()
+        peak_rss = None
+    return time.time() - start_time, process.returncode, peak_rss
+
+
+def summarize_run(spans, num_cases, seconds):
+    """Cases per hour, per-stage latency, per-case latency and peak device memory of one run from its telemetry"""
+    from nnunetv2.utilities.telemetry import summarize_spans
+
+    case_spans = [s for s in spans if s['case'] is not None]
+    case_latency = {}
+    for case in set(s['case'] for s in case_spans):
+        starts_and_ends = [(s['start'], s['start'] + s['duration']) for s in case_spans if s['case'] == case]
+        case_latency[case] = max(e for _, e in starts_and_ends) - min(s for s, _ in starts_and_ends)
+    device_memory = [s['peak_device_memory'] for s in spans
+                     if s['name'] == 'prediction' and s.get('peak_device_memory') is not None]
+    latencies = list(case_latency.values())
+    return {
+        'cases_per_hour': num_cases / seconds * 3600,
+        'stages': summarize_spans(case_spans),
+        'case_latency': {'p50': float(np.percentile(latencies, 50)), 'p90': float(np.percentile(latencies, 90)),
+                         'max': float(np.max(latencies))} if len(latencies) > 0 else None,
+        'peak_device_memory': max(device_memory) if len(device_memory) > 0 else None,
+    }
+
+
+def get_run_key(run):
+    return f"{run['config']}|{run['source']}|{run['resolution']:g}mm|{run['num_folds']} folds"
+
+
+def compare_to_baseline(runs, baseline_runs, tolerance):
+    """
+    Relative change of the throughput, the p50 stage latencies and the memory of every run that is also in the
+    baseline. Returns the comparison of every run and the list of regressions.
+    """
+    baseline_runs = {get_run_key(r): r for r in baseline_runs}
+    comparisons, regressions = {}, []
+    for run in runs:
+        key = get_run_key(run)
+        if key not in baseline_runs or run['returncode'] != 0:
+            continue
+        base = baseline_runs[key]
+        comparison = {'cases_per_hour': run['cases_per_hour'] / base['cases_per_hour'] - 1}
+        for name in ('peak_rss', 'peak_device_memory'):
+            if run.get(name) is not None and base.get(name):
+                comparison[name] = run[name] / base[name] - 1
+        comparison['stages_p50'] = {name: stage['p50'] / base['stages'][name]['p50'] - 1
+                                    for name, stage in run['stages'].items()
+                                    if name in base['stages'] and base['stages'][name]['p50'] > 0}
+        comparisons[key] = comparison
+        if comparison['cases_per_hour'] < -tolerance:
+            regressions.append(f"{key}: {-comparison['cases_per_hour']:.1%} fewer cases per hour")
+        for name in ('peak_rss', 'peak_device_memory'):
+            if comparison.get(name, 0) > tolerance:
+                regressions.append(f"{key}: {comparison[name]:.1%} more {name}")
+    return comparisons, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the inference speed and memory of run_gouhfi configurations at several resolutions and fold counts.")
+    parser.add_argument("-w", "--work_dir", required=True, help="Directory for the resampled input images, the label maps and the telemetry of every run. Existing input images are reused.")
+    parser.add_argument("-i", "--input_dir", default=None, help="Directory with the test images ({SUBJECT_ID}_0000.nii.gz, conformed and brain-extracted). Default: $GOUHFI_HOME/test_data/input-images-lia-brain-extracted/all-subs.")
+    parser.add_argument("--sources", default="synthetic test_data", help="Space-separated image sources: synthetic and/or test_data. Default: both.")
+    parser.add_argument("--resolutions", default="1.0 0.7 0.5", help="Space-separated isotropic resolutions in mm the images are resampled to. Default: \"1.0 0.7 0.5\".")
+    parser.add_argument("--fold_counts", default="1 5", help="Space-separated numbers of folds (the first N of 0 1 2 3 4). Default: \"1 5\".")
+    parser.add_argument("--config", nargs=2, action="append", metavar=("NAME", "OPTIONS"), default=None, help="Configuration to benchmark: a name and the run_gouhfi options as one string (e.g., --config resident \"--in_process --resident_folds\"). Can be repeated. Default: default \"--in_process\".")
+    parser.add_argument("--cpu", action="store_true", help="Set flag to add --cpu to every configuration.")
+    parser.add_argument("--num_synthetic", type=int, default=2, help="Number of synthetic images per resolution. Default: 2.")
+    parser.add_argument("--fov", default="176 208 176", help="Space-separated field of view in mm of the synthetic images. Default: \"176 208 176\".")
+    parser.add_argument("--seed", type=int, default=1234, help="Seed of the synthetic images. Default: 1234.")
+    parser.add_argument("--output_json", default=None, help="JSON file the results are written to. Default: benchmark.json in --work_dir. Can be used as --baseline later on.")
+    parser.add_argument("--baseline", default=None, help="Results of a previous benchmark (--output_json) to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Only used with --baseline. Relative loss of cases per hour (or increase of peak memory) reported as a regression. Default: 0.1.")
+    args = parser.parse_args()
+
+    # Importing this module sets up GOUHFI_HOME and the nnUNet environment variables
+    from run_inference.gouhfi_inference_postpro_reo import gouhfi_home
+    from nnunetv2.utilities.telemetry import load_spans
+
+    sources = args.sources.split()
+    unknown_sources = [i for i in sources if i not in ('synthetic', 'test_data')]
+    if len(unknown_sources) > 0:
+        parser.error(f"Unknown sources {unknown_sources}. Use synthetic and/or test_data")
+    test_data_dir = args.input_dir if args.input_dir is not None else \
+        os.path.join(gouhfi_home, "test_data", "input-images-lia-brain-extracted", "all-subs")
+    if 'test_data' in sources and not os.path.isdir(test_data_dir):
+        parser.error(f"Test images not found in {test_data_dir}. Use --input_dir or --sources synthetic")
+    resolutions = [float(i) for i in args.resolutions.split()]
+    fold_counts = [int(i) for i in args.fold_counts.split()]
+    if any(n < 1 or n > 5 for n in fold_counts):
+        parser.error("--fold_counts must be between 1 and 5")
+    configs = args.config if args.config is not None else [["default", "--in_process"]]
+    output_json = args.output_json if args.output_json is not None else os.path.join(args.work_dir, "benchmark.json")
+
+    input_folders = prepare_inputs(args.work_dir, sources, resolutions, test_data_dir, args.num_synthetic,
+                                   [float(i) for i in args.fov.split()], args.seed)
+    runs = []
+    for config_name, options in configs:
+        if args.cpu:
+            options = options + " --cpu"
+        for (source, resolution), input_dir in input_folders.items():
+            num_cases = len([i for i in os.listdir(input_dir) if i.endswith('.nii.gz')])
+            for num_folds in fold_counts:
+                run = {'config': config_name, 'options': options, 'source': source, 'resolution': resolution,
+                       'num_folds': num_folds, 'num_cases': num_cases}
+                run_dir = os.path.join(args.work_dir, 'runs', get_run_key(run).replace('|', '_').replace(' ', '_'))
+                os.makedirs(run_dir, exist_ok=True)
+                telemetry_file = os.path.join(run_dir, 'telemetry.jsonl')
+                seconds, returncode, peak_rss = run_gouhfi_and_measure(input_dir, os.path.join(run_dir, 'outputs'),
+                                                                       list(range(num_folds)), options, telemetry_file)
+                run.update({'seconds': seconds, 'returncode': returncode, 'peak_rss': peak_rss})
+                if returncode != 0:
+                    print(f"{get_run_key(run)}: run_gouhfi failed with return code {returncode}")
+                else:
+                    run.update(summarize_run(load_spans(telemetry_file), num_cases, seconds))
+                    print(f"{get_run_key(run)}: {run['cases_per_hour']:.1f} cases/hour, " +
+                          (f"p50 latency per case {run['case_latency']['p50']:.2f} s, "
+                           if run['case_latency'] is not None else "") +
+                          (f"peak RSS {peak_rss / 1e9:.2f} GB" if peak_rss is not None else "") +
+                          (f", peak VRAM {run['peak_device_memory'] / 1e9:.2f} GB"
+                           if run['peak_device_memory'] is not None else ""))
+                runs.append(run)
+
+    import torch
+    results = {
+        'environment': {'python': platform.python_version(), 'torch': torch.__version__, 'platform': platform.platform(),
+                        'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+                        'cuda_device': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None},
+        'settings': vars(args),
+        'runs': runs,
+    }
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        results['baseline'] = args.baseline
+        results['comparison'], regressions = compare_to_baseline(runs, baseline['runs'], args.tolerance)
+        print(f"\nComparison against {args.baseline}:")
+        for key, comparison in results['comparison'].items():
+            print(f"  {key}: {comparison['cases_per_hour']:+.1%} cases/hour" +
+                  (f", {comparison['peak_rss']:+.1%} peak RSS" if 'peak_rss' in comparison else "") +
+                  (f", {comparison['peak_device_memory']:+.1%} peak VRAM" if 'peak_device_memory' in comparison else ""))
+        results['regressions'] = regressions
+    with open(output_json, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output_json}")
+
+    failed = [get_run_key(r) for r in runs if r['returncode'] != 0]
+    if len(failed) > 0:
+        print(f"Failed runs: {', '.join(failed)}")
+    if len(regressions) > 0:
+        print("Regressions:\n  " + "\n  ".join(regressions))
+    if len(failed) > 0 or len(regressions) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()